@@ -0,0 +1,293 @@
+import asyncio
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from vcenter_collector import InventorySnapshot, iter_vm_properties, DEFAULT_PAGE_SIZE, DEFAULT_WORKERS
+from vcenter_fetcher import build_cluster_record, build_vm_records, default_transformer
+from data_conversion import cluster_entities, vm_entities
+from network_index import NetworkIndex
+from ingest_scheduler import DEFAULT_BATCH_ENTITIES, DEFAULT_BATCH_BYTES, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF, retry_delay, ingest_batch
+
+# Blocking vCenter calls allowed at once.
+DEFAULT_FETCH_CONCURRENCY = 4
+
+# Ingest calls allowed at once.
+DEFAULT_INGEST_CONCURRENCY = 4
+
+DEFAULT_QUEUE_SIZE = 100
+
+
+class AsyncIngester:
+    """
+    Consumer side of the asyncio pipeline: collects entity lists from a bounded queue into
+    batches bounded by entity count and serialized size, and sends each batch from the
+    executor while holding the ingest semaphore. Failed batches are retried with exponential
+    backoff. With a state store, unchanged entities are dropped and hashes recorded on success.
+    With an Outbox, each batch is written to it before it is sent and removed once ingested;
+    a batch that uses up its retries stays there for the next run and parks the outbox.
+    Entities left in the outbox by earlier runs are sent once the queue is closed.
+    """
+
+    def __init__(self, client, logging, executor, state=None, concurrency=DEFAULT_INGEST_CONCURRENCY,
+                 max_batch_entities=DEFAULT_BATCH_ENTITIES, max_batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, queue_size=DEFAULT_QUEUE_SIZE,
+                 outbox=None):
+        self.client = client
+        self.logging = logging
+        self.executor = executor
+        self.state = state
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.max_batch_entities = max(1, max_batch_entities)
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.outbox = outbox
+        self.batches = 0
+        self.ingested = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def put(self, entities):
+        """
+        Queues entities, waiting while the queue is full.
+        """
+        await self.queue.put(entities)
+
+    async def drain(self):
+        """
+        Sends everything queued so far and waits until it has been ingested.
+        """
+        done = asyncio.Event()
+        await self.queue.put(done)
+        await done.wait()
+
+    async def close(self):
+        await self.queue.put(None)
+
+    async def run(self):
+        """
+        Consumes the queue until close() is called, then replays the outbox.
+        """
+        loop = asyncio.get_running_loop()
+        pending = set()
+        batch, hashes, size = [], [], 0
+
+        async def _submit():
+            nonlocal batch, hashes, size
+            if not batch:
+                return
+            await self.semaphore.acquire()
+            task = asyncio.create_task(self._send(batch, hashes))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            batch, hashes, size = [], [], 0
+
+        while True:
+            item = await self.queue.get()
+            if item is None or isinstance(item, asyncio.Event):
+                await _submit()
+                if pending:
+                    await asyncio.gather(*pending)
+                if item is None:
+                    if self.outbox is not None:
+                        await self._replay()
+                    break
+                item.set()
+                continue
+
+            try:
+                entities, changed_hashes = item, None
+                if self.state is not None:
+                    entities, changed_hashes = await loop.run_in_executor(self.executor, self.state.filter_changed, item)
+                for index, entity in enumerate(entities):
+                    entity_size = entity.ByteSize()
+                    if batch and (len(batch) >= self.max_batch_entities or size + entity_size > self.max_batch_bytes):
+                        await _submit()
+                    batch.append(entity)
+                    if changed_hashes is not None:
+                        hashes.append(changed_hashes[index])
+                    size += entity_size
+            except Exception as e:
+                # Keep consuming so producers never block on a dead queue
+                self.logging.error(f"Error queueing entities for ingestion: {e}")
+
+    async def _replay(self):
+        """
+        Sends the rows earlier runs left in the outbox, oldest first. Entities this run sent
+        again have already replaced theirs. Stops when nothing is due, or the outbox is parked.
+        """
+        loop = asyncio.get_running_loop()
+        pending = set()
+        while True:
+            await self.semaphore.acquire()
+            try:
+                rows = await loop.run_in_executor(self.executor, self.outbox.claim, self.max_batch_entities, self.max_batch_bytes)
+                batch = self.outbox.entities(rows)
+            except Exception as e:
+                self.logging.error(f"Failed to read from the ingest outbox: {e}")
+                rows = []
+            if not rows:
+                self.semaphore.release()
+                break
+            hashes = [(entity_type, key, digest) for _, entity_type, key, digest, _, _ in rows]
+            task = asyncio.create_task(self._send(batch, hashes, [row[0] for row in rows]))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def _send(self, batch, hashes, ids=None):
+        """
+        Sends a batch, writing it to the outbox first unless it was claimed from there as ids.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if self.outbox is not None:
+                if ids is None:
+                    ids = await loop.run_in_executor(self.executor, partial(self.outbox.put, batch, hashes or None, claim=True))
+                if not self.outbox.available:
+                    # Diode is down for this run; the batch waits in the outbox
+                    await loop.run_in_executor(self.executor, self.outbox.retry, ids)
+                    return
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    delay = retry_delay(self.backoff, attempt)
+                    self.logging.warning(f"Retrying batch of {len(batch)} entities in {delay:.1f}s...")
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                error, _ = await loop.run_in_executor(self.executor, ingest_batch, self.client, batch, self.logging)
+                if not error:
+                    self.batches += 1
+                    self.ingested += len(batch)
+                    if ids is not None:
+                        await loop.run_in_executor(self.executor, self.outbox.done, ids)
+                    if hashes and self.state is not None:
+                        await loop.run_in_executor(self.executor, self.state.commit, hashes)
+                    return
+            if ids is not None:
+                self.logging.error(f"Leaving batch of {len(batch)} entities in the outbox after {self.max_retries} retries.")
+                # Parked first, so the released rows are not claimed again by _replay
+                self.outbox.park()
+                await loop.run_in_executor(self.executor, self.outbox.retry, ids)
+            else:
+                self.logging.error(f"Dropping batch of {len(batch)} entities after {self.max_retries} retries.")
+            self.batches += 1
+            self.failed += 1
+        finally:
+            self.semaphore.release()
+
+    def stats(self):
+        return {"batches": self.batches, "ingested": self.ingested, "retries": self.retries, "failed": self.failed}
+
+
+async def _run(si, client, logging, transformer, state, page_size, workers, fetch_concurrency,
+               ingest_concurrency, max_batch_entities, max_retries, queue_size, snapshot, vcenter, scope, cache, outbox,
+               network_index):
+    loop = asyncio.get_running_loop()
+    counts = {"cluster": 0, "vm": 0}
+    errors = []
+    fetch_semaphore = asyncio.Semaphore(max(1, fetch_concurrency))
+    executor = ThreadPoolExecutor(max_workers=max(1, fetch_concurrency) + max(1, ingest_concurrency), thread_name_prefix="async")
+    ingester = AsyncIngester(
+        client, logging, executor, state, ingest_concurrency,
+        max_batch_entities=max_batch_entities, max_retries=max_retries, queue_size=queue_size, outbox=outbox,
+    )
+    consumer = asyncio.create_task(ingester.run())
+    # Converting happens on the event loop thread only, so these need no locking
+    cluster_cache = {}
+    network_index = network_index if network_index is not None else NetworkIndex()
+
+    async def _fetch(func, *args):
+        async with fetch_semaphore:
+            return await loop.run_in_executor(executor, func, *args)
+
+    async def _cluster(cluster):
+        try:
+            record = await loop.run_in_executor(executor, build_cluster_record, cluster, inventory, logging, None, transformer)
+        except Exception as e:
+            # Clusters that cannot be built are skipped, as in the other modes
+            logging.error(f"Error processing cluster {cluster.get('name')}: {e}")
+            return
+        counts["cluster"] += 1
+        try:
+            if snapshot is not None:
+                snapshot.write("cluster", record, vcenter)
+            await ingester.put(cluster_entities(record, cluster_cache, network_index))
+        except Exception as e:
+            logging.error(f"Error converting cluster {cluster.get('name')}: {e}")
+            errors.append(f"convert stage failed: {e}")
+
+    async def _datacenter(datacenter):
+        pages = iter_vm_properties(content, datacenter, inventory, logging, page_size, scope)
+
+        def _next_page():
+            return [props for _, props in islice(pages, page_size)]
+
+        def _build(page):
+            return list(build_vm_records(page, inventory, logging, transformer))
+
+        try:
+            while True:
+                page = await _fetch(_next_page)
+                if not page:
+                    break
+                for record in await loop.run_in_executor(executor, _build, page):
+                    counts["vm"] += 1
+                    if snapshot is not None:
+                        snapshot.write("vm", record, vcenter)
+                    await ingester.put(vm_entities(record, cluster_cache, logging, network_index))
+        except Exception as e:
+            logging.error(f"Error retrieving VMs from datacenter {datacenter.get('name')}: {e}")
+            errors.append(f"fetch stage failed for datacenter {datacenter.get('name')}: {e}")
+        finally:
+            await loop.run_in_executor(executor, pages.close)
+
+    try:
+        inventory = await _fetch(InventorySnapshot.collect, si, logging, page_size, workers, False, scope, cache)
+        content = si.RetrieveContent()
+
+        await asyncio.gather(*(_cluster(cluster) for cluster in inventory.clusters.values()))
+        # VMs reference their clusters, so those are ingested first
+        await ingester.drain()
+
+        await asyncio.gather(*(_datacenter(datacenter) for datacenter in inventory.datacenters.values()))
+    finally:
+        await ingester.close()
+        await consumer
+        executor.shutdown(wait=True)
+
+    if errors:
+        raise RuntimeError("; ".join(errors))
+    stats = ingester.stats()
+    logging.info(
+        f"Async pipeline processed {counts['cluster']} clusters and {counts['vm']} VMs, "
+        f"ingested {stats['ingested']} entities in {stats['batches']} batches ({stats['failed']} failed)."
+    )
+    return counts["cluster"], counts["vm"], stats
+
+
+def run_async_pipeline(si, client, logging, transformer=None, state=None, page_size=DEFAULT_PAGE_SIZE,
+                       workers=DEFAULT_WORKERS, fetch_concurrency=DEFAULT_FETCH_CONCURRENCY,
+                       ingest_concurrency=DEFAULT_INGEST_CONCURRENCY, max_batch_entities=DEFAULT_BATCH_ENTITIES,
+                       max_retries=DEFAULT_MAX_RETRIES, queue_size=DEFAULT_QUEUE_SIZE, snapshot=None, vcenter=None,
+                       scope=None, cache=None, outbox=None, network_index=None):
+    """
+    Fetches, converts and ingests one vCenter on an asyncio event loop. Blocking pyVmomi and
+    Diode calls run on a bounded executor; fetch_concurrency caps simultaneous vCenter calls and
+    ingest_concurrency simultaneous ingest calls. Clusters are built concurrently, then the VMs
+    of all datacenters are paged in concurrently, each page converted as it arrives.
+    With a Scope, only the inventory in scope is fetched; with a PropertyCache, property
+    groups not due for refresh are served from it. With an Outbox, batches are written to it
+    before they are sent, and entities earlier runs left there are sent at the end.
+    network_index tracks the prefixes already sent; pass the same one to the calls of one run.
+    If retrieving or converting fails, what was queued is still ingested and the failures
+    are raised as a RuntimeError afterwards, as in run_pipeline.
+    :return: (number of cluster records, number of VM records, ingest counters)
+    """
+    transformer = transformer or default_transformer()
+    return asyncio.run(_run(
+        si, client, logging, transformer, state, page_size, workers, fetch_concurrency,
+        ingest_concurrency, max_batch_entities, max_retries, queue_size, snapshot, vcenter, scope, cache, outbox,
+        network_index,
+    ))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import gc
+import sys
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import time
+import tracemalloc
+from mock_vcenter import MockVCenter, FakeDiodeClient, generate_inventory
+from vcenter_collector import InventorySnapshot, DEFAULT_PAGE_SIZE, DEFAULT_WORKERS
+from vcenter_fetcher import fetch_cluster_data, fetch_vm_data
+from data_conversion import prepare_data, cluster_entities, vm_entities
+from network_index import NetworkIndex
+from ingest_scheduler import IngestScheduler
+from pipeline import run_pipeline
+from records import ClusterRecord, VMRecord
+from profiling import profiler, write_report
+
+
+def parse_arguments():
+    """
+    Parse benchmark scale and agent tuning options.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the vCenter agent against a synthetic in-process vCenter")
+    parser.add_argument("--datacenters", type=int, default=10, help="Datacenters to generate (default: 10)")
+    parser.add_argument("--hosts", type=int, default=200, help="Hosts to generate (default: 200)")
+    parser.add_argument("--vms", type=int, default=20000, help="VMs to generate (default: 20000)")
+    parser.add_argument("--max-nics", type=int, default=8, help="Maximum NICs per VM (default: 8)")
+    parser.add_argument("--max-disks", type=int, default=8, help="Maximum disks per VM (default: 8)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the inventory (default: 0)")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="Objects per PropertyCollector page")
+    parser.add_argument("--fetch-workers", type=int, default=DEFAULT_WORKERS, help="Parallel datacenter retrievals")
+    parser.add_argument("--ingest-workers", type=int, default=4, help="Ingest batches in flight")
+    parser.add_argument("--ingest-latency", type=float, default=0.0, help="Seconds each fake ingest call takes (default: 0)")
+    parser.add_argument("--pipeline", action="store_true", help="Benchmark the streaming pipeline as one stage")
+    parser.add_argument("--startup", action="store_true", help="Measure import and startup times instead of a sync")
+    parser.add_argument("--repeat", type=int, default=5, help="With --startup, runs per measurement; the median is reported (default: 5)")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip peak memory tracking, which slows the run down")
+    parser.add_argument("--report-file", help="Write the results as JSON to this file")
+    parser.add_argument("--log-level", default="WARNING", help="Logging Level INFO, WARNING, ERROR, DEBUG")
+    return parser.parse_args()
+
+
+class StageTimer:
+    """
+    Measures wall time, vCenter round trips, ingest calls and peak traced memory of each stage.
+    """
+
+    def __init__(self, si, client, track_memory=True):
+        self.si = si
+        self.client = client
+        self.track_memory = track_memory
+        self.stages = []
+
+    def run(self, name, func, items=None):
+        """
+        Runs func as a stage. items returns the number of objects the stage handled from its result.
+        """
+        round_trips = self.si.round_trips
+        calls = self.client.calls
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        count = items(result) if items else None
+        stage = {
+            "stage": name,
+            "seconds": round(seconds, 3),
+            "items": count,
+            "items_per_second": round(count / seconds, 1) if count and seconds else None,
+            "round_trips": self.si.round_trips - round_trips,
+            "ingest_calls": self.client.calls - calls,
+            "peak_mib": round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1) if self.track_memory else None,
+        }
+        self.stages.append(stage)
+        logging.warning(
+            f"{name}: {stage['seconds']}s, {count} items, {stage['round_trips']} round trips, "
+            f"{stage['ingest_calls']} ingest calls, peak {stage['peak_mib']} MiB"
+        )
+        return result
+
+
+# Startup costs measured by --startup, each in a fresh interpreter: (name, command arguments)
+STARTUP_STEPS = [
+    ("import pyVmomi", ["-c", "import pyVmomi"]),
+    ("import Diode SDK", ["-c", "import netboxlabs.diode.sdk"]),
+    ("import yaml", ["-c", "import yaml"]),
+    ("import vcenter_fetcher", ["-c", "import vcenter_fetcher"]),
+    ("import data_conversion", ["-c", "import data_conversion"]),
+    ("load default rules", ["-c", "import vcenter_fetcher; vcenter_fetcher.default_transformer()"]),
+    ("diode-vcenter.py --help", ["diode-vcenter.py", "--help"]),
+]
+
+
+def startup_times(repeat):
+    """
+    Times each startup step in a fresh interpreter, minus the startup of a bare interpreter.
+    :return: list of dicts with the step name and its median seconds
+    """
+    def _median(arguments):
+        runs = []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *arguments], check=True, stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+        return statistics.median(runs)
+
+    baseline = _median(["-c", "pass"])
+    logging.warning(f"bare interpreter: {baseline:.3f}s")
+    steps = [{"step": "bare interpreter", "seconds": round(baseline, 3)}]
+    for name, arguments in STARTUP_STEPS:
+        seconds = _median(arguments) - baseline
+        logging.warning(f"{name}: {seconds:+.3f}s")
+        steps.append({"step": name, "seconds": round(seconds, 3)})
+    return steps
+
+
+def record_memory(records, record_type):
+    """
+    Compares the traced memory held by records loaded from JSON as plain nested dicts, as records
+    were kept before, with the same data loaded as slotted records with interned strings.
+    """
+    payload = json.dumps([record.to_dict() for record in records])
+
+    def _held(load):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        held = load()
+        gc.collect()
+        return held, tracemalloc.get_traced_memory()[0] - before
+
+    dicts, dict_bytes = _held(lambda: json.loads(payload))
+    slotted, record_bytes = _held(lambda: [record_type.from_dict(data) for data in json.loads(payload)])
+    result = {
+        "records": len(slotted),
+        "dict_mib": round(dict_bytes / 2 ** 20, 1),
+        "record_mib": round(record_bytes / 2 ** 20, 1),
+        "saved_percent": round(100 * (1 - record_bytes / dict_bytes), 1) if dict_bytes else None,
+    }
+    logging.warning(
+        f"{record_type.__name__}: {result['dict_mib']} MiB as dicts, {result['record_mib']} MiB as records "
+        f"({result['saved_percent']}% saved)"
+    )
+    del dicts
+    return result
+
+
+# Entity fields holding a reference to a parent entity, with the parent's entity type
+PARENT_FIELDS = {
+    "virtual_machine": [("cluster", "cluster")],
+    "interface": [("device", "device")],
+    "vminterface": [("virtual_machine", "virtual_machine")],
+    "vm_interface": [("virtual_machine", "virtual_machine")],
+    "virtual_disk": [("virtual_machine", "virtual_machine")],
+}
+
+
+def payload_bytes(clusters, vms, batches):
+    """
+    Compares the serialized size of the entities built from the records, whose parents are
+    referenced by key, with the size they had when every entity embedded full copies of its
+    parents and host Devices were only sent inside their interfaces.
+    :param batches: ingest calls the run took, to report sizes per batch
+    """
+    sizes = {"entities": 0, "bytes": 0, "embedded_bytes": 0}
+    # Full parent messages by entity type and name; VM children follow their VM directly
+    parents = {}
+
+    def _count(entities):
+        for entity in entities:
+            kind = entity.WhichOneof("entity")
+            sizes["entities"] += 1
+            sizes["bytes"] += entity.ByteSize()
+            embedded = type(entity)()
+            embedded.CopyFrom(entity)
+            message = getattr(embedded, kind)
+            for field, parent_kind in PARENT_FIELDS.get(kind, []):
+                full = parents.get((parent_kind, getattr(message, field).name)) if message.HasField(field) else None
+                if full is not None:
+                    getattr(message, field).CopyFrom(full)
+            if kind in ("cluster", "device", "virtual_machine"):
+                parents[(kind, message.name)] = message
+            if kind != "device":
+                sizes["embedded_bytes"] += embedded.ByteSize()
+
+    cluster_cache = {}
+    network_index = NetworkIndex()
+    for cluster in clusters:
+        _count(cluster_entities(cluster, cluster_cache, network_index))
+    for vm in vms:
+        _count(vm_entities(vm, cluster_cache, logging, network_index))
+        parents.pop(("virtual_machine", vm.name), None)
+
+    batches = max(1, batches)
+    result = {
+        **sizes,
+        "bytes_per_batch": round(sizes["bytes"] / batches),
+        "embedded_bytes_per_batch": round(sizes["embedded_bytes"] / batches),
+        "saved_percent": round(100 * (1 - sizes["bytes"] / sizes["embedded_bytes"]), 1) if sizes["embedded_bytes"] else None,
+    }
+    logging.warning(
+        f"payload: {result['bytes_per_batch']} bytes per batch with references, "
+        f"{result['embedded_bytes_per_batch']} with embedded parents ({result['saved_percent']}% saved)"
+    )
+    return result
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.startup:
+        report = {"startup": startup_times(args.repeat)}
+        if args.report_file:
+            write_report(args.report_file, report, logging)
+        else:
+            print(json.dumps(report, indent=2))
+        return
+
+    logging.warning(f"Generating {args.datacenters} datacenters, {args.hosts} hosts and {args.vms} VMs...")
+    objects = generate_inventory(args.datacenters, args.hosts, args.vms, args.max_nics, args.max_disks, seed=args.seed)
+    si = MockVCenter(objects)
+    client = FakeDiodeClient(args.ingest_latency)
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    timer = StageTimer(si, client, not args.no_tracemalloc)
+    scheduler = IngestScheduler(client, logging, max_in_flight=args.ingest_workers)
+
+    if args.pipeline:
+        timer.run(
+            "pipeline",
+            lambda: run_pipeline(si, client, logging, page_size=args.page_size, workers=args.fetch_workers, scheduler=scheduler),
+            items=sum,
+        )
+    else:
+        inventory = timer.run(
+            "fetch inventory",
+            lambda: InventorySnapshot.collect(si, logging, args.page_size, args.fetch_workers),
+            items=lambda snapshot: len(snapshot.vms) + len(snapshot.hosts) + len(snapshot.clusters),
+        )
+        clusters = timer.run("fetch clusters", lambda: fetch_cluster_data(si, logging, inventory), items=len)
+        vms = timer.run("fetch VMs", lambda: fetch_vm_data(si, logging, inventory), items=len)
+        timer.run(
+            "convert and ingest",
+            lambda: prepare_data(client, clusters, vms, logging, scheduler=scheduler),
+            items=lambda _: len(clusters) + len(vms),
+        )
+    scheduler.close()
+
+    payload = {}
+    if not args.pipeline:
+        payload = payload_bytes(clusters, vms, client.calls)
+
+    memory = {}
+    if not args.pipeline and not args.no_tracemalloc:
+        memory = {"clusters": record_memory(clusters, ClusterRecord), "vms": record_memory(vms, VMRecord)}
+
+    report = {
+        "scale": {
+            "datacenters": args.datacenters,
+            "hosts": args.hosts,
+            "vms": args.vms,
+            "max_nics": args.max_nics,
+            "max_disks": args.max_disks,
+        },
+        "stages": timer.stages,
+        "ingest": {"calls": client.calls, "entities": client.entities, "bytes": client.bytes, **scheduler.stats()},
+        "payload": payload,
+        "phases": profiler.report(),
+        "record_memory": memory,
+    }
+    if args.report_file:
+        write_report(args.report_file, report, logging)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
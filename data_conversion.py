@@ -1,192 +1,321 @@
 import re
+import multiprocessing
+import logging as worker_logging
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from netboxlabs.diode.sdk.ingester import Device, VirtualMachine, Cluster, Interface, VMInterface, VirtualDisk, IPAddress, Prefix, Entity
-import ipaddress
+from network_index import NetworkIndex, parse_interface
+from ingest_scheduler import IngestScheduler
+from profiling import profiler
+
+# VM records handed to a conversion worker at a time.
+CONVERT_CHUNK_SIZE = 200
+
+# Tags of every entity the agent creates; references to parent entities carry none.
+TAGS = ["Diode-vCenter-Agent", "Diode"]
+
+# Status of clusters, hosts and VMs that were removed from vCenter.
+REMOVED_STATUS = "decommissioning"
+
+# Conversion workers are started from a clean process rather than forked: the parent has
+# ingest threads and SQLite connections running. _init_worker gets all the state they need.
+_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Per-process state of conversion workers, set up by _init_worker.
+_worker_cluster_cache = None
+_worker_network_index = None
 
 def get_network_addr(ip):
-    try:
-        if "." in ip:  # IPv4
-            network = ipaddress.IPv4Network(f"{ip}", strict=False)
-            return f"{network.network_address}/{network.prefixlen}"
-        else:  # IPv6
-            network = ipaddress.IPv6Network(f"{ip}", strict=False)
-            return f"{network.network_address}/{network.prefixlen}"
-    except Exception as e:
-        print(f"Error calculating network address: {e}")
-        return None     
-
-def prepare_data(client,data,vm_data,logging):
     """
-    Transforms cluster and host data into Diode-compatible entities.
+    Returns the network of an address with prefix length in CIDR notation, or None.
+    """
+    interface = parse_interface(ip)
+    return str(interface.network) if interface else None
+
+def cluster_reference(name):
+    """
+    Returns a Cluster carrying only its natural key, to link entities to a cluster sent on its own.
+    """
+    return Cluster(name=name)
+
+def device_reference(name, site):
+    """
+    Returns a Device carrying only its natural key, the name within its site.
+    """
+    return Device(name=name, site=site)
+
+def vm_reference(name, cluster):
+    """
+    Returns a VirtualMachine carrying only its natural key, the name within its cluster.
+    :param cluster: Cluster reference or None
     """
+    return VirtualMachine(name=name, cluster=cluster)
+
+def removed_entities(clusters=(), hosts=(), vms=()):
+    """
+    Builds entities marking clusters, hosts and VMs removed from vCenter as decommissioning.
+    Each carries only its natural key and the status.
+    :param clusters: cluster names
+    :param hosts: (host name, site) pairs
+    :param vms: (VM name, cluster name) pairs
+    """
+    entities = [Entity(cluster=Cluster(name=name, status=REMOVED_STATUS)) for name in clusters]
+    entities += [Entity(device=Device(name=name, site=site, status=REMOVED_STATUS)) for name, site in hosts]
+    entities += [
+        Entity(virtual_machine=VirtualMachine(
+            name=name, cluster=cluster_reference(cluster) if cluster else None, status=REMOVED_STATUS,
+        ))
+        for name, cluster in vms
+    ]
+    return entities
+
+@profiler.timed("convert_cluster")
+def cluster_entities(cluster, cluster_cache, network_index=None):
+    """
+    Builds the Cluster entity of a cluster record and the Device, Interface, IPAddress
+    and Prefix entities of its hosts. Each Device is sent once, and its interfaces refer to
+    it by key. A reference to the Cluster is added to cluster_cache.
+    With a NetworkIndex, only prefixes not emitted earlier in the run are included.
+    """
+    network_index = network_index or NetworkIndex()
     entities = []
-    cluster_cache={}
-    host_cache={}
-
-    for cluster in data:
-        
-        cluster_entity = Cluster(
-            name=cluster['name'],
-            group=cluster['group'],
-            type="VMWare",
-            site=cluster['site'],
-            status='active',
-            tags=["Diode-vCenter-Agent",'Diode'],
+    cluster_entity = Cluster(
+        name=cluster.name,
+        group=cluster.group,
+        type="VMWare",
+        site=cluster.site,
+        status='active',
+        tags=TAGS,
+
+    )
+    cluster_cache[cluster.name]=cluster_reference(cluster.name)
+    entities.append(Entity(cluster=cluster_entity))
+
+    for host in cluster.hosts:
 
+        #TODO: link to cluster when diode is updated to support
+        # Create Device entity for each host
+        device_data = Device(
+            name=host.name,
+            site=cluster.site,
+            device_type=host.model,
+            manufacturer=host.vendor,
+            serial=host.serial_number,
+            #tenant=host.tenant,
+            role="Hypervisor Host",  # Replace with specific role if applicable
+            status="active",
+            tags=TAGS,
+
+            #interfaces=interfaces,  # Host NICs as interfaces
         )
-        cluster_cache[cluster['name']]=cluster_entity
-        entities.append(Entity(cluster=cluster_entity))
-                    
-        for host in cluster["hosts"]:
-           
-            #TODO: link to cluster when diode is updated to support
-            # Create Device entity for each host
-            device_data = Device(
-                name=host["name"],
-                site=cluster["site"],
-                device_type=host["model"],
-                manufacturer=host["vendor"],
-                serial=host["serial_number"],
-                #tenant=host['tenant'],
-                role="Hypervisor Host",  # Replace with specific role if applicable
-                status="active",
-                tags=["Diode-vCenter-Agent",'Diode'],
-
-                #interfaces=interfaces,  # Host NICs as interfaces
-            )
-            host_cache[host['name']]=device_data
-
-            for nic in host["nics"]:
-                interface_data = Interface(
-                    name=nic["name"], 
-                    device=device_data, 
-                    description=f"{cluster['name']}/{host['name']} {nic['name']} {nic['portgroup_name']}",
-                    mac_address=nic["mac"],
-                    type=nic["type"],
-                    tags=["Diode-vCenter-Agent",'Diode'],
-
-                )       
-                entities.append(Entity(interface=interface_data))
-                for ip in nic['ip_addresses']:
-                    ip_data = IPAddress(
-                        address=ip,
-                        interface=nic["name"],
-                        description=f"{cluster['name']}/{host['name']} {nic['name']} {nic['portgroup_name']}",
-                        tags=["Diode-vCenter-Agent",'Diode'],
+        entities.append(Entity(device=device_data))
+        device_ref = device_reference(host.name, cluster.site)
+
+        for nic in host.nics:
+            interface_data = Interface(
+                name=nic.name, 
+                device=device_ref,
+                description=f"{cluster.name}/{host.name} {nic.name} {nic.portgroup_name}",
+                mac_address=nic.mac,
+                type=nic.type,
+                tags=TAGS,
+
+            )       
+            entities.append(Entity(interface=interface_data))
+            for ip in nic.ip_addresses:
+                ip_data = IPAddress(
+                    address=ip,
+                    interface=nic.name,
+                    description=f"{cluster.name}/{host.name} {nic.name} {nic.portgroup_name}",
+                    tags=TAGS,
+
+                )
+                entities.append(Entity(ip_address=ip_data))
+                prefix = network_index.new_prefix(ip)
+                if prefix is None:
+                    continue
+                prefix_entity = Prefix(
+                    prefix=prefix,
+                    site = cluster.site,
+                    description = f"Cluster {cluster.name} {nic.portgroup_name} VLAN ({cluster.site})",
+                    status='active',
+                    tags=TAGS,
+                )
+                entities.append(Entity(prefix=prefix_entity))
+    return entities
+
+@profiler.timed("convert_vm")
+def vm_entities(vm, cluster_cache, logging, network_index=None):
+    """
+    Builds the VirtualMachine entity of a VM record and its VMInterface, IPAddress,
+    Prefix and VirtualDisk entities, linking the VM to its cluster through the references in
+    cluster_cache. Interfaces and disks refer to the VM by key.
+    With a NetworkIndex, only prefixes not emitted earlier in the run are included.
+    """
+    network_index = network_index or NetworkIndex()
+    entities = []
+    try:
+        # Create VirtualMachine entity for each VM
+        virtual_machine = VirtualMachine(
+            name=vm.name,
+            cluster=cluster_cache.get(vm.cluster, None),
+            platform=vm.platform,
+            vcpus=vm.vcpus,
+            #memory=vm.memory,
+            #tenant=vm.tenant,
+            site=vm.site,
+            role=vm.role,
+            status=vm.status,
+            description=f"{vm.cluster}: {vm.role} VM for {vm.tenant}",
+            tags=TAGS,
+        )
+        entities.append(Entity(virtual_machine=virtual_machine))
+        vm_ref = vm_reference(vm.name, cluster_cache.get(vm.cluster))
+
+        for nic in vm.interfaces:
+            try:
+                interface_data = VMInterface(
+                    name=nic.name,
+                    description=f"{vm.name}: {nic.name}",                
+                    virtual_machine=vm_ref,
+                    mac_address=nic.mac,
+                    enabled=nic.enabled,
+                    tags=TAGS,
+                )
+                entities.append(Entity(vminterface=interface_data))
 
+                #TODO: link to vm_interface when diode is updated to support
+                for address in nic.ipv4_addresses + nic.ipv6_addresses:
+                    # VM IPs are keyed by the bare address; the prefix length only places the network
+                    ip_data = IPAddress(
+                        address=address.split("/")[0],
+                        description=f"{vm.name} {nic.name}",
+                        status="active",
+                        tags=TAGS,
                     )
                     entities.append(Entity(ip_address=ip_data))
-                    prefix_entity = Prefix(
-                        prefix=get_network_addr(ip),
-                        site = cluster['site'],
-                        description = f"Cluster {cluster['name']} {nic['portgroup_name']} VLAN ({cluster['site']})",
-                        status='active',
-                        tags=["Diode-vCenter-Agent","Diode"],
-                    )
-                    entities.append(Entity(prefix=prefix_entity))
-                    #TODO: Create prefixes and VLANs for networks
-
-        logging.info("Ingesting Cluster/Host data into Diode...")
-        logging.debug(f"Total entities being sent: {entities}")
-        try:
-            response = client.ingest(entities=entities)
-            if response.errors:
-                logging.error(f"Diode Ingestion Errors: {response.errors}")
-            else:
-                logging.info(f"Successfully ingested {len(entities)}.")
-        except Exception as e:
-            logging.error(f"Error during ingestion: {e}")
-        entities=[]
-                
-                
-    for vm in vm_data:
-        
-        try:
-            # Create VirtualMachine entity for each VM
-            virtual_machine = VirtualMachine(
-                name=vm["name"],
-                cluster=cluster_cache.get(vm['cluster'], None),
-                platform=vm["platform"],
-                vcpus=vm["vcpus"],
-                #memory=vm["memory"],
-                #tenant=vm['tenant'],
-                site=vm["site"],
-                role=vm["role"],
-                status=vm["status"],
-                description=f"{vm["cluster"]}: {vm["role"]} VM for {vm["tenant"]}",
-                tags=["Diode-vCenter-Agent",'Diode'],
-            )
-            entities.append(Entity(virtual_machine=virtual_machine))
-            
-            for nic in vm["interfaces"]:
-                try:
-                    interface_data = VMInterface(
-                        name=nic["name"],
-                        description=f"{vm["name"]}: {nic["name"]}",                
-                        virtual_machine=virtual_machine,
-                        mac_address=nic["mac"],
-                        enabled=nic["enabled"],
-                        tags=["Diode-vCenter-Agent",'Diode'],
-                    )
-                    entities.append(Entity(vminterface=interface_data))
-                    
-                    #TODO: Create prefixes and VLANs for networks
-                    #TODO: link to vm_interface when diode is updated to support
-                    if nic.get("ipv4_address"):
-                        ip_data = IPAddress(
-                            address=nic["ipv4_address"]["address"],
-                            description=f"{vm['name']} {nic['name']}",
-                            status="active",
-                            tags=["Diode-vCenter-Agent",'Diode'],
+                    prefix = network_index.new_prefix(address)
+                    if prefix is not None:
+                        prefix_entity = Prefix(
+                            prefix=prefix,
+                            site=vm.site,
+                            description=f"Cluster {vm.cluster} VM network ({vm.site})",
+                            status='active',
+                            tags=TAGS,
                         )
-                        entities.append(Entity(ip_address=ip_data))
-                    #TODO: link to vm_interface when diode is updated to support
-                    if nic.get("ipv6_address"):
-                        ip_data = IPAddress(
-                            address=nic["ipv6_address"]["address"],
-                            description=f"{vm['name']} {nic['name']}",
-                            status="active",
-                            tags=["Diode-vCenter-Agent",'Diode'],
+                        entities.append(Entity(prefix=prefix_entity))
+            except AttributeError as e:
+                logging.error(f"Error processing NIC for VM {vm.name}: {e}")
+                continue
 
-                        )
-                        entities.append(Entity(ip_address=ip_data))
-                except KeyError as e:
-                    logging.error(f"Error processing NIC for VM {vm['name']}: Missing key {e}")
-                    continue
+        for disk in vm.disks:
+            try:
+                disk_data = VirtualDisk(
+                    name=disk.name,
+                    virtual_machine=vm_ref,
+                    size=disk.capacity,
+                    description=f"{disk.datastore} "
+                                f"{disk.vmdk} "
+                                f"{disk.thin_thick} "
+                                f"{disk.disk_type}",
+                    tags=TAGS,
+                )
+                entities.append(Entity(virtual_disk=disk_data))
+            except AttributeError as e:
+                logging.error(f"Error processing disk for VM {vm.name}: {e}")
+                continue
+    except AttributeError as e:
+        logging.error(f"Error processing VM: {e}")
+    return entities
 
-            for disk in vm["disks"]:
-                try:
-                    disk_data = VirtualDisk(
-                        name=disk["name"],
-                        virtual_machine=virtual_machine,
-                        size=disk["capacity"],
-                        description=f"{disk.get('datastore', 'Unknown')} "
-                                    f"{disk.get('vmdk', 'Unknown')} "
-                                    f"{disk.get('thin_thick', 'Unknown')} "
-                                    f"{disk.get('disk_type', 'Unknown')}",
-                        tags=["Diode-vCenter-Agent",'Diode'],
-                    )
-                    entities.append(Entity(virtual_disk=disk_data))
-                except KeyError as e:
-                    logging.error(f"Error processing disk for VM {vm['name']}: Missing key {e}")
-                    continue
-        except KeyError as e:
-            logging.error(f"Error processing VM: Missing key {e}")
-            continue
-        
-        # Ingest data into Diode
-        if len(entities) > 1000:
-            logging.info(f"Ingesting {len(entities)} entity batch device data into Diode...")
-            response = client.ingest(entities=entities)# + interface_entities)
-            if response.errors:
-                logging.error(f"Errors during ingestion: {response.errors}")
-            else:
-                logging.info("Data ingested successfully into Diode.")
-            entities = []
-    
-    logging.info(f"Ingesting {len(entities)} entity batch device data into Diode...")
-    response = client.ingest(entities=entities)# + interface_entities)
-    if response.errors:
-        logging.error(f"Errors during ingestion: {response.errors}")
-    else:
-        logging.debug("Data ingested successfully into Diode.")
-    entities = []
+def _message_type(wrapper, **kwargs):
+    """
+    Returns the protobuf message class an SDK wrapper builds; protobuf messages are passed
+    between processes as bytes, as the generated classes cannot always be pickled by reference.
+    """
+    return type(wrapper(**kwargs))
+
+def _init_worker(serialized_clusters):
+    global _worker_cluster_cache, _worker_network_index
+    cluster_type = _message_type(Cluster, name="")
+    _worker_cluster_cache = {name: cluster_type.FromString(data) for name, data in serialized_clusters.items()}
+    _worker_network_index = NetworkIndex()
+
+def _convert_chunk(vms):
+    """
+    Builds the serialized entities of a chunk of VM records in a worker process, each paired
+    with its prefix, or None if it is not a Prefix, so repeats can be dropped unparsed.
+    """
+    return [
+        (entity.SerializeToString(), entity.prefix.prefix if entity.WhichOneof("entity") == "prefix" else None)
+        for vm in vms
+        for entity in vm_entities(vm, _worker_cluster_cache, worker_logging, _worker_network_index)
+    ]
+
+def convert_vms(vm_data, cluster_cache, logging, network_index, processes=0, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+    Yields lists of entities for VM records, in input order.
+    With more than one process, chunks of VMs are converted on a process pool that starts
+    with a copy of cluster_cache, so VMs still link to the Cluster entities built here.
+    Workers only dedupe prefixes among their own VMs; the rest are dropped against network_index.
+    """
+    if processes <= 1:
+        for vm in vm_data:
+            yield vm_entities(vm, cluster_cache, logging, network_index)
+        return
+
+    vms = iter(vm_data)
+    entity_type = _message_type(Entity)
+    serialized_clusters = {name: cluster.SerializeToString() for name, cluster in cluster_cache.items()}
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context(_START_METHOD),
+        initializer=_init_worker,
+        initargs=(serialized_clusters,),
+    ) as pool:
+        # Keep a couple of chunks per worker queued so memory stays bounded
+        futures = []
+        while True:
+            while len(futures) < processes * 2:
+                chunk = list(islice(vms, chunk_size))
+                if not chunk:
+                    break
+                futures.append(pool.submit(_convert_chunk, chunk))
+            if not futures:
+                break
+            yield [
+                entity_type.FromString(data) for data, prefix in futures.pop(0).result()
+                if prefix is None or network_index.new_prefix(prefix)
+            ]
+
+def prepare_data(client,data,vm_data,logging,cluster_cache=None,state=None,scheduler=None,network_index=None,processes=0):
+    """
+    Transforms cluster and host data into Diode-compatible entities.
+    cluster_cache maps cluster names to Cluster entities for VMs whose cluster is not in data;
+    clusters in data are added to it. With a state store, only changed entities are sent.
+    Entities are sent through scheduler, or a scheduler of this call's own if none is given;
+    clusters are fully ingested before VMs, and everything is ingested on return.
+    network_index tracks the prefixes already sent; pass the same one to calls of one run.
+    With processes > 1, VM entities are built on a process pool of that size.
+    """
+    if cluster_cache is None:
+        cluster_cache={}
+    if network_index is None:
+        network_index = NetworkIndex()
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = IngestScheduler(client, logging, state)
+
+    try:
+        if data:
+            logging.info("Ingesting Cluster/Host data into Diode...")
+        for cluster in data:
+            scheduler.add(cluster_entities(cluster, cluster_cache, network_index))
+        scheduler.flush()
+
+        for entities in convert_vms(vm_data, cluster_cache, logging, network_index, processes):
+            scheduler.add(entities)
+        scheduler.flush()
+    finally:
+        if own_scheduler:
+            scheduler.close()
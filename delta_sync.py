@@ -0,0 +1,294 @@
+import time
+from pyVmomi import vim
+from vcenter_collector import InventorySnapshot, InventoryWatcher
+from vcenter_fetcher import build_cluster_record, build_vm_record, default_transformer
+from data_conversion import prepare_data, removed_entities, REMOVED_STATUS
+from network_index import NetworkIndex
+
+# Seconds to wait before re-subscribing after the watcher fails.
+RETRY_DELAY = 30
+
+
+def _vms_on_hosts(inventory, host_ids):
+    """
+    Returns the ids of VMs whose runtime host is one of host_ids.
+    """
+    return {
+        moid for moid, vm in inventory.vms.items()
+        if vm.get("runtime.host") is not None and vm["runtime.host"]._moId in host_ids
+    }
+
+
+def _vms_on_datastore(inventory, datastore_id):
+    """
+    Returns the ids of VMs with a disk on the datastore.
+    """
+    vm_ids = set()
+    for moid, vm in inventory.vms.items():
+        for device in vm.get("config.hardware.device", []):
+            datastore = getattr(getattr(device, "backing", None), "datastore", None)
+            if datastore is not None and datastore._moId == datastore_id:
+                vm_ids.add(moid)
+                break
+    return vm_ids
+
+
+def _datacenter_name(inventory, ref):
+    """
+    Returns the name of the datacenter an object reference is in.
+    """
+    while ref is not None:
+        if isinstance(ref, vim.Datacenter):
+            return inventory.name_of(ref)
+        ref = inventory.parent_of(ref)
+    return None
+
+
+def _cluster_in_scope(inventory, cluster, scope):
+    if scope is None:
+        return True
+    return (
+        scope.datacenter_selected(_datacenter_name(inventory, cluster.get("parent")))
+        and scope.cluster_selected(cluster.get("name"))
+    )
+
+
+def _vm_in_scope(inventory, vm, scope, cluster):
+    if scope is None:
+        return True
+    # VMs without a folder are placed by their cluster
+    parent = vm.get("parent") or (cluster.get("parent") if cluster else None)
+    if not scope.datacenter_selected(_datacenter_name(inventory, parent)):
+        return False
+    if scope.filters("clusters") and not scope.cluster_selected(cluster.get("name") if cluster else None):
+        return False
+    return scope.vm_selected(vm.get("name"), inventory.path_of(vm.get("parent")))
+
+
+def _host_cluster(inventory, host, departed):
+    """
+    Returns the property dict of a host's cluster, which may have been removed with it.
+    """
+    parent = host.get("parent") if host else None
+    if parent is None:
+        return None
+    return inventory.clusters.get(parent._moId) or departed.get(parent._moId)
+
+
+def _vm_cluster(inventory, vm, departed=None):
+    """
+    Returns the property dict of the cluster of a VM's host.
+    """
+    departed = departed or {}
+    host = vm.get("runtime.host")
+    if host is None:
+        return None
+    return _host_cluster(inventory, inventory.hosts.get(host._moId) or departed.get(host._moId), departed)
+
+
+def affected_records(inventory, changes, logging, transformer=None, scope=None):
+    """
+    Rebuilds only the cluster and VM records touched by a set of changes.
+    Changed hosts are emitted within a record of their cluster holding just those hosts.
+    Renaming or moving a host or cluster also re-emits the VMs that carry its name, and
+    renaming or moving a folder or datacenter re-emits the clusters whose group it names.
+    Removed objects are left to removed_records. With a Scope, records out of scope are
+    not built.
+    :param changes: dict returned by InventorySnapshot.apply_update_set
+    :return: (cluster records, VM records)
+    """
+    transformer = transformer or default_transformer()
+    cluster_hosts = {}  # cluster id -> host ids to emit, None for all hosts
+    vm_ids = set()
+
+    for moid, (kind, changed) in changes.items():
+        if kind == "leave":
+            continue
+        if moid in inventory.clusters:
+            cluster_hosts[moid] = None
+            if "name" in changed:
+                host_ids = {ref._moId for ref in inventory.clusters[moid].get("host", [])}
+                vm_ids |= _vms_on_hosts(inventory, host_ids)
+        elif moid in inventory.hosts:
+            parent = inventory.hosts[moid].get("parent")
+            if parent is not None and parent._moId in inventory.clusters:
+                if cluster_hosts.get(parent._moId, set()) is not None:
+                    cluster_hosts.setdefault(parent._moId, set()).add(moid)
+            if changed & {"name", "parent"}:
+                vm_ids |= _vms_on_hosts(inventory, {moid})
+        elif moid in inventory.vms:
+            vm_ids.add(moid)
+        elif moid in inventory.datastores and "name" in changed:
+            vm_ids |= _vms_on_datastore(inventory, moid)
+        elif (moid in inventory.switches or moid in inventory.portgroups) and "name" in changed:
+            # Host vmkernel NICs carry switch and portgroup names; renames are rare, so rebuild every host
+            cluster_hosts.update((cluster_id, None) for cluster_id in inventory.clusters)
+        elif moid in inventory.entities and changed & {"name", "parent"}:
+            # A cluster's group is the name of the folder or datacenter above its host folder
+            for cluster_id, cluster in inventory.clusters.items():
+                group = inventory.parent_of(cluster.get("parent"))
+                if group is not None and group._moId == moid:
+                    cluster_hosts[cluster_id] = None
+
+    clusters = []
+    for cluster_id, host_ids in cluster_hosts.items():
+        cluster = inventory.clusters[cluster_id]
+        if not _cluster_in_scope(inventory, cluster, scope):
+            continue
+        try:
+            clusters.append(build_cluster_record(cluster, inventory, logging, host_ids, transformer))
+        except Exception as e:
+            logging.error(f"Error processing cluster {cluster.get('name')}: {e}")
+
+    vms = []
+    for vm_id in vm_ids:
+        vm = inventory.vms[vm_id]
+        vm_name = vm.get("name")
+        if transformer.should_skip_vm(vm_name) or not _vm_in_scope(inventory, vm, scope, _vm_cluster(inventory, vm)):
+            continue
+        try:
+            vms.append(build_vm_record(vm, inventory, logging, transformer))
+        except Exception as e:
+            logging.error(f"Error processing VM {vm_name}: {e}")
+    return clusters, vms
+
+
+def all_records(inventory, logging, transformer=None, scope=None):
+    """
+    Builds the records of every cluster and VM in the snapshot that is in scope.
+    :return: (cluster records, VM records)
+    """
+    changes = {moid: ("enter", set()) for moid in (*inventory.clusters, *inventory.vms)}
+    return affected_records(inventory, changes, logging, transformer, scope)
+
+
+def removed_records(inventory, departed, logging, transformer=None, scope=None):
+    """
+    Returns the entities marking removed clusters, hosts and VMs as decommissioning.
+    Objects are identified by their last known properties, as their names are all the
+    entity keys need; objects out of scope or skipped are left out.
+    :param departed: dict returned by InventorySnapshot.pop_departed
+    :return: list of entities
+    """
+    transformer = transformer or default_transformer()
+    clusters, hosts, vms = [], [], []
+    for props in departed.values():
+        ref = props.get("obj")
+        name = props.get("name")
+        if isinstance(ref, vim.VirtualMachine):
+            cluster = _vm_cluster(inventory, props, departed)
+            if transformer.should_skip_vm(name) or not _vm_in_scope(inventory, props, scope, cluster):
+                continue
+            vms.append((name, cluster.get("name") if cluster else None))
+        elif isinstance(ref, vim.HostSystem):
+            cluster = _host_cluster(inventory, props, departed)
+            if cluster is None or not _cluster_in_scope(inventory, cluster, scope):
+                continue
+            hosts.append((transformer.clean_name(name), transformer.host_to_site(cluster.get("name"))))
+        elif isinstance(ref, vim.ComputeResource):
+            if _cluster_in_scope(inventory, props, scope):
+                clusters.append(name)
+    for kind, removed in (("clusters", clusters), ("hosts", hosts), ("VMs", vms)):
+        if removed:
+            logging.info(f"{len(removed)} {kind} were removed from vCenter, marking them {REMOVED_STATUS}.")
+    return removed_entities(clusters, hosts, vms)
+
+
+def _merge_changes(inventory, update_sets):
+    """
+    Applies update sets to the snapshot, merging the changes they report per object.
+    """
+    changes = {}
+    for update_set in update_sets:
+        for moid, (kind, changed) in inventory.apply_update_set(update_set).items():
+            previous_kind, previous = changes.get(moid, (kind, set()))
+            changes[moid] = (kind if kind == "leave" else previous_kind, previous | changed)
+    return changes
+
+
+def run_delta_sync(si, client, logging, max_wait_seconds=60, state=None, transformer=None, scheduler=None,
+                   full_sync_interval=0, scope=None):
+    """
+    Runs a full sync, then ingests only the records affected by each vCenter change.
+    The initial WaitForUpdatesEx result carries every watched property, so it doubles
+    as the inventory snapshot for the full sync. Runs until interrupted; when subscribing
+    or waiting fails, it re-subscribes after RETRY_DELAY seconds.
+    Clusters, hosts and VMs removed from vCenter while subscribed are marked as
+    decommissioning. With a Scope, only the clusters and VMs in scope are ingested.
+    With a state store, unchanged entities are not resent. Every full_sync_interval
+    seconds (0 to never) all records are rebuilt and resent; the schedule is kept per
+    call, so the daemons of other vCenters sharing the store are not affected.
+    Rule files are checked for changes after each wait; when the rules are reloaded,
+    every record is rebuilt from the in-memory inventory and ingested again.
+    """
+    from ingest_scheduler import IngestScheduler
+
+    transformer = transformer or default_transformer()
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = IngestScheduler(client, logging, state)
+    cluster_cache = {}
+    # The first full sync follows the state store's decision for the run
+    last_full_sync = time.monotonic()
+    try:
+        while True:
+            # Prefixes are resent after each (re)subscription's full sync
+            network_index = NetworkIndex()
+            watcher = None
+            try:
+                logging.info("Subscribing to vCenter inventory changes...")
+                # Subscribing calls vCenter, which may still be down when re-subscribing
+                watcher = InventoryWatcher(si, logging, max_wait_seconds)
+                inventory = InventorySnapshot()
+                _merge_changes(inventory, watcher.wait())
+
+                generation = transformer.generation
+                cluster_data, vm_data = all_records(inventory, logging, transformer, scope)
+                logging.info(f"Built {len(cluster_data)} clusters and {len(vm_data)} VMs.")
+                prepare_data(client, cluster_data, vm_data, logging, cluster_cache, state, scheduler, network_index)
+                logging.info("Full sync complete, waiting for changes...")
+
+                while True:
+                    changes = _merge_changes(inventory, watcher.wait())
+                    transformer.reload_if_changed()
+                    removed = removed_records(inventory, inventory.pop_departed(), logging, transformer, scope)
+                    if removed:
+                        scheduler.add(removed)
+                        scheduler.flush()
+                    full_sync = (
+                        state is not None and full_sync_interval > 0
+                        and time.monotonic() - last_full_sync >= full_sync_interval
+                    )
+                    if transformer.generation != generation or full_sync:
+                        # The rebuild covers this wait's changes too, as they are already applied to the snapshot
+                        if transformer.generation != generation:
+                            logging.info("Rules changed, rebuilding all records...")
+                        if full_sync:
+                            logging.info("Full sync due, rebuilding and resending all records...")
+                            last_full_sync = time.monotonic()
+                        generation = transformer.generation
+                        network_index = NetworkIndex()
+                        cluster_data, vm_data = all_records(inventory, logging, transformer, scope)
+                        scheduler.full_sync = True if full_sync else None
+                        try:
+                            prepare_data(client, cluster_data, vm_data, logging, cluster_cache, state, scheduler, network_index)
+                        finally:
+                            scheduler.full_sync = None
+                        continue
+                    if not changes:
+                        continue
+                    clusters, vms = affected_records(inventory, changes, logging, transformer, scope)
+                    logging.info(
+                        f"{len(changes)} objects changed, ingesting {len(clusters)} clusters and {len(vms)} VMs."
+                    )
+                    if clusters or vms:
+                        prepare_data(client, clusters, vms, logging, cluster_cache, state, scheduler, network_index)
+            except Exception as e:
+                logging.error(f"Delta sync failed: {e}; re-subscribing in {RETRY_DELAY} seconds.")
+                time.sleep(RETRY_DELAY)
+            finally:
+                if watcher is not None:
+                    watcher.close()
+    finally:
+        if own_scheduler:
+            scheduler.close()
@@ -3,16 +3,34 @@
 import argparse
 import os
 import logging
+import time
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from netboxlabs.diode.sdk import DiodeClient
-from vcenter_connector import connect_to_vcenter, disconnect_vcenter
-from vcenter_fetcher import fetch_cluster_data, fetch_vm_data
-from data_conversion import prepare_data
+from profiling import profiler, write_report
 from version import __version__
 
+# pyVmomi, the Diode SDK and the rule files are loaded only by the modes that use them,
+# so --help, snapshot replay and dry runs start without them.
+
 # Load .env file
 load_dotenv()
 
+def _patterns(value):
+    """
+    Splits a comma-separated list of regexes.
+    """
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+def _intervals(value):
+    """
+    Parses comma-separated property group intervals in seconds, e.g. "config=21600,hardware=21600".
+    """
+    intervals = {}
+    for item in _patterns(value):
+        group, _, seconds = item.partition("=")
+        intervals[group.strip()] = int(seconds)
+    return intervals
+
 def parse_arguments():
     """
     Parse command-line arguments with environment variable defaults,
@@ -26,45 +44,274 @@ def parse_arguments():
     parser.add_argument(
         "--diode-server",
         default=os.getenv("DIODE_SERVER"),
-        required=not os.getenv("DIODE_SERVER"),
         help="Diode server address (or set via DIODE_SERVER environment variable)"
     )
     parser.add_argument(
         "--diode-api-key",
         default=os.getenv("DIODE_API_KEY"),
-        required=not os.getenv("DIODE_API_KEY"),
         help="Diode API token (or set via DIODE_API_KEY environment variable)"
     )
     parser.add_argument(
         "--vcenter-host",
         default=os.getenv("VCENTER_HOST"),
-        required=not os.getenv("VCENTER_HOST"),
         help="Catalyst Center host (or set via VCENTER_HOST environment variable)"
     )
     parser.add_argument(
         "--vcenter-user",
         default=os.getenv("VCENTER_USER"),
-        required=not os.getenv("VCENTER_USER"),
         help="Catalyst Center username (or set via VCENTER_USER environment variable)"
     )
     parser.add_argument(
         "--vcenter-password",
         default=os.getenv("VCENTER_PASSWORD"),
-        required=not os.getenv("VCENTER_PASSWORD"),
         help="Catalyst Center password (or set via VCENTER_PASSWORD environment variable)"
     )
+    parser.add_argument(
+        "--vcenter-config",
+        default=os.getenv("VCENTER_CONFIG"),
+        help="YAML file listing several vCenters to sync in parallel, replacing the single --vcenter-* options (or set via VCENTER_CONFIG environment variable)"
+    )
     parser.add_argument(
         "--vcenter-verify",
         default=os.getenv("VCENTER_VERIFY", "true").lower() in ("true", "1", "yes"),
         type=lambda x: x.lower() in ("true", "1", "yes"),
         help="Verify Catalyst Center SSL certificate (default: true, or set via VCENTER_VERIFY environment variable)"
     )
+    parser.add_argument(
+        "--session-cache",
+        default=os.getenv("SESSION_CACHE"),
+        help="File (mode 0600) caching vCenter session ids so later runs resume the session instead of logging in (or set via SESSION_CACHE environment variable)"
+    )
+    parser.add_argument(
+        "--keepalive-interval",
+        default=int(os.getenv("KEEPALIVE_INTERVAL", "600")),
+        type=int,
+        help="Seconds between vCenter session checks, re-authenticating if needed, 0 to disable (default: 600, or set via KEEPALIVE_INTERVAL environment variable)"
+    )
     parser.add_argument(
         "--log-level",
         default=os.getenv("LOG_LEVEL", "INFO"),
         help="Logging Level INFO, WARNING, ERROR, DEBUG"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--page-size",
+        default=int(os.getenv("PAGE_SIZE", "1000")),
+        type=int,
+        help="Objects per PropertyCollector page (default: 1000, or set via PAGE_SIZE environment variable)"
+    )
+    parser.add_argument(
+        "--fetch-workers",
+        default=int(os.getenv("FETCH_WORKERS", "4")),
+        type=int,
+        help="Datacenter/object-type retrievals run in parallel (default: 4, or set via FETCH_WORKERS environment variable)"
+    )
+    parser.add_argument(
+        "--daemon",
+        default=os.getenv("DAEMON", "false").lower() in ("true", "1", "yes"),
+        type=lambda x: x.lower() in ("true", "1", "yes"),
+        help="Keep running and ingest vCenter changes as they happen (default: false, or set via DAEMON environment variable)"
+    )
+    parser.add_argument(
+        "--update-wait",
+        default=int(os.getenv("UPDATE_WAIT", "60")),
+        type=int,
+        help="Seconds each WaitForUpdatesEx call waits for changes in daemon mode (default: 60, or set via UPDATE_WAIT environment variable)"
+    )
+    parser.add_argument(
+        "--state-db",
+        default=os.getenv("STATE_DB"),
+        help="SQLite file recording entity hashes so unchanged entities are not resent (or set via STATE_DB environment variable)"
+    )
+    parser.add_argument(
+        "--full-sync-every",
+        default=int(os.getenv("FULL_SYNC_EVERY", "24")),
+        type=int,
+        help="With --state-db, resend all entities every N runs, 0 to never (default: 24, or set via FULL_SYNC_EVERY environment variable)"
+    )
+    parser.add_argument(
+        "--full-sync-interval",
+        default=int(os.getenv("FULL_SYNC_INTERVAL", "86400")),
+        type=int,
+        help="With --state-db in daemon mode, resend all entities of each vCenter every N seconds, 0 to never (default: 86400, or set via FULL_SYNC_INTERVAL environment variable)"
+    )
+    parser.add_argument(
+        "--refresh-intervals",
+        default=os.getenv("REFRESH_INTERVALS", ""),
+        type=_intervals,
+        help="With --state-db, VM and host property groups retrieved only every N seconds and cached in between, e.g. config=21600,hardware=21600,summary=21600; not with --daemon (or set via REFRESH_INTERVALS environment variable)"
+    )
+    parser.add_argument(
+        "--outbox-db",
+        default=os.getenv("OUTBOX_DB"),
+        help="SQLite file entities are written to before they are sent; batches Diode does not accept stay there and are replayed by the next run (or set via OUTBOX_DB environment variable)"
+    )
+    parser.add_argument(
+        "--pipeline",
+        default=os.getenv("PIPELINE", "false").lower() in ("true", "1", "yes"),
+        type=lambda x: x.lower() in ("true", "1", "yes"),
+        help="Stream records through concurrent fetch, convert and ingest stages (default: false, or set via PIPELINE environment variable)"
+    )
+    parser.add_argument(
+        "--queue-size",
+        default=int(os.getenv("QUEUE_SIZE", "100")),
+        type=int,
+        help="With --pipeline, items buffered between stages (default: 100, or set via QUEUE_SIZE environment variable)"
+    )
+    parser.add_argument(
+        "--async-mode",
+        default=os.getenv("ASYNC_MODE", "false").lower() in ("true", "1", "yes"),
+        type=lambda x: x.lower() in ("true", "1", "yes"),
+        help="Fetch, convert and ingest on one asyncio event loop with blocking calls on a bounded executor (default: false, or set via ASYNC_MODE environment variable)"
+    )
+    parser.add_argument(
+        "--fetch-concurrency",
+        default=int(os.getenv("FETCH_CONCURRENCY", "4")),
+        type=int,
+        help="With --async-mode, vCenter calls in flight at once (default: 4, or set via FETCH_CONCURRENCY environment variable)"
+    )
+    parser.add_argument(
+        "--convert-processes",
+        default=int(os.getenv("CONVERT_PROCESSES", "0")),
+        type=int,
+        help="Build VM entities on a pool of this many processes, 0 or 1 to convert in-process; not with --pipeline, --async-mode or --daemon (default: 0, or set via CONVERT_PROCESSES environment variable)"
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        default=int(os.getenv("INGEST_WORKERS", "4")),
+        type=int,
+        help="Ingest batches in flight at once (default: 4, or set via INGEST_WORKERS environment variable)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=int(os.getenv("BATCH_SIZE", "1000")),
+        type=int,
+        help="Upper limit on entities per ingest batch; the batch size adapts below it (default: 1000, or set via BATCH_SIZE environment variable)"
+    )
+    parser.add_argument(
+        "--ingest-retries",
+        default=int(os.getenv("INGEST_RETRIES", "3")),
+        type=int,
+        help="Retries with backoff before a failed ingest batch is dropped (default: 3, or set via INGEST_RETRIES environment variable)"
+    )
+    parser.add_argument(
+        "--report-file",
+        default=os.getenv("REPORT_FILE"),
+        help="Write a JSON run report with per-phase timings and counters to this file (or set via REPORT_FILE environment variable)"
+    )
+    parser.add_argument(
+        "--profile",
+        default=os.getenv("PROFILE"),
+        help="Run each vCenter sync under cProfile, one at a time, and write pstats files named after this path; not with --daemon (or set via PROFILE environment variable)"
+    )
+    parser.add_argument(
+        "--snapshot-out",
+        default=os.getenv("SNAPSHOT_OUT"),
+        help="Save fetched cluster and VM records to this JSONL file, gzipped if it ends in .gz (or set via SNAPSHOT_OUT environment variable)"
+    )
+    parser.add_argument(
+        "--snapshot-in",
+        default=os.getenv("SNAPSHOT_IN"),
+        help="Convert and ingest records from a snapshot file instead of connecting to vCenter (or set via SNAPSHOT_IN environment variable)"
+    )
+    parser.add_argument(
+        "--dry-run",
+        default=os.getenv("DRY_RUN", "false").lower() in ("true", "1", "yes"),
+        type=lambda x: x.lower() in ("true", "1", "yes"),
+        help="Convert entities but do not send them to Diode (default: false, or set via DRY_RUN environment variable)"
+    )
+    parser.add_argument(
+        "--include-datacenters",
+        default=os.getenv("INCLUDE_DATACENTERS", ""),
+        type=_patterns,
+        help="Only sync datacenters whose name matches one of these comma-separated regexes (or set via INCLUDE_DATACENTERS environment variable)"
+    )
+    parser.add_argument(
+        "--include-clusters",
+        default=os.getenv("INCLUDE_CLUSTERS", ""),
+        type=_patterns,
+        help="Only sync clusters, and their hosts and VMs, whose name matches one of these comma-separated regexes (or set via INCLUDE_CLUSTERS environment variable)"
+    )
+    parser.add_argument(
+        "--include-folders",
+        default=os.getenv("INCLUDE_FOLDERS", ""),
+        type=_patterns,
+        help="Only sync VMs whose folder path, e.g. /DC1/vm/Production, matches one of these comma-separated regexes (or set via INCLUDE_FOLDERS environment variable)"
+    )
+    parser.add_argument(
+        "--include-vms",
+        default=os.getenv("INCLUDE_VMS", ""),
+        type=_patterns,
+        help="Only sync VMs whose name matches one of these comma-separated regexes (or set via INCLUDE_VMS environment variable)"
+    )
+    parser.add_argument(
+        "--exclude-datacenters",
+        default=os.getenv("EXCLUDE_DATACENTERS", ""),
+        type=_patterns,
+        help="Skip datacenters whose name matches one of these comma-separated regexes (or set via EXCLUDE_DATACENTERS environment variable)"
+    )
+    parser.add_argument(
+        "--exclude-clusters",
+        default=os.getenv("EXCLUDE_CLUSTERS", ""),
+        type=_patterns,
+        help="Skip clusters, and their hosts and VMs, whose name matches one of these comma-separated regexes (or set via EXCLUDE_CLUSTERS environment variable)"
+    )
+    parser.add_argument(
+        "--exclude-folders",
+        default=os.getenv("EXCLUDE_FOLDERS", ""),
+        type=_patterns,
+        help="Skip VMs whose folder path, e.g. /DC1/vm/Production, matches one of these comma-separated regexes (or set via EXCLUDE_FOLDERS environment variable)"
+    )
+    parser.add_argument(
+        "--exclude-vms",
+        default=os.getenv("EXCLUDE_VMS", ""),
+        type=_patterns,
+        help="Skip VMs whose name matches one of these comma-separated regexes (or set via EXCLUDE_VMS environment variable)"
+    )
+    args = parser.parse_args()
+    if args.profile and args.daemon:
+        # Profiled syncs run one at a time, so a daemon that never returns would keep the others from syncing
+        parser.error("--profile cannot be combined with --daemon")
+    if args.refresh_intervals and args.daemon:
+        # Daemon mode watches every property, so there is nothing to retrieve on a schedule
+        parser.error("--refresh-intervals cannot be combined with --daemon")
+    if args.convert_processes > 1 and not args.snapshot_in and (args.pipeline or args.async_mode or args.daemon):
+        # Those modes convert as records stream in, without a process pool
+        parser.error("--convert-processes cannot be combined with --pipeline, --async-mode or --daemon")
+    if not args.dry_run and not (args.diode_server and args.diode_api_key):
+        parser.error("--diode-server and --diode-api-key are required unless --dry-run is given")
+    if not args.snapshot_in and not args.vcenter_config and not (args.vcenter_host and args.vcenter_user and args.vcenter_password):
+        parser.error("--vcenter-host, --vcenter-user and --vcenter-password are required unless --vcenter-config or --snapshot-in is given")
+    return args
+
+
+def replay(path, client, args, state=None, outbox=None):
+    """
+    Ingests a snapshot file through the same scheduler settings as a live sync.
+    :return: result dict shaped like those of sync_vcenter
+    """
+    from snapshot import replay_snapshot
+    from ingest_scheduler import IngestScheduler
+
+    result = {"name": path, "ok": False, "clusters": 0, "vms": 0, "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    scheduler = IngestScheduler(
+        client, logging, state,
+        max_in_flight=args.ingest_workers,
+        max_batch_entities=args.batch_size,
+        max_retries=args.ingest_retries,
+        outbox=outbox,
+    )
+    try:
+        clusters, vms = replay_snapshot(path, client, logging, state, scheduler, args.convert_processes)
+        result.update(ok=True, clusters=clusters, vms=vms)
+    except Exception as e:
+        logging.error(f"Failed to replay snapshot {path}: {e}")
+        result["error"] = str(e)
+    finally:
+        scheduler.close()
+        result["ingest"] = scheduler.stats()
+        result["seconds"] = time.perf_counter() - start
+    return result
 
 
 def main():
@@ -76,42 +323,112 @@ def main():
         format="%(asctime)s - %(levelname)s - %(message)s"
     )
 
+    logging.info(f"Running Diode vCenter Agent version {__version__}")
     logging.info("Starting Diode vCenter Agent...")
+    started = datetime.now(timezone.utc)
+    start = time.perf_counter()
 
-    # Connect to vCenter
-    si = connect_to_vcenter(args.vcenter_host, args.vcenter_user, args.vcenter_password)
-    if not si:
-        logging.error("Failed to connect to vCenter. Exiting.")
+    if args.snapshot_in:
+        vcenters = []
+    elif args.vcenter_config:
+        from vcenter_sync import load_vcenter_configs
+
+        vcenters = load_vcenter_configs(args.vcenter_config)
+    else:
+        vcenters = [{
+            "name": args.vcenter_host,
+            "host": args.vcenter_host,
+            "user": args.vcenter_user,
+            "password": args.vcenter_password,
+            "verify": args.vcenter_verify,
+            "rules": {},
+            "scope": {},
+        }]
+    if not vcenters and not args.snapshot_in:
+        logging.error("No vCenters configured. Exiting.")
         return
 
+    state = None
+    if args.state_db:
+        from state_store import StateStore
+
+        state = StateStore(args.state_db, args.full_sync_every)
+        state.start_run(logging)
+
+    outbox = None
+    if args.outbox_db and args.dry_run:
+        logging.warning("The outbox is not used in dry runs.")
+    elif args.outbox_db:
+        from outbox import Outbox
+
+        outbox = Outbox(args.outbox_db)
+        if outbox.replayed:
+            logging.info(f"Replaying {outbox.replayed} entities left in the outbox by earlier runs.")
+
+    snapshot = None
+    if args.snapshot_out:
+        from snapshot import SnapshotWriter
+
+        snapshot = SnapshotWriter(args.snapshot_out)
+
     # Connect to Diode
-    with DiodeClient(
-        target=f"grpc://{args.diode_server}/diode",
-        app_name="diode-vcenter",
-        app_version=__version__,
-    ) as client:
+    if args.dry_run:
+        from ingest_scheduler import DryRunClient
+
+        client_context = DryRunClient(logging)
+    else:
+        from netboxlabs.diode.sdk import DiodeClient
+
+        client_context = DiodeClient(
+            target=f"grpc://{args.diode_server}/diode",
+            app_name="diode-vcenter",
+            app_version=__version__,
+        )
+    with client_context as client:
+        results = []
         try:
-            logging.info("Fetching cluster data from vCenter...")
-            cluster_data = fetch_cluster_data(si,logging)
-            logging.info(f"Fetched {len(cluster_data)} clusters.")
-
-            logging.info("Fetching VM data from vCenter...")
-            vm_data = fetch_vm_data(si,logging)
-            logging.info(f"Fetched {len(vm_data)} VMs.")
-            
-            logging.info("Transforming data to Diode entities...")
-            prepare_data(client,cluster_data,vm_data,logging)
-            
-            
-        except Exception as e:
-            logging.error(f"An error occurred during the process: {e}")
+            if args.snapshot_in:
+                results = [replay(args.snapshot_in, client, args, state, outbox)]
+            else:
+                from vcenter_sync import sync_vcenters
+
+                results = sync_vcenters(vcenters, client, args, state, snapshot, outbox)
         finally:
-            # Disconnect from vCenter
-            logging.info("Disconnecting from vCenter...")
-            disconnect_vcenter(si)
-            logging.info("Disconnected from vCenter.")
+            if snapshot:
+                snapshot.close()
+                logging.info(
+                    f"Saved {snapshot.counts['cluster']} clusters and {snapshot.counts['vm']} VMs to {args.snapshot_out}."
+                )
+            if outbox:
+                pending = outbox.pending()
+                if pending:
+                    logging.warning(f"{pending} entities wait in the outbox for the next run.")
+                outbox.close()
+            if state:
+                logging.info(f"Sent {state.sent} entities, skipped {state.skipped} unchanged.")
+                state.close()
+            if args.report_file:
+                write_report(args.report_file, {
+                    "version": __version__,
+                    "started": started.isoformat(),
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "settings": {
+                        "page_size": args.page_size,
+                        "fetch_workers": args.fetch_workers,
+                        "pipeline": args.pipeline,
+                        "async_mode": args.async_mode,
+                        "convert_processes": args.convert_processes,
+                        "dry_run": args.dry_run,
+                        "snapshot_in": args.snapshot_in,
+                        "ingest_workers": args.ingest_workers,
+                        "batch_size": args.batch_size,
+                    },
+                    "vcenters": results,
+                    "phases": profiler.report(),
+                    "state": {"sent": state.sent, "skipped": state.skipped} if state else None,
+                    "outbox": {"replayed": outbox.replayed, "pending": pending} if outbox else None,
+                }, logging)
 
 
 if __name__ == "__main__":
-    logging.info(f"Running Diode vCenter Agent version {__version__}")
     main()
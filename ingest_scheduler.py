@@ -0,0 +1,323 @@
+import time
+import random
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from profiling import profiler
+
+DEFAULT_MAX_IN_FLIGHT = 4
+
+DEFAULT_BATCH_ENTITIES = 1000
+
+# Stay well below the 4 MiB default gRPC message limit.
+DEFAULT_BATCH_BYTES = 3 * 1024 * 1024
+
+DEFAULT_MAX_RETRIES = 3
+
+# Seconds before the first retry, doubled for each further attempt.
+DEFAULT_BACKOFF = 2.0
+
+# Batches slower than this shrink the batch size, faster ones grow it.
+DEFAULT_TARGET_LATENCY = 5.0
+
+MIN_BATCH_ENTITIES = 50
+
+
+def retry_delay(backoff, attempt):
+    """
+    Returns the seconds to wait before retry number attempt, counting from 1: backoff doubled
+    for each further attempt, jittered by up to half either way so senders do not retry in step.
+    """
+    return backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def ingest_batch(client, batch, logging):
+    """
+    Sends one batch to Diode, logging and profiling the call.
+    :return: (the ingest errors or the exception raised, falsy on success; seconds the call took)
+    """
+    logging.info(f"Ingesting {len(batch)} entity batch into Diode...")
+    start = time.perf_counter()
+    try:
+        error = client.ingest(entities=batch).errors
+    except Exception as e:
+        error = e
+    elapsed = time.perf_counter() - start
+    profiler.record("ingest_batch", elapsed, len(batch))
+    if error:
+        logging.error(f"Diode Ingestion Errors: {error}")
+    else:
+        logging.info(f"Successfully ingested {len(batch)} in {elapsed:.2f}s.")
+    return error, elapsed
+
+
+class DryRunClient:
+    """
+    Stands in for DiodeClient in dry runs: counts what would be ingested and sends nothing.
+    """
+
+    def __init__(self, logging):
+        self.logging = logging
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.entities = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.logging.info(f"Dry run: would have sent {self.entities} entities ({self.bytes} bytes) in {self.calls} batches.")
+        return False
+
+    def ingest(self, entities):
+        size = sum(entity.ByteSize() for entity in entities)
+        with self.lock:
+            self.calls += 1
+            self.entities += len(entities)
+            self.bytes += size
+        return SimpleNamespace(errors=[])
+
+
+class IngestScheduler:
+    """
+    Groups entities into batches bounded by entity count and serialized size and sends
+    them to Diode from a thread pool, with up to max_in_flight batches outstanding.
+    The entity limit adapts to the service: it grows while batches complete faster than
+    target_latency and halves on slow or failed batches. Failed batches are retried
+    with exponential backoff before they are dropped.
+    With a state store, unchanged entities are dropped before batching and hashes
+    are recorded once their batch is ingested; setting full_sync to True sends them
+    anyway, for this scheduler only.
+    With an Outbox, batches are written to it instead of being sent directly, so add never
+    waits for Diode. A sender thread drains the outbox, including entities left by earlier
+    runs, through the same pool; failed batches are retried with backoff and, once their
+    retries are used up, the outbox is parked and probed again after a cool-down, so entities
+    are kept instead of being dropped.
+    """
+
+    def __init__(self, client, logging, state=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_batch_entities=DEFAULT_BATCH_ENTITIES, max_batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 target_latency=DEFAULT_TARGET_LATENCY, outbox=None):
+        self.client = client
+        self.logging = logging
+        self.state = state
+        # None follows the state store's decision for the run
+        self.full_sync = None
+        self.max_batch_entities = max(1, max_batch_entities)
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.target_latency = target_latency
+        self.batch_entities = min(self.max_batch_entities, max(MIN_BATCH_ENTITIES, self.max_batch_entities // 2))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix="ingest")
+        self.slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.lock = threading.Lock()
+        self.futures = []
+        self.entities = []
+        self.hashes = []
+        self.bytes = 0
+        self.batches = 0
+        self.ingested = 0
+        self.retries = 0
+        self.failed = 0
+        self.outbox = outbox
+        self.closed = threading.Event()
+        self.sender = None
+        if outbox is not None:
+            self.sender = threading.Thread(target=self._drain, name="outbox", daemon=True)
+            self.sender.start()
+
+    def add(self, entities):
+        """
+        Queues entities for ingestion, sending a batch whenever a limit is reached.
+        Without an outbox, blocks while max_in_flight batches are outstanding.
+        """
+        hashes = None
+        if self.state is not None:
+            total = len(entities)
+            entities, hashes = self.state.filter_changed(entities, self.full_sync)
+            self.logging.debug(f"{total - len(entities)} of {total} entities unchanged since last run.")
+        for index, entity in enumerate(entities):
+            size = entity.ByteSize()
+            if self.entities and (
+                len(self.entities) >= self.batch_entities or self.bytes + size > self.max_batch_bytes
+            ):
+                self._submit()
+            self.entities.append(entity)
+            if hashes is not None:
+                self.hashes.append(hashes[index])
+            self.bytes += size
+
+    def flush(self):
+        """
+        Sends any buffered entities and waits until every batch has completed.
+        With an outbox, waits until the entities this scheduler wrote have been ingested,
+        or left in the outbox because Diode is unavailable.
+        """
+        if self.entities:
+            self._submit()
+        if self.outbox is not None:
+            self.outbox.wait_sent(self._owner())
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def stats(self):
+        """
+        Returns batch, entity, retry and failure counters.
+        """
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "ingested": self.ingested,
+                "retries": self.retries,
+                "failed": self.failed,
+                "batch_entities": self.batch_entities,
+                "outbox": self.outbox.pending(self._owner()) if self.outbox is not None else None,
+            }
+
+    def close(self):
+        """
+        Flushes and shuts down the sender threads.
+        """
+        try:
+            self.flush()
+        finally:
+            self.closed.set()
+            if self.sender is not None:
+                self.outbox.notify()
+                self.sender.join()
+            self.executor.shutdown(wait=True)
+            self.logging.info(
+                f"Ingested {self.ingested} entities in {self.batches} batches "
+                f"({self.retries} retries, {self.failed} batches failed)."
+            )
+
+    def _owner(self):
+        return f"scheduler-{id(self)}"
+
+    def _submit(self):
+        batch, hashes = self.entities, self.hashes
+        self.entities, self.hashes, self.bytes = [], [], 0
+        if self.outbox is not None:
+            # Without a state store there are no hashes yet; the outbox computes them
+            self.outbox.put(batch, hashes or None, self._owner())
+            return
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._send, batch, hashes)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures = [f for f in self.futures if not f.done()]
+            self.futures.append(future)
+
+    def _send(self, batch, hashes):
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    delay = retry_delay(self.backoff, attempt)
+                    self.logging.warning(f"Retrying batch of {len(batch)} entities in {delay:.1f}s...")
+                    time.sleep(delay)
+                    with self.lock:
+                        self.retries += 1
+                self.logging.debug(f"Total entities being sent: {batch}")
+                error, elapsed = ingest_batch(self.client, batch, self.logging)
+                self._tune(elapsed, ok=not error)
+                if not error:
+                    with self.lock:
+                        self.batches += 1
+                        self.ingested += len(batch)
+                    if hashes and self.state is not None:
+                        self.state.commit(hashes)
+                    return
+            self.logging.error(f"Dropping batch of {len(batch)} entities after {self.max_retries} retries.")
+            with self.lock:
+                self.batches += 1
+                self.failed += 1
+        finally:
+            self.slots.release()
+
+    def _drain(self):
+        """
+        Claims batches from the outbox and sends them from the pool until the scheduler is closed
+        and nothing is due.
+        """
+        while True:
+            self.slots.acquire()
+            try:
+                rows = self.outbox.claim(self.batch_entities, self.max_batch_bytes)
+            except Exception as e:
+                self.logging.error(f"Failed to read from the ingest outbox: {e}")
+                rows = []
+            if not rows:
+                self.slots.release()
+                if self.closed.is_set():
+                    return
+                self.outbox.wait(1.0)
+                continue
+            future = self.executor.submit(self._send_rows, rows)
+            with self.lock:
+                self.futures = [f for f in self.futures if not f.done()]
+                self.futures.append(future)
+
+    def _send_rows(self, rows):
+        """
+        Sends one batch of outbox rows. Failures are rescheduled with backoff; once the retries
+        are used up the outbox is parked for one more backoff step, then probed with its oldest row.
+        """
+        ids = [row[0] for row in rows]
+        try:
+            batch = self.outbox.entities(rows)
+            error, elapsed = ingest_batch(self.client, batch, self.logging)
+            self._tune(elapsed, ok=not error)
+            if not error:
+                if self.outbox.done(ids):
+                    self.logging.info("Diode is available again; resuming sends from the outbox.")
+                with self.lock:
+                    self.batches += 1
+                    self.ingested += len(batch)
+                if self.state is not None:
+                    self.state.commit([(entity_type, key, digest) for _, entity_type, key, digest, _, _ in rows])
+                return
+            attempt = max(row[5] for row in rows) + 1
+            if attempt > self.max_retries:
+                cooldown = retry_delay(self.backoff, attempt)
+                self.outbox.retry(ids)
+                if self.outbox.park(cooldown):
+                    self.logging.error(
+                        f"Diode unavailable after {self.max_retries} retries; entities stay in the outbox, "
+                        f"probing again in {cooldown:.1f}s."
+                    )
+                else:
+                    self.logging.warning(f"Diode still unavailable; probing again in {cooldown:.1f}s.")
+                with self.lock:
+                    self.batches += 1
+                    self.failed += 1
+                return
+            delay = retry_delay(self.backoff, attempt)
+            self.logging.warning(f"Retrying batch of {len(batch)} entities in {delay:.1f}s...")
+            self.outbox.retry(ids, delay)
+            with self.lock:
+                self.retries += 1
+        except Exception as e:
+            self.logging.error(f"Error sending outbox batch: {e}")
+            self.outbox.retry(ids, self.backoff)
+        finally:
+            self.slots.release()
+
+    def _tune(self, elapsed, ok):
+        """
+        Adjusts the batch entity limit: additive increase on fast successes,
+        multiplicative decrease on slow or failed batches.
+        """
+        with self.lock:
+            if ok and elapsed < self.target_latency:
+                self.batch_entities = min(self.max_batch_entities, self.batch_entities + MIN_BATCH_ENTITIES)
+            elif not ok or elapsed > self.target_latency:
+                self.batch_entities = min(self.max_batch_entities, max(MIN_BATCH_ENTITIES, self.batch_entities // 2))
+            self.logging.debug(f"Batch size now {self.batch_entities} entities.")
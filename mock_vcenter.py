@@ -0,0 +1,269 @@
+import time
+import random
+import threading
+from types import SimpleNamespace
+from pyVmomi import vim
+
+VENDORS = [("Dell Inc.", "PowerEdge R740"), ("HPE", "ProLiant DL380 Gen10"), ("Cisco Systems Inc", "UCSC-C240-M5SX")]
+
+VM_PREFIXES = ["web", "app", "db", "ad", "file", "print", "mail", "vdi", "sql", "template"]
+
+GUEST_OS = ["Ubuntu Linux (64-bit)", "Microsoft Windows Server 2019 (64-bit)", "Red Hat Enterprise Linux 8 (64-bit)"]
+
+
+class MockView(vim.view.ContainerView):
+    """
+    ContainerView stand-in; the PropertyCollector type checks require a real managed object.
+    """
+
+    def Destroy(self):
+        pass
+
+
+def _ip(n):
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+def generate_inventory(datacenters=10, hosts=200, vms=20000, max_nics=8, max_disks=8,
+                       hosts_per_cluster=8, datastores_per_datacenter=4, seed=0):
+    """
+    Builds a synthetic inventory of pyVmomi objects with the property paths the agent reads.
+    Hosts are spread over the datacenters and grouped into clusters; VMs are spread over the
+    hosts with 1 to max_nics NICs (each with guest IPs) and 1 to max_disks disks.
+    :return: list of (managed object reference, {property path: value}, datacenter id)
+    """
+    rng = random.Random(seed)
+    objects = []
+    root = vim.Folder("group-d1")
+    objects.append((root, {"name": "Datacenters", "parent": None}, None))
+
+    host_refs = []
+    datastores = {}
+    vm_folders = {}
+    for d in range(datacenters):
+        dc = vim.Datacenter(f"datacenter-{d}")
+        dc_id = dc._moId
+        host_folder = vim.Folder(f"group-h{d}")
+        vm_folder = vim.Folder(f"group-v{d}")
+        objects.append((dc, {"name": f"DC{d:02d}", "parent": root}, dc_id))
+        objects.append((host_folder, {"name": "host", "parent": dc}, dc_id))
+        objects.append((vm_folder, {"name": "vm", "parent": dc}, dc_id))
+        vm_folders[dc_id] = []
+        for f, name in enumerate(["Production", "Test"]):
+            folder = vim.Folder(f"group-v{d}-{f}")
+            objects.append((folder, {"name": name, "parent": vm_folder}, dc_id))
+            vm_folders[dc_id].append(folder)
+        switch = vim.dvs.VmwareDistributedVirtualSwitch(f"dvs-{d}")
+        switch_uuid = f"50 2a 00 00 00 00 00 {d:02x}-00 00 00 00 00 00 00 {d:02x}"
+        objects.append((switch, {"name": f"DC{d:02d}-DSwitch", "uuid": switch_uuid}, dc_id))
+        portgroups = []
+        for p, name in enumerate(["Management", "vMotion"]):
+            portgroup = vim.dvs.DistributedVirtualPortgroup(f"dvportgroup-{d}-{p}")
+            objects.append((portgroup, {"name": f"DC{d:02d}-{name}", "key": portgroup._moId}, dc_id))
+            portgroups.append(portgroup._moId)
+        datastores[dc_id] = []
+        for s in range(datastores_per_datacenter):
+            ds = vim.Datastore(f"datastore-{d}-{s}")
+            datastores[dc_id].append(ds)
+            objects.append((ds, {"name": f"DC{d:02d}-DS{s:02d}"}, dc_id))
+
+        dc_hosts = [n for n in range(hosts) if n % datacenters == d]
+        for c in range(0, len(dc_hosts), hosts_per_cluster):
+            cluster = vim.ClusterComputeResource(f"domain-c{d}-{c}")
+            members = []
+            for n in dc_hosts[c:c + hosts_per_cluster]:
+                host = vim.HostSystem(f"host-{n}")
+                vendor, model = rng.choice(VENDORS)
+                # vmk0 on a standard portgroup, vmk1 on the datacenter's distributed switch
+                vnics = [
+                    vim.host.VirtualNic(
+                        device=f"vmk{i}", portgroup="Management" if i == 0 else "",
+                        spec=vim.host.VirtualNic.Specification(
+                            mac=f"00:50:56:6{i}:{n >> 8 & 255:02x}:{n & 255:02x}",
+                            ip=vim.host.IpConfig(ipAddress=_ip(n * 2 + i + 1), subnetMask="255.255.255.0"),
+                            distributedVirtualPort=vim.dvs.PortConnection(switchUuid=switch_uuid, portgroupKey=portgroups[1]) if i else None,
+                        ),
+                    )
+                    for i in range(2)
+                ]
+                pnics = [
+                    vim.host.PhysicalNic(
+                        device=f"vmnic{i}", mac=f"a0:36:9f:0{i}:{n >> 8 & 255:02x}:{n & 255:02x}",
+                        linkSpeed=vim.host.PhysicalNic.LinkSpeedDuplex(speedMb=rng.choice([1000, 10000, 25000]), duplex=True),
+                    )
+                    for i in range(rng.randint(2, 4))
+                ]
+                serial = vim.host.SystemIdentificationInfo(
+                    identifierValue=f"SN{n:06d}",
+                    identifierType=vim.ElementDescription(key="SerialNumberTag", label="Serial number tag", summary=""),
+                )
+                objects.append((host, {
+                    "name": f"esx{n:04d}.example.com",
+                    "parent": cluster,
+                    "config.network.vnic": vnics,
+                    "config.network.pnic": pnics,
+                    "summary.hardware.otherIdentifyingInfo": [serial],
+                    "hardware.systemInfo.model": model,
+                    "hardware.systemInfo.vendor": vendor,
+                }, dc_id))
+                members.append(host)
+                host_refs.append((host, dc_id))
+            objects.append((cluster, {"name": f"DC{d:02d}-Cluster{c // hosts_per_cluster:02d}", "parent": host_folder, "host": members}, dc_id))
+
+    for n in range(vms):
+        if not host_refs:
+            break
+        host, dc_id = host_refs[n % len(host_refs)]
+        vm = vim.VirtualMachine(f"vm-{n}")
+        devices = []
+        nets = []
+        for i in range(rng.randint(1, max_nics)):
+            mac = f"02:{i:02x}:{n >> 24 & 255:02x}:{n >> 16 & 255:02x}:{n >> 8 & 255:02x}:{n & 255:02x}"
+            devices.append(vim.vm.device.VirtualVmxnet3(
+                key=4000 + i, macAddress=mac,
+                deviceInfo=vim.Description(label=f"Network adapter {i + 1}", summary=""),
+                connectable=vim.vm.device.VirtualDevice.ConnectInfo(connected=rng.random() > 0.05),
+            ))
+            addresses = [vim.net.IpConfigInfo.IpAddress(ipAddress=_ip(n * max_nics + i + 1024), prefixLength=rng.choice([22, 24, 26]))]
+            if rng.random() < 0.3:
+                addresses.append(vim.net.IpConfigInfo.IpAddress(ipAddress=f"fe80::{n & 0xffff:x}:{i}", prefixLength=64))
+            nets.append(vim.vm.GuestInfo.NicInfo(macAddress=mac, ipConfig=vim.net.IpConfigInfo(ipAddress=addresses)))
+        for i in range(rng.randint(1, max_disks)):
+            backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName=f"[ds] vm-{n}/vm-{n}_{i}.vmdk", diskMode="persistent",
+                datastore=rng.choice(datastores[dc_id]), thinProvisioned=rng.random() < 0.5,
+            )
+            devices.append(vim.vm.device.VirtualDisk(
+                key=2000 + i, capacityInKB=rng.choice([16, 40, 100, 500]) * 1048576,
+                deviceInfo=vim.Description(label=f"Hard disk {i + 1}", summary=""), backing=backing,
+            ))
+        objects.append((vm, {
+            "name": f"{rng.choice(VM_PREFIXES)}-{n:06d}",
+            "parent": vm_folders[dc_id][n % len(vm_folders[dc_id])],
+            "runtime.powerState": "poweredOn" if rng.random() < 0.9 else "poweredOff",
+            "runtime.host": host,
+            "guest.net": nets,
+            "guest.guestFullName": rng.choice(GUEST_OS),
+            "config.hardware.device": devices,
+            "config.hardware.numCPU": rng.choice([1, 2, 4, 8]),
+            "config.hardware.memoryMB": rng.choice([2048, 4096, 8192, 16384]),
+            "summary.config.annotation": "",
+        }, dc_id))
+    return objects
+
+
+class MockVCenter:
+    """
+    In-process stand-in for a vCenter ServiceInstance, serving a generated inventory through
+    the ContainerView and PropertyCollector calls the agent makes. It plays the roles of the
+    ServiceInstance, ServiceContent, ViewManager and PropertyCollector, and counts round trips
+    and the property values handed out.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.by_id = {ref._moId: (ref, props) for ref, props, _ in objects}
+        self.rootFolder = objects[0][0] if objects else vim.Folder("group-d1")
+        self.lock = threading.Lock()
+        self.views = {}
+        self.results = {}
+        self.tokens = 0
+        self.round_trips = 0
+        self.values = 0
+
+    def RetrieveContent(self):
+        return self
+
+    @property
+    def propertyCollector(self):
+        return self
+
+    @property
+    def viewManager(self):
+        return self
+
+    def CreateContainerView(self, container, type, recursive):
+        dc_id = container._moId if isinstance(container, vim.Datacenter) else None
+        types = tuple(type)
+        members = [
+            (ref, props) for ref, props, dc in self.objects
+            if isinstance(ref, types) and (dc_id is None or dc == dc_id)
+        ]
+        with self.lock:
+            self.round_trips += 1
+            view = MockView(f"session[mock]view-{len(self.views)}")
+            self.views[view._moId] = members
+        return view
+
+    def _page(self, items, page_size):
+        page, rest = items[:page_size], items[page_size:]
+        result = SimpleNamespace(token=None, objects=[
+            SimpleNamespace(obj=ref, propSet=[SimpleNamespace(name=name, val=val) for name, val in props.items()])
+            for ref, props in page
+        ])
+        with self.lock:
+            self.values += sum(len(props) for _, props in page)
+            if rest:
+                self.tokens += 1
+                result.token = str(self.tokens)
+                self.results[result.token] = (rest, page_size)
+        return result
+
+    def RetrievePropertiesEx(self, specSet, options):
+        with self.lock:
+            self.round_trips += 1
+        spec = specSet[0]
+        if isinstance(spec.objectSet[0].obj, vim.view.ContainerView):
+            members = self.views[spec.objectSet[0].obj._moId]
+        else:
+            members = [self.by_id[object_spec.obj._moId] for object_spec in spec.objectSet if object_spec.obj._moId in self.by_id]
+        items = []
+        for ref, props in members:
+            for prop_spec in spec.propSet:
+                if isinstance(ref, prop_spec.type):
+                    items.append((ref, {path: props[path] for path in prop_spec.pathSet if path in props}))
+                    break
+        if not items:
+            return None
+        return self._page(items, options.maxObjects or len(items))
+
+    def ContinueRetrievePropertiesEx(self, token):
+        with self.lock:
+            self.round_trips += 1
+            items, page_size = self.results.pop(token)
+        return self._page(items, page_size)
+
+    def CancelRetrievePropertiesEx(self, token):
+        with self.lock:
+            self.round_trips += 1
+            self.results.pop(token, None)
+
+
+class FakeDiodeClient:
+    """
+    DiodeClient stand-in that records ingest calls instead of sending them.
+    :param latency: seconds each ingest call sleeps, to model the Diode round trip
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.entities = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def ingest(self, entities):
+        size = sum(entity.ByteSize() for entity in entities)
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.entities += len(entities)
+            self.bytes += size
+        return SimpleNamespace(errors=[])
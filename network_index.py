@@ -0,0 +1,57 @@
+import ipaddress
+import threading
+from functools import lru_cache
+
+# Distinct addresses seen per run; hosts and VMs share a handful of networks.
+ADDRESS_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=None)
+def mask_to_prefixlen(subnet_mask):
+    """
+    Returns the prefix length of a dotted IPv4 subnet mask, e.g. 24 for 255.255.255.0.
+    Raises ValueError for masks that are not contiguous.
+    """
+    return ipaddress.IPv4Network(f"0.0.0.0/{subnet_mask}").prefixlen
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def parse_interface(address):
+    """
+    Parses an address with optional prefix length ("10.0.0.5/24", "fe80::1") into an
+    IPv4Interface or IPv6Interface, or None if it is not a valid address.
+    """
+    try:
+        return ipaddress.ip_interface(address)
+    except ValueError:
+        return None
+
+
+class NetworkIndex:
+    """
+    Per-run record of the prefixes already emitted, so each network is sent once
+    however many host or VM addresses fall into it. One index is shared by the threads
+    syncing the vCenters of a run.
+    """
+
+    def __init__(self):
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def new_prefix(self, address):
+        """
+        Returns the network of an address in CIDR notation the first time it is seen,
+        and None for repeats, invalid addresses, host routes and loopback or link-local networks.
+        """
+        interface = parse_interface(address)
+        if interface is None:
+            return None
+        network = interface.network
+        if network.num_addresses == 1 or network.is_loopback or network.is_link_local:
+            return None
+        prefix = str(network)
+        with self.lock:
+            if prefix in self.prefixes:
+                return None
+            self.prefixes.add(prefix)
+        return prefix
@@ -0,0 +1,219 @@
+import os
+import time
+import sqlite3
+import threading
+from state_store import entity_hash
+
+# Rows fetched per SELECT ... IN (...), below SQLite's limit on bound parameters.
+QUERY_CHUNK = 500
+
+
+class Outbox:
+    """
+    Durable SQLite queue of entities waiting to be ingested. Entities are written before they
+    are sent and deleted once Diode accepted them, so batches that fail, or a run that is
+    interrupted, leave them to be replayed by the next run. Only the latest version of each
+    entity is kept: a pending row is replaced by one with the same entity type and natural
+    key (see state_store.KEY_FIELDS), and entity types without one are keyed by content.
+    A failed batch pauses all sending until its retry is due, so the oldest entities are
+    retried first. Once a batch has used up its retries, Diode is taken to be unavailable and
+    the outbox is parked: after a cool-down, the oldest row alone is handed out as a probe,
+    and sending resumes once it is ingested. Entities written meanwhile wait in the outbox.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        # Notified whenever rows are written, sent, rescheduled or the outbox is parked
+        self.changed = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entity_type TEXT NOT NULL,
+                entity_key TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                entity BLOB NOT NULL,
+                owner TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                UNIQUE (entity_type, entity_key)
+            );
+        """)
+        # Entities left over from earlier runs are due now
+        self.conn.execute("UPDATE outbox SET owner = NULL, attempts = 0, next_attempt = 0")
+        self.conn.commit()
+        # Ids being sent, which are not handed out again
+        self.claimed = set()
+        self.available = True
+        # Nothing is handed out before this time after a failed batch
+        self.resume = 0.0
+        self.message_type = None
+        self.replayed = self.pending()
+
+    def put(self, entities, hashes=None, owner=None, claim=False):
+        """
+        Writes entities to the outbox, replacing any pending version of the same entity.
+        :param hashes: (entity type, key, hash) of each entity, computed if not given
+        :param owner: tag of the writer, so it can wait for its own entities with wait_sent
+        :param claim: mark the rows as being sent by the caller, so they are not handed out by claim
+        :return: ids of the written rows
+        """
+        if not entities:
+            return []
+        if self.message_type is None:
+            self.message_type = type(entities[0])
+        hashes = hashes or [entity_hash(entity) for entity in entities]
+        ids = []
+        with self.changed:
+            for entity, (entity_type, key, digest) in zip(entities, hashes):
+                cursor = self.conn.execute(
+                    "INSERT OR REPLACE INTO outbox (entity_type, entity_key, hash, entity, owner) VALUES (?, ?, ?, ?, ?)",
+                    (entity_type, key, digest, entity.SerializeToString(), owner),
+                )
+                ids.append(cursor.lastrowid)
+            self.conn.commit()
+            if claim:
+                self.claimed.update(ids)
+            self.changed.notify_all()
+        return ids
+
+    def claim(self, max_entities, max_bytes):
+        """
+        Claims the oldest due rows not being sent, up to max_entities rows and max_bytes of entities.
+        :return: list of (id, entity type, key, hash, serialized entity, attempts)
+        """
+        now = time.time()
+        with self.lock:
+            if now < self.resume:
+                return []
+            if not self.available:
+                # Parked: one probe row at a time until Diode takes it
+                if self.claimed:
+                    return []
+                max_entities = 1
+            candidates = self.conn.execute(
+                "SELECT id, length(entity) FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, len(self.claimed) + max_entities),
+            ).fetchall()
+            ids = []
+            size = 0
+            for row_id, length in candidates:
+                if row_id in self.claimed:
+                    continue
+                if ids and (len(ids) >= max_entities or size + length > max_bytes):
+                    break
+                ids.append(row_id)
+                size += length
+            rows = self._rows(ids)
+            self.claimed.update(row[0] for row in rows)
+        return rows
+
+    def _rows(self, ids):
+        rows = []
+        for start in range(0, len(ids), QUERY_CHUNK):
+            chunk = ids[start:start + QUERY_CHUNK]
+            rows.extend(self.conn.execute(
+                f"SELECT id, entity_type, entity_key, hash, entity, attempts FROM outbox "
+                f"WHERE id IN ({', '.join('?' * len(chunk))}) ORDER BY id",
+                chunk,
+            ))
+        return rows
+
+    def entities(self, rows):
+        """
+        Returns the Entity messages of claimed rows.
+        """
+        if self.message_type is None:
+            from netboxlabs.diode.sdk.ingester import Entity
+
+            self.message_type = type(Entity())
+        return [self.message_type.FromString(row[4]) for row in rows]
+
+    def done(self, ids):
+        """
+        Deletes rows that were ingested. Rows replaced by a newer version meanwhile are already gone.
+        A parked outbox resumes sending.
+        :return: True if the outbox was parked
+        """
+        with self.changed:
+            resumed, self.available = not self.available, True
+            for start in range(0, len(ids), QUERY_CHUNK):
+                chunk = ids[start:start + QUERY_CHUNK]
+                self.conn.execute(f"DELETE FROM outbox WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            self.conn.commit()
+            self.claimed.difference_update(ids)
+            self.changed.notify_all()
+        return resumed
+
+    def retry(self, ids, delay=0.0):
+        """
+        Releases rows that failed to send, to be claimed again after delay seconds,
+        and holds back all other rows until then.
+        """
+        with self.changed:
+            retry_at = time.time() + delay
+            self.resume = max(self.resume, retry_at)
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+                [(retry_at, row_id) for row_id in ids],
+            )
+            self.conn.commit()
+            self.claimed.difference_update(ids)
+            self.changed.notify_all()
+
+    def park(self, cooldown=0.0):
+        """
+        Stops handing out rows until cooldown seconds have passed; after that, claim hands out
+        a single probe row until one is ingested. A failed probe parks the outbox again.
+        :return: True if the outbox was not parked yet
+        """
+        with self.changed:
+            parked, self.available = self.available, False
+            self.resume = max(self.resume, time.time() + cooldown)
+            self.changed.notify_all()
+        return parked
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for rows to be written, sent or rescheduled, or for a
+        paused outbox to resume.
+        """
+        with self.changed:
+            pause = self.resume - time.time()
+            self.changed.wait(max(0.0, min(timeout, pause)) if pause > 0 else timeout)
+
+    def notify(self):
+        """
+        Wakes threads blocked in wait.
+        """
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait_sent(self, owner):
+        """
+        Waits until every row written by owner has been ingested, or the outbox is parked
+        and none of them is being sent any more; those are sent once a probe succeeds.
+        """
+        with self.changed:
+            while True:
+                pending = self.conn.execute("SELECT id FROM outbox WHERE owner = ?", (owner,)).fetchall()
+                if not pending or (not self.available and not self.claimed.intersection(row[0] for row in pending)):
+                    return
+                self.changed.wait(1.0)
+
+    def pending(self, owner=None):
+        """
+        Returns the number of entities waiting in the outbox, or those written by owner.
+        """
+        with self.lock:
+            if owner is None:
+                return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
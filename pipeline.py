@@ -0,0 +1,144 @@
+import queue
+import threading
+from vcenter_collector import InventorySnapshot
+from vcenter_fetcher import iter_cluster_data, iter_vm_data
+from data_conversion import cluster_entities, vm_entities
+from ingest_scheduler import IngestScheduler
+from network_index import NetworkIndex
+
+DEFAULT_QUEUE_SIZE = 100
+
+# Marks the end of a stage's output.
+_DONE = object()
+
+# Tells the ingest stage to wait for all clusters to be ingested before sending VMs.
+_FLUSH = object()
+
+
+def _put(q, item, stop):
+    """
+    Puts item on a bounded queue, giving up if the pipeline is stopping.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(si, client, logging, transformer=None, state=None,
+                 page_size=1000, workers=4, queue_size=DEFAULT_QUEUE_SIZE, scheduler=None,
+                 snapshot=None, vcenter=None, scope=None, cache=None, network_index=None):
+    """
+    Streams records from vCenter through conversion into Diode with a thread per stage:
+    fetch -> records queue -> convert -> entities queue -> ingest.
+    VMs are read one PropertyCollector page at a time and both queues are bounded,
+    so memory stays flat and ingest runs while VMs are still being fetched.
+    Clusters are sent first so the convert stage can link VMs to them.
+    The ingest stage feeds scheduler, or a scheduler of its own if none is given.
+    With a SnapshotWriter, the fetch stage also records each record tagged with vcenter.
+    With a Scope, only the inventory in scope is fetched; with a PropertyCache, property
+    groups not due for refresh are served from it. network_index tracks the prefixes already
+    sent; pass the same one to the calls of one run.
+    If the fetch or convert stage fails, what was handed over is still ingested and the
+    failure is raised as a RuntimeError afterwards, so a partial inventory is not reported
+    as a successful sync.
+    :return: (number of cluster records, number of VM records)
+    """
+    records = queue.Queue(maxsize=queue_size)
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    counts = {"cluster": 0, "vm": 0}
+    errors = []
+    network_index = network_index if network_index is not None else NetworkIndex()
+
+    def _fetch():
+        try:
+            inventory = InventorySnapshot.collect(si, logging, page_size, workers, include_vms=False, scope=scope, cache=cache)
+            for cluster in iter_cluster_data(si, logging, inventory, transformer):
+                if snapshot is not None:
+                    snapshot.write("cluster", cluster, vcenter)
+                if not _put(records, ("cluster", cluster), stop):
+                    return
+            for vm in iter_vm_data(si, logging, inventory, transformer, page_size, scope):
+                if snapshot is not None:
+                    snapshot.write("vm", vm, vcenter)
+                if not _put(records, ("vm", vm), stop):
+                    return
+        except Exception as e:
+            logging.error(f"Fetch stage failed: {e}")
+            errors.append(f"fetch stage failed: {e}")
+        finally:
+            _put(records, _DONE, stop)
+
+    def _convert():
+        cluster_cache = {}
+        clusters_done = False
+        try:
+            while True:
+                try:
+                    item = records.get(timeout=1)
+                except queue.Empty:
+                    # The fetch stage gave up handing over _DONE because the pipeline is stopping
+                    if stop.is_set() and not fetch_thread.is_alive():
+                        return
+                    continue
+                if item is _DONE:
+                    break
+                kind, record = item
+                counts[kind] += 1
+                if kind == "cluster":
+                    if not _put(batches, cluster_entities(record, cluster_cache, network_index), stop):
+                        return
+                    continue
+                if not clusters_done:
+                    clusters_done = True
+                    if not _put(batches, _FLUSH, stop):
+                        return
+                if not _put(batches, vm_entities(record, cluster_cache, logging, network_index), stop):
+                    return
+        except Exception as e:
+            logging.error(f"Convert stage failed: {e}")
+            errors.append(f"convert stage failed: {e}")
+            stop.set()
+        finally:
+            _put(batches, _DONE, stop)
+
+    fetch_thread = threading.Thread(target=_fetch, name="pipeline-fetch", daemon=True)
+    convert_thread = threading.Thread(target=_convert, name="pipeline-convert", daemon=True)
+    fetch_thread.start()
+    convert_thread.start()
+
+    # Ingest on the calling thread
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = IngestScheduler(client, logging, state)
+    try:
+        while True:
+            try:
+                entities = batches.get(timeout=1)
+            except queue.Empty:
+                # The convert stage stopped without handing over _DONE
+                if not convert_thread.is_alive():
+                    break
+                continue
+            if entities is _DONE:
+                break
+            if entities is _FLUSH:
+                scheduler.flush()
+                continue
+            scheduler.add(entities)
+        scheduler.flush()
+    finally:
+        stop.set()
+        fetch_thread.join()
+        convert_thread.join()
+        if own_scheduler:
+            scheduler.close()
+
+    if errors:
+        raise RuntimeError("; ".join(errors))
+    logging.info(f"Pipeline processed {counts['cluster']} clusters and {counts['vm']} VMs.")
+    return counts["cluster"], counts["vm"]
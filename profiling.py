@@ -0,0 +1,134 @@
+import os
+import re
+import json
+import time
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+
+def _percentile(samples, fraction):
+    """
+    Returns the sample at the given fraction of a sorted list (nearest rank).
+    """
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))
+    return samples[index]
+
+
+class Profiler:
+    """
+    Collects wall time samples per named phase from any thread.
+    Each sample is one call (one object, page or batch) and may cover several items.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, name, seconds, count=1):
+        """
+        Adds one timing sample to a phase.
+        """
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    @contextmanager
+    def phase(self, name, count=1):
+        """
+        Times the enclosed block as one sample of a phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, count)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as one sample of a phase.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """
+        Returns calls, item count, total seconds and per-call percentiles for each phase.
+        """
+        with self.lock:
+            phases = {name: sorted(samples) for name, samples in self.samples.items()}
+            counts = dict(self.counts)
+        return {
+            name: {
+                "calls": len(samples),
+                "count": counts[name],
+                "total_seconds": round(sum(samples), 6),
+                "p50": round(_percentile(samples, 0.50), 6),
+                "p90": round(_percentile(samples, 0.90), 6),
+                "p99": round(_percentile(samples, 0.99), 6),
+                "max": round(samples[-1], 6),
+            }
+            for name, samples in sorted(phases.items())
+        }
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counts = {}
+
+
+# Shared by all modules and threads of the agent.
+profiler = Profiler()
+
+# Held while a cProfile profiler is active; Python 3.12+ allows only one at a time per process.
+_cprofile_lock = threading.Lock()
+
+
+@contextmanager
+def cprofile(path, name, logging):
+    """
+    Runs the enclosed block under cProfile if path is set and writes the stats to
+    path with name inserted before the extension. cProfile only sees the current thread.
+    Profiled blocks run one at a time, so parallel vCenter syncs are serialized.
+    """
+    if not path:
+        yield
+        return
+    root, ext = os.path.splitext(path)
+    out = f"{root}-{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}{ext or '.prof'}"
+    if not _cprofile_lock.acquire(blocking=False):
+        logging.info(f"Waiting for another profiled sync to finish before profiling {name}...")
+        _cprofile_lock.acquire()
+    try:
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(out)
+            logging.info(f"Wrote cProfile stats to {out}.")
+    finally:
+        _cprofile_lock.release()
+
+
+def write_report(path, report, logging):
+    """
+    Writes a run report as JSON.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        logging.info(f"Wrote run report to {path}.")
+    except Exception as e:
+        logging.error(f"Failed to write run report to {path}: {e}")
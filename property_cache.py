@@ -0,0 +1,153 @@
+import json
+import time
+import threading
+from datetime import datetime
+from pyVmomi import VmomiSupport
+
+
+def property_group(path):
+    """
+    Returns the refresh group of a property path, its first component: "config" for
+    "config.hardware.device", "runtime" for "runtime.powerState". Top-level properties
+    such as name and parent are groups of their own.
+    """
+    return path.split(".", 1)[0]
+
+
+def encode(value):
+    """
+    Converts a property value into JSON-serializable form. Data objects keep their type
+    name and set fields, managed object references their type name and id.
+    """
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return {"_ref": type(value).__name__, "id": value._moId}
+    if isinstance(value, VmomiSupport.DataObject):
+        data = {"_type": type(value).__name__}
+        for prop in value._GetPropertyList():
+            field = getattr(value, prop.name, None)
+            if field is None or (isinstance(field, list) and not field):
+                continue
+            data[prop.name] = encode(field)
+        return data
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, datetime):
+        return {"_datetime": value.isoformat()}
+    return value
+
+
+def decode(value):
+    """
+    Rebuilds a property value from the output of encode. Managed object references are
+    rebuilt without a stub; they are only resolved against the inventory snapshot.
+    """
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if "_ref" in value:
+            return VmomiSupport.GetVmodlType(value["_ref"])(value["id"])
+        if "_datetime" in value:
+            return datetime.fromisoformat(value["_datetime"])
+        obj_type = VmomiSupport.GetVmodlType(value["_type"])
+        return obj_type(**{name: decode(field) for name, field in value.items() if name != "_type"})
+    return value
+
+
+class PropertyCache:
+    """
+    Tiered refresh of VM and host properties. Property groups with a refresh interval
+    (e.g. config and hardware every 6 hours) are retrieved for all objects of a table once
+    their oldest cached copy is older than the interval, and otherwise served from the state
+    store; all other groups (e.g. runtime and guest) are retrieved on every run. Objects
+    without a cached copy, such as new VMs, are retrieved by reference.
+    :param store: StateStore holding the cached properties
+    :param vcenter: vCenter name the cached properties are keyed by
+    :param intervals: dict of property group -> refresh interval in seconds
+    :param refresh_all: retrieve every group on this run, e.g. on full sync runs
+    """
+
+    def __init__(self, store, vcenter, intervals, logging, refresh_all=False):
+        self.store = store
+        self.vcenter = vcenter
+        self.intervals = {group: seconds for group, seconds in intervals.items() if seconds > 0}
+        self.logging = logging
+        self.refresh_all = refresh_all
+        # Property groups served from the cache, decided once per table and run
+        self.plans = {}
+        self.lock = threading.Lock()
+        self.cached = 0
+        self.retrieved = 0
+
+    def plan(self, table, path_set):
+        """
+        Splits a table's property paths into those retrieved on this run and those served
+        from the cache. A group due for refresh has its expired cached copies pruned, so
+        objects that no longer exist leave the cache.
+        :return: (paths to retrieve, paths served from the cache)
+        """
+        with self.lock:
+            if table not in self.plans:
+                now = time.time()
+                cached_groups = set()
+                for group in sorted({property_group(path) for path in path_set} & set(self.intervals)):
+                    expires = now - self.intervals[group]
+                    oldest = self.store.oldest_properties(self.vcenter, table, group)
+                    if self.refresh_all or oldest is None or oldest < expires:
+                        self.logging.info(f"Refreshing {group} properties of {table}.")
+                        self.store.prune_properties(self.vcenter, table, group, expires)
+                    else:
+                        cached_groups.add(group)
+                self.plans[table] = cached_groups
+            cached_groups = self.plans[table]
+        cached = [path for path in path_set if property_group(path) in cached_groups]
+        return [path for path in path_set if path not in cached], cached
+
+    def fill(self, table, objects, paths):
+        """
+        Adds the cached values of the given paths to retrieved property dicts.
+        :param objects: dict of managed object id -> properties
+        :return: ids of the objects that have no cached copy of some of the paths
+        """
+        groups = {property_group(path) for path in paths}
+        if not groups:
+            return []
+        cached = self.store.load_properties(self.vcenter, table, objects)
+        missing = []
+        for moid, props in objects.items():
+            values = cached.get(moid, {})
+            if not groups <= set(values):
+                missing.append(moid)
+                continue
+            for group in groups:
+                props.update({path: decode(value) for path, value in json.loads(values[group]).items()})
+        with self.lock:
+            self.cached += len(objects) - len(missing)
+        return missing
+
+    def save(self, table, objects, paths):
+        """
+        Caches the retrieved values of the paths in groups with a refresh interval.
+        :param objects: dict of managed object id -> properties
+        """
+        groups = {}
+        for path in paths:
+            if property_group(path) in self.intervals:
+                groups.setdefault(property_group(path), []).append(path)
+        if not groups:
+            return
+        rows = [
+            (moid, group, json.dumps({path: encode(props[path]) for path in group_paths if path in props}))
+            for moid, props in objects.items()
+            for group, group_paths in groups.items()
+        ]
+        self.store.save_properties(self.vcenter, table, rows)
+        with self.lock:
+            self.retrieved += len(objects)
+
+    def stats(self):
+        """
+        Returns the number of objects whose cached groups were served from the cache and
+        the number whose groups were retrieved and cached.
+        """
+        with self.lock:
+            return {"cached": self.cached, "retrieved": self.retrieved}
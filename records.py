@@ -0,0 +1,127 @@
+import sys
+from dataclasses import dataclass, field, asdict
+from typing import ClassVar, Optional
+
+
+def _intern_fields(record):
+    """
+    Interns the string fields named in the record's INTERNED tuple; values such as site,
+    cluster and tenant repeat across thousands of records.
+    """
+    for name in record.INTERNED:
+        value = getattr(record, name)
+        if isinstance(value, str):
+            setattr(record, name, sys.intern(value))
+
+
+class Record:
+    """
+    Shared helpers of the fetched inventory records.
+    """
+
+    __slots__ = ()
+
+    INTERNED: ClassVar[tuple] = ()
+
+    def __post_init__(self):
+        _intern_fields(self)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class HostNicRecord(Record):
+    INTERNED: ClassVar[tuple] = ("type", "dvs_name", "portgroup_name")
+
+    type: str
+    name: str
+    mac: Optional[str]
+    ip_addresses: list = field(default_factory=list)  # CIDR strings
+    dvs_name: Optional[str] = None
+    portgroup_name: Optional[str] = None
+    link_speed: Optional[int] = None
+
+
+@dataclass(slots=True)
+class HostRecord(Record):
+    INTERNED: ClassVar[tuple] = ("site", "cluster", "tenant", "model", "vendor")
+
+    name: str
+    site: Optional[str]
+    cluster: Optional[str]
+    tenant: Optional[str]
+    model: Optional[str]
+    vendor: Optional[str]
+    serial_number: Optional[str]
+    nics: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["nics"] = [HostNicRecord(**nic) for nic in data.get("nics", [])]
+        return cls(**data)
+
+
+@dataclass(slots=True)
+class ClusterRecord(Record):
+    INTERNED: ClassVar[tuple] = ("name", "group", "site", "tenant")
+
+    name: str
+    group: Optional[str]
+    site: Optional[str]
+    tenant: Optional[str]
+    hosts: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["hosts"] = [HostRecord.from_dict(host) for host in data.get("hosts", [])]
+        return cls(**data)
+
+
+@dataclass(slots=True)
+class VMInterfaceRecord(Record):
+    name: str
+    mac: Optional[str]
+    enabled: bool
+    ipv4_addresses: list = field(default_factory=list)  # CIDR strings
+    ipv6_addresses: list = field(default_factory=list)  # CIDR strings
+
+
+@dataclass(slots=True)
+class VMDiskRecord(Record):
+    INTERNED: ClassVar[tuple] = ("datastore", "disk_type", "thin_thick")
+
+    name: str
+    capacity: int  # MB
+    datastore: Optional[str]
+    vmdk: Optional[str]
+    disk_type: Optional[str]
+    thin_thick: str
+
+
+@dataclass(slots=True)
+class VMRecord(Record):
+    INTERNED: ClassVar[tuple] = ("status", "site", "cluster", "role", "device", "platform", "tenant")
+
+    name: str
+    status: str
+    site: Optional[str]
+    cluster: Optional[str]
+    role: Optional[str]
+    device: Optional[str]
+    platform: str
+    vcpus: Optional[int]
+    memory: Optional[int]
+    description: Optional[str]
+    tenant: Optional[str]
+    interfaces: list = field(default_factory=list)
+    disks: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["interfaces"] = [VMInterfaceRecord(**nic) for nic in data.get("interfaces", [])]
+        data["disks"] = [VMDiskRecord(**disk) for disk in data.get("disks", [])]
+        return cls(**data)
@@ -0,0 +1,56 @@
+import re
+
+# Selector names, as used under include/exclude in vCenter config files and by the --include-*/--exclude-* options.
+SELECTORS = ("datacenters", "clusters", "folders", "vms")
+
+
+class Scope:
+    """
+    Include/exclude selectors limiting the datacenters, clusters, VM folders and VMs that are synced.
+    Each selector is a list of regexes matched case-insensitively from the start of a datacenter or
+    cluster name, a VM folder path ("/DC1/vm/Production/Web") or a VM name. A value is in scope if it
+    matches an include pattern, or there are none, and matches no exclude pattern.
+    VMs are also left out if skip_vm, e.g. Transformer.should_skip_vm, returns True for their name.
+    """
+
+    def __init__(self, include=None, exclude=None, skip_vm=None):
+        include = include or {}
+        exclude = exclude or {}
+        unknown = (set(include) | set(exclude)) - set(SELECTORS)
+        if unknown:
+            raise ValueError(f"Unknown scope selectors {sorted(unknown)}, expected {', '.join(SELECTORS)}")
+        self.include = {key: [re.compile(pattern, flags=re.IGNORECASE) for pattern in include.get(key) or []] for key in SELECTORS}
+        self.exclude = {key: [re.compile(pattern, flags=re.IGNORECASE) for pattern in exclude.get(key) or []] for key in SELECTORS}
+        self.skip_vm = skip_vm
+
+    def _selected(self, key, value):
+        if value is None:
+            return not self.include[key]
+        if self.include[key] and not any(regex.match(value) for regex in self.include[key]):
+            return False
+        return not any(regex.match(value) for regex in self.exclude[key])
+
+    def filters(self, key):
+        """
+        Returns True if there are include or exclude patterns for the selector.
+        """
+        return bool(self.include[key] or self.exclude[key])
+
+    def filters_vms(self):
+        """
+        Returns True if VMs have to be selected individually, by cluster, folder or name.
+        Skip rules alone do not count: skipped VMs are dropped when their records are built
+        anyway, so retrieving every VM name first would only add round trips.
+        """
+        return self.filters("clusters") or self.filters("folders") or self.filters("vms")
+
+    def datacenter_selected(self, name):
+        return self._selected("datacenters", name)
+
+    def cluster_selected(self, name):
+        return self._selected("clusters", name)
+
+    def vm_selected(self, name, folder_path):
+        if not self._selected("vms", name) or not self._selected("folders", folder_path):
+            return False
+        return not (self.skip_vm is not None and name is not None and self.skip_vm(name))
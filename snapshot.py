@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import sys
+import gzip
+import json
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from version import __version__
+from records import ClusterRecord, VMRecord
+
+# Bumped when the record layout changes incompatibly.
+SNAPSHOT_FORMAT = 2
+
+
+def _open(path, mode):
+    """
+    Opens a snapshot file as text, gzip-compressed if the name ends in .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class SnapshotWriter:
+    """
+    Writes cluster and VM records as JSON lines, one record per line, safe to share
+    between the threads of several vCenter syncs. Lines carry the record kind and
+    the vCenter name, and the first line is a header.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = {"cluster": 0, "vm": 0}
+        self.file = _open(path, "w")
+        self._write({
+            "kind": "header",
+            "format": SNAPSHOT_FORMAT,
+            "version": __version__,
+            "created": datetime.now(timezone.utc).isoformat(),
+        })
+
+    def _write(self, line):
+        self.file.write(json.dumps(line, separators=(",", ":"), default=str) + "\n")
+
+    def write(self, kind, record, vcenter=None):
+        """
+        Appends one ClusterRecord or VMRecord, of kind "cluster" or "vm".
+        """
+        line = {"kind": kind, "vcenter": vcenter, "record": record.to_dict()}
+        with self.lock:
+            self._write(line)
+            self.counts[kind] += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def iter_snapshot(path, kind=None):
+    """
+    Yields (kind, vCenter name, record dict) for each record in a snapshot, optionally only of one kind.
+    """
+    with _open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["kind"] == "header":
+                if entry.get("format") != SNAPSHOT_FORMAT:
+                    raise ValueError(f"{path}: unsupported snapshot format {entry.get('format')}")
+                continue
+            if kind is None or entry["kind"] == kind:
+                yield entry["kind"], entry.get("vcenter"), entry["record"]
+
+
+def replay_snapshot(path, client, logging, state=None, scheduler=None, processes=0):
+    """
+    Converts and ingests the records of a snapshot without connecting to vCenter.
+    Clusters are read and ingested first, then VMs are streamed from a second pass over the file.
+    With processes > 1, VM entities are built on a process pool of that size.
+    :return: (number of cluster records, number of VM records)
+    """
+    # The Diode SDK is only needed to replay, not to diff
+    from data_conversion import prepare_data
+
+    logging.info(f"Replaying snapshot {path}...")
+    clusters = [ClusterRecord.from_dict(record) for _, _, record in iter_snapshot(path, "cluster")]
+    counts = {"vm": 0}
+
+    def _vms():
+        for _, _, record in iter_snapshot(path, "vm"):
+            counts["vm"] += 1
+            yield VMRecord.from_dict(record)
+
+    prepare_data(client, clusters, _vms(), logging, state=state, scheduler=scheduler, processes=processes)
+    logging.info(f"Replayed {len(clusters)} clusters and {counts['vm']} VMs from {path}.")
+    return len(clusters), counts["vm"]
+
+
+def _index(path):
+    return {(kind, vcenter, record.get("name")): record for kind, vcenter, record in iter_snapshot(path)}
+
+
+def diff_snapshots(old_path, new_path):
+    """
+    Compares two snapshots by record kind, vCenter and name.
+    :return: dict with added and removed keys and, for changed records, the fields that differ
+    """
+    old = _index(old_path)
+    new = _index(new_path)
+    changed = {}
+    for key in old.keys() & new.keys():
+        fields = sorted(
+            field for field in old[key].keys() | new[key].keys()
+            if old[key].get(field) != new[key].get(field)
+        )
+        if fields:
+            changed[key] = fields
+    return {
+        "added": sorted(new.keys() - old.keys(), key=str),
+        "removed": sorted(old.keys() - new.keys(), key=str),
+        "changed": dict(sorted(changed.items(), key=lambda item: str(item[0]))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two vCenter agent snapshots")
+    parser.add_argument("old", help="Earlier snapshot file")
+    parser.add_argument("new", help="Later snapshot file")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s - %(message)s")
+
+    diff = diff_snapshots(args.old, args.new)
+    for kind, vcenter, name in diff["added"]:
+        print(f"+ {kind} {name} ({vcenter})")
+    for kind, vcenter, name in diff["removed"]:
+        print(f"- {kind} {name} ({vcenter})")
+    for (kind, vcenter, name), fields in diff["changed"].items():
+        print(f"~ {kind} {name} ({vcenter}): {', '.join(fields)}")
+    logging.info(
+        f"{len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['changed'])} changed."
+    )
+    sys.exit(1 if any(diff.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Fields forming the natural key of each entity type, as dotted paths into the protobuf message.
+# Fields the installed SDK does not have, or that are not set, count as empty.
+# An address can be on several interfaces, so IPs are keyed by the interface they are
+# assigned to as well; VM addresses are not assigned, their description names the VM and NIC.
+KEY_FIELDS = {
+    "cluster": ("name",),
+    "device": ("site.name", "name"),
+    "interface": ("device.site.name", "device.name", "name"),
+    "ip_address": (
+        "address",
+        "interface.device.name",
+        "interface.name",
+        "assigned_object_interface.device.name",
+        "assigned_object_interface.name",
+        "assigned_object_vm_interface.virtual_machine.name",
+        "assigned_object_vm_interface.name",
+        "description",
+    ),
+    "prefix": ("prefix",),
+    "virtual_machine": ("cluster.name", "name"),
+    "vminterface": ("virtual_machine.cluster.name", "virtual_machine.name", "name"),
+    "vm_interface": ("virtual_machine.cluster.name", "virtual_machine.name", "name"),
+    "virtual_disk": ("virtual_machine.cluster.name", "virtual_machine.name", "name"),
+}
+
+
+def _field(message, path):
+    for name in path.split("."):
+        if name not in message.DESCRIPTOR.fields_by_name:
+            return ""
+        message = getattr(message, name)
+    return str(message)
+
+
+def entity_hash(entity):
+    """
+    Returns (entity type, natural key, content hash) for a Diode Entity.
+    Only the wrapped message is hashed; the Entity timestamp changes on every run.
+    """
+    entity_type = entity.WhichOneof("entity")
+    message = getattr(entity, entity_type)
+    content = message.SerializeToString(deterministic=True)
+    digest = hashlib.sha256(content).hexdigest()
+    fields = KEY_FIELDS.get(entity_type)
+    key = "/".join(_field(message, path) for path in fields) if fields else digest
+    return entity_type, key, digest
+
+
+class StateStore:
+    """
+    SQLite store of the content hash of every entity ingested in previous runs,
+    keyed by entity type and natural key, used to skip unchanged entities.
+    It also holds the slowly changing vCenter properties cached by PropertyCache.
+    """
+
+    def __init__(self, path, full_sync_every=0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.full_sync_every = full_sync_every
+        self.full_sync = False
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entity_hashes (
+                entity_type TEXT NOT NULL,
+                entity_key TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (entity_type, entity_key)
+            );
+            CREATE TABLE IF NOT EXISTS property_cache (
+                vcenter TEXT NOT NULL,
+                obj_table TEXT NOT NULL,
+                moid TEXT NOT NULL,
+                property_group TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (vcenter, obj_table, moid, property_group)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self.skipped = 0
+        self.sent = 0
+
+    def start_run(self, logging):
+        """
+        Counts a run and decides whether it resends everything.
+        Every full_sync_every-th run (and the first run) is a full sync.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'runs'").fetchone()
+            runs = int(row[0]) + 1 if row else 1
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('runs', ?)", (str(runs),))
+            self.conn.commit()
+        self.full_sync = runs == 1 or (self.full_sync_every > 0 and runs % self.full_sync_every == 0)
+        if self.full_sync:
+            logging.info(f"Run {runs}: sending all entities.")
+        else:
+            logging.info(f"Run {runs}: sending only new or changed entities.")
+        return self.full_sync
+
+    def filter_changed(self, entities, full_sync=None):
+        """
+        Splits out entities whose content hash differs from the stored one.
+        :param full_sync: True to send every entity, None to follow this run's decision
+        :return: (entities to send, hashes to record once they are ingested)
+        """
+        pending = [entity_hash(entity) for entity in entities]
+        if self.full_sync if full_sync is None else full_sync:
+            self.sent += len(entities)
+            return list(entities), pending
+
+        with self.lock:
+            changed = []
+            changed_hashes = []
+            for entity, (entity_type, key, digest) in zip(entities, pending):
+                row = self.conn.execute(
+                    "SELECT hash FROM entity_hashes WHERE entity_type = ? AND entity_key = ?",
+                    (entity_type, key),
+                ).fetchone()
+                if row and row[0] == digest:
+                    self.skipped += 1
+                    continue
+                changed.append(entity)
+                changed_hashes.append((entity_type, key, digest))
+        self.sent += len(changed)
+        return changed, changed_hashes
+
+    def commit(self, hashes):
+        """
+        Records the hashes of successfully ingested entities.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entity_hashes (entity_type, entity_key, hash, updated) VALUES (?, ?, ?, ?)",
+                [(entity_type, key, digest, now) for entity_type, key, digest in hashes],
+            )
+            self.conn.commit()
+
+    def oldest_properties(self, vcenter, table, group):
+        """
+        Returns when the least recently retrieved cached property group of a table was
+        retrieved, or None if none is cached.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(updated) FROM property_cache WHERE vcenter = ? AND obj_table = ? AND property_group = ?",
+                (vcenter, table, group),
+            ).fetchone()
+        return row[0] if row else None
+
+    def prune_properties(self, vcenter, table, group, before):
+        """
+        Deletes the cached property groups retrieved before the given time.
+        """
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM property_cache WHERE vcenter = ? AND obj_table = ? AND property_group = ? AND updated < ?",
+                (vcenter, table, group, before),
+            )
+            self.conn.commit()
+
+    def load_properties(self, vcenter, table, moids):
+        """
+        Returns the cached property groups of the given managed object ids.
+        :return: dict of managed object id -> {property group: JSON value}
+        """
+        cached = {}
+        moids = list(moids)
+        with self.lock:
+            # Stay below SQLite's limit on bound parameters
+            for start in range(0, len(moids), 500):
+                chunk = moids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT moid, property_group, value FROM property_cache WHERE vcenter = ? AND obj_table = ? "
+                    f"AND moid IN ({', '.join('?' * len(chunk))})",
+                    (vcenter, table, *chunk),
+                )
+                for moid, group, value in rows:
+                    cached.setdefault(moid, {})[group] = value
+        return cached
+
+    def save_properties(self, vcenter, table, rows):
+        """
+        Stores (managed object id, property group, JSON value) rows retrieved now.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO property_cache (vcenter, obj_table, moid, property_group, value, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(vcenter, table, moid, group, value, now) for moid, group, value in rows],
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
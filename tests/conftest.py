@@ -0,0 +1,80 @@
+import os
+import argparse
+import sys
+import logging
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_vcenter
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    """
+    Runs each test from the repository root, where the agent finds its rule files.
+    """
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(scope="session")
+def inventory():
+    return mock_vcenter.generate_inventory(datacenters=2, hosts=16, vms=300, seed=1)
+
+
+@pytest.fixture
+def vcenter(inventory):
+    return mock_vcenter.MockVCenter(inventory)
+
+
+@pytest.fixture
+def log():
+    return logging.getLogger("tests")
+
+
+class NoKeepAlive:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture
+def sync_args():
+    """
+    Returns a factory of the parsed options vcenter_sync expects, for a default mode sync
+    unless overridden.
+    """
+    from scope import SELECTORS
+
+    def _args(**kwargs):
+        args = dict(
+            daemon=False, async_mode=False, pipeline=False, profile=None, session_cache=None, keepalive_interval=0,
+            refresh_intervals={}, page_size=50, fetch_workers=2, fetch_concurrency=2, ingest_workers=2,
+            batch_size=500, ingest_retries=0, queue_size=10, convert_processes=0,
+        )
+        args.update({f"include_{key}": [] for key in SELECTORS})
+        args.update({f"exclude_{key}": [] for key in SELECTORS})
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    return _args
+
+
+@pytest.fixture
+def connected(vcenter, monkeypatch):
+    """
+    Makes vcenter_sync connect to the mock vCenter, and returns its config entry.
+    """
+    import vcenter_sync
+
+    monkeypatch.setattr(vcenter_sync, "connect_to_vcenter", lambda *args: vcenter)
+    monkeypatch.setattr(vcenter_sync, "disconnect_vcenter", lambda *args, **kwargs: None)
+    monkeypatch.setattr(vcenter_sync, "SessionKeepAlive", NoKeepAlive)
+    return {"name": "vc1", "host": "vc1", "user": "user", "password": "password", "verify": False, "rules": {}, "scope": {}}
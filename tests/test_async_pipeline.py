@@ -0,0 +1,70 @@
+import pytest
+from netboxlabs.diode.sdk.ingester import Entity, IPAddress
+
+import async_pipeline
+import vcenter_sync
+from mock_vcenter import FakeDiodeClient
+from outbox import Outbox
+
+
+iter_vm_properties = async_pipeline.iter_vm_properties
+
+
+def _broken_vm_properties(*args, **kwargs):
+    for index, vm in enumerate(iter_vm_properties(*args, **kwargs)):
+        if index == 10:
+            raise RuntimeError("connection lost")
+        yield vm
+
+
+def test_streams_every_record(vcenter, log):
+    client = FakeDiodeClient()
+    clusters, vms, ingest = async_pipeline.run_async_pipeline(vcenter, client, log, page_size=50)
+    assert (clusters, vms) == (2, 273)
+    assert ingest["ingested"] == client.entities > 0
+
+
+def test_fetch_failure_fails_the_sync(vcenter, log, monkeypatch):
+    monkeypatch.setattr(async_pipeline, "iter_vm_properties", _broken_vm_properties)
+    client = FakeDiodeClient()
+    with pytest.raises(RuntimeError, match="fetch stage failed for datacenter DC00: connection lost"):
+        async_pipeline.run_async_pipeline(vcenter, client, log, page_size=5)
+    # What was fetched before the failure is still ingested
+    assert client.entities > 0
+
+
+def test_failed_async_sync_is_reported(connected, sync_args, monkeypatch):
+    monkeypatch.setattr(async_pipeline, "iter_vm_properties", _broken_vm_properties)
+    result = vcenter_sync._sync_vcenter(connected, FakeDiodeClient(), sync_args(async_mode=True, page_size=5))
+    assert not result["ok"]
+    assert "connection lost" in result["error"]
+
+
+def test_async_mode_sends_through_its_own_ingester_only(connected, sync_args, monkeypatch, tmp_path):
+    def no_scheduler(*args, **kwargs):
+        raise AssertionError("an IngestScheduler would also drain the outbox")
+
+    monkeypatch.setattr(vcenter_sync, "IngestScheduler", no_scheduler)
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    client = FakeDiodeClient()
+    result = vcenter_sync._sync_vcenter(connected, client, sync_args(async_mode=True), outbox=outbox)
+    assert result["ok"]
+    assert result["ingest"]["ingested"] == client.entities > 0
+    assert outbox.pending() == 0
+    outbox.close()
+
+
+def test_async_mode_replays_entities_left_by_earlier_runs(connected, sync_args, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.put([Entity(ip_address=IPAddress(address="192.0.2.1", description="left over"))])
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert outbox.replayed == 1
+    client = FakeDiodeClient()
+    result = vcenter_sync._sync_vcenter(connected, client, sync_args(async_mode=True), outbox=outbox)
+    assert result["ok"]
+    assert outbox.pending() == 0
+    assert result["ingest"]["ingested"] == client.entities
+    outbox.close()
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+
+from data_conversion import cluster_entities, convert_vms, vm_entities
+from network_index import NetworkIndex
+from vcenter_collector import InventorySnapshot
+from vcenter_fetcher import fetch_cluster_data, fetch_vm_data
+
+
+def test_vm_ips_keep_the_bare_address_and_still_yield_prefixes(vcenter, log):
+    entities = []
+    network_index = NetworkIndex()
+    for vm in fetch_vm_data(vcenter, log)[:20]:
+        entities += vm_entities(vm, {}, log, network_index)
+    addresses = [entity.ip_address.address for entity in entities if entity.WhichOneof("entity") == "ip_address"]
+    prefixes = [entity.prefix.prefix for entity in entities if entity.WhichOneof("entity") == "prefix"]
+    assert addresses and all("/" not in address for address in addresses)
+    assert prefixes and all("/" in prefix for prefix in prefixes)
+
+
+def test_process_pool_matches_in_process_conversion(vcenter, log):
+    inventory = InventorySnapshot.collect(vcenter, log)
+    clusters = fetch_cluster_data(vcenter, log, inventory)
+    vms = fetch_vm_data(vcenter, log, inventory)
+
+    def convert(processes):
+        cluster_cache, network_index = {}, NetworkIndex()
+        for cluster in clusters:
+            cluster_entities(cluster, cluster_cache, network_index)
+        return [
+            [entity.SerializeToString() for entity in entities]
+            for entities in convert_vms(vms, cluster_cache, log, network_index, processes, chunk_size=20)
+        ]
+
+    in_process = [data for entities in convert(0) for data in entities]
+    pooled = [data for entities in convert(2) for data in entities]
+    assert pooled == in_process
+
+
+def test_convert_processes_are_rejected_with_streaming_modes():
+    result = subprocess.run(
+        [sys.executable, "diode-vcenter.py", "--pipeline", "true", "--convert-processes", "2",
+         "--dry-run", "true", "--vcenter-host", "vc", "--vcenter-user", "user", "--vcenter-password", "password"],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 2
+    assert "--convert-processes cannot be combined with --pipeline" in result.stderr
@@ -0,0 +1,102 @@
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import delta_sync
+from data_conversion import REMOVED_STATUS
+from mock_vcenter import FakeDiodeClient
+from scope import Scope
+from vcenter_collector import InventorySnapshot
+
+
+def _update(ref, kind, **props):
+    changes = [SimpleNamespace(name=name, op="assign", val=value) for name, value in props.items()]
+    return SimpleNamespace(filterSet=[SimpleNamespace(objectSet=[SimpleNamespace(obj=ref, kind=kind, changeSet=changes)])])
+
+
+def _first(table, name_prefix=""):
+    return next(props for props in table.values() if (props.get("name") or "").startswith(name_prefix))
+
+
+def test_removed_vms_and_hosts_are_decommissioned(vcenter, log):
+    inventory = InventorySnapshot.collect(vcenter, log)
+    vm = _first(inventory.vms)
+    cluster_name = delta_sync._vm_cluster(inventory, vm)["name"]
+    host = next(props for props in inventory.hosts.values() if props["obj"] != vm["runtime.host"])
+
+    changes = delta_sync._merge_changes(inventory, [_update(vm["obj"], "leave"), _update(host["obj"], "leave")])
+    assert delta_sync.affected_records(inventory, changes, log) == ([], [])
+    entities = delta_sync.removed_records(inventory, inventory.pop_departed(), log)
+
+    vms = [entity.virtual_machine for entity in entities if entity.WhichOneof("entity") == "virtual_machine"]
+    devices = [entity.device for entity in entities if entity.WhichOneof("entity") == "device"]
+    assert [(vm_entity.name, vm_entity.cluster.name, vm_entity.status) for vm_entity in vms] == [
+        (vm["name"], cluster_name, REMOVED_STATUS)
+    ]
+    assert [(device.name, device.status) for device in devices] == [(host["name"], REMOVED_STATUS)]
+    assert inventory.pop_departed() == {}
+
+
+def test_renamed_datacenter_re_emits_its_clusters(vcenter, log):
+    inventory = InventorySnapshot.collect(vcenter, log)
+    datacenter = _first(inventory.datacenters, "DC00")
+    changes = delta_sync._merge_changes(inventory, [_update(datacenter["obj"], "modify", name="Campus")])
+    clusters, vms = delta_sync.affected_records(inventory, changes, log)
+    assert clusters and all(cluster.name.startswith("DC00-") and cluster.group == "Campus" for cluster in clusters)
+    assert vms == []
+
+
+def test_scope_limits_what_is_ingested(vcenter, log):
+    inventory = InventorySnapshot.collect(vcenter, log)
+    all_clusters, all_vms = delta_sync.all_records(inventory, log)
+    clusters, vms = delta_sync.all_records(inventory, log, scope=Scope({"datacenters": ["DC00"]}))
+    assert clusters and all(cluster.name.startswith("DC00-") for cluster in clusters)
+    assert vms and all(vm.cluster.startswith("DC00-") for vm in vms)
+    assert len(vms) < len(all_vms)
+
+    outside = next(vm for vm in inventory.vms.values() if delta_sync._vm_cluster(inventory, vm)["name"].startswith("DC01-"))
+    delta_sync._merge_changes(inventory, [_update(outside["obj"], "leave")])
+    assert delta_sync.removed_records(inventory, inventory.pop_departed(), log, scope=Scope({"datacenters": ["DC00"]})) == []
+
+
+def test_refresh_intervals_are_rejected_in_daemon_mode(tmp_path):
+    result = subprocess.run(
+        [sys.executable, "diode-vcenter.py", "--daemon", "true", "--refresh-intervals", "config=3600",
+         "--dry-run", "true", "--snapshot-in", str(tmp_path / "missing.jsonl")],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 2
+    assert "--refresh-intervals cannot be combined with --daemon" in result.stderr
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_failed_re_subscription_is_retried(vcenter, log, monkeypatch):
+    # vCenter drops the first subscription and is still down when it is re-subscribed
+    outcomes = iter([None, RuntimeError("vCenter unreachable"), None])
+    subscriptions = []
+
+    class FlakyWatcher:
+        def __init__(self, si, logging, max_wait_seconds):
+            error = next(outcomes)
+            if error is not None:
+                raise error
+            subscriptions.append(self)
+
+        def wait(self):
+            if len(subscriptions) == 1:
+                raise RuntimeError("connection lost")
+            raise Stop()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(delta_sync, "InventoryWatcher", FlakyWatcher)
+    monkeypatch.setattr(delta_sync, "RETRY_DELAY", 0)
+    with pytest.raises(Stop):
+        delta_sync.run_delta_sync(vcenter, FakeDiodeClient(), log)
+    assert len(subscriptions) == 2
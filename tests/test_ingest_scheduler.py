@@ -0,0 +1,62 @@
+from netboxlabs.diode.sdk.ingester import Entity, IPAddress
+
+from ingest_scheduler import IngestScheduler, MIN_BATCH_ENTITIES
+from mock_vcenter import FakeDiodeClient
+
+
+def _addresses(count):
+    return [Entity(ip_address=IPAddress(address=f"10.0.{n // 256}.{n % 256}", description=f"vm{n} eth0")) for n in range(count)]
+
+
+class RecordingDiodeClient(FakeDiodeClient):
+    def __init__(self, latency=0.0, failures=0):
+        super().__init__(latency)
+        self.failures = failures
+        self.batches = []
+
+    def ingest(self, entities):
+        with self.lock:
+            self.batches.append([entity.ByteSize() for entity in entities])
+            self.failures -= 1
+            if self.failures >= 0:
+                raise RuntimeError("unavailable")
+        return super().ingest(entities)
+
+
+def test_fast_batches_grow_the_batch_size(log):
+    scheduler = IngestScheduler(RecordingDiodeClient(), log, max_in_flight=1, max_batch_entities=1000)
+    start = scheduler.stats()["batch_entities"]
+    scheduler.add(_addresses(start))
+    scheduler.close()
+    assert scheduler.stats()["batch_entities"] == start + MIN_BATCH_ENTITIES
+
+
+def test_slow_batches_shrink_the_batch_size(log):
+    client = RecordingDiodeClient(latency=0.05)
+    scheduler = IngestScheduler(client, log, max_in_flight=1, max_batch_entities=1000, target_latency=0.01)
+    start = scheduler.stats()["batch_entities"]
+    scheduler.add(_addresses(start))
+    scheduler.close()
+    assert scheduler.stats()["batch_entities"] == start // 2
+
+
+def test_byte_cap_splits_batches(log):
+    entities = _addresses(10)
+    cap = sum(entity.ByteSize() for entity in entities[:3])
+    client = RecordingDiodeClient()
+    scheduler = IngestScheduler(client, log, max_batch_entities=1000, max_batch_bytes=cap)
+    scheduler.add(entities)
+    scheduler.close()
+    assert len(client.batches) == 4
+    assert all(sum(sizes) <= cap for sizes in client.batches)
+    assert client.entities == 10
+
+
+def test_retries_stop_at_max_retries(log):
+    client = RecordingDiodeClient(failures=10)
+    scheduler = IngestScheduler(client, log, max_retries=2, backoff=0.001)
+    scheduler.add(_addresses(5))
+    scheduler.close()
+    assert len(client.batches) == 3
+    stats = scheduler.stats()
+    assert (stats["retries"], stats["failed"], stats["ingested"]) == (2, 1, 0)
@@ -0,0 +1,32 @@
+import data_conversion
+import mock_vcenter
+import vcenter_fetcher
+from mock_vcenter import FakeDiodeClient, MockVCenter
+from vcenter_collector import InventorySnapshot
+
+
+def _names(objects):
+    return [props["name"] for _, props, _ in objects]
+
+
+def test_inventory_is_reproducible(inventory):
+    again = mock_vcenter.generate_inventory(datacenters=2, hosts=16, vms=300, seed=1)
+    assert _names(again) == _names(inventory)
+
+
+def test_pages_count_as_round_trips(inventory, log):
+    whole = MockVCenter(inventory)
+    InventorySnapshot.collect(whole, log, page_size=10000)
+    paged = MockVCenter(inventory)
+    InventorySnapshot.collect(paged, log, page_size=50)
+    assert paged.round_trips > whole.round_trips
+
+
+def test_fetched_inventory_is_converted_and_ingested(vcenter, log):
+    snapshot = InventorySnapshot.collect(vcenter, log)
+    clusters = vcenter_fetcher.fetch_cluster_data(vcenter, log, snapshot)
+    vms = vcenter_fetcher.fetch_vm_data(vcenter, log, snapshot)
+    client = FakeDiodeClient()
+    data_conversion.prepare_data(client, clusters, vms, log)
+    assert len(clusters) == 2
+    assert client.calls > 0 and client.entities > len(vms)
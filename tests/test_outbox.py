@@ -0,0 +1,107 @@
+import time
+
+from netboxlabs.diode.sdk.ingester import Entity, IPAddress
+
+import data_conversion
+import vcenter_fetcher
+from ingest_scheduler import IngestScheduler
+from mock_vcenter import FakeDiodeClient
+from outbox import Outbox
+from vcenter_collector import InventorySnapshot
+
+
+def _address(description, status="active"):
+    return Entity(ip_address=IPAddress(address="10.0.0.1/24", description=description, status=status))
+
+
+def test_addresses_shared_by_vms_are_kept(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    ids = outbox.put([_address("vm1 eth0"), _address("vm2 eth0")])
+    assert len(ids) == 2
+    assert outbox.pending() == 2
+    outbox.close()
+
+
+def test_newer_version_replaces_pending_entity(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    outbox.put([_address("vm1 eth0"), _address("vm2 eth0")])
+    outbox.put([_address("vm1 eth0", status="deprecated")])
+    rows = outbox.claim(10, 1 << 20)
+    assert [entity.ip_address.status for entity in outbox.entities(rows)] == ["active", "deprecated"]
+    outbox.close()
+
+
+def test_unsent_entities_are_replayed_by_the_next_run(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path)
+    outbox.put([_address("vm1 eth0"), _address("vm2 eth0")])
+    rows = outbox.claim(1, 1 << 20)
+    outbox.done([row[0] for row in rows])
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert outbox.replayed == 1
+    assert [entity.ip_address.description for entity in outbox.entities(outbox.claim(10, 1 << 20))] == ["vm2 eth0"]
+    outbox.close()
+
+
+class UnavailableDiodeClient(FakeDiodeClient):
+    def ingest(self, entities):
+        raise RuntimeError("unavailable")
+
+
+def test_entities_survive_an_unavailable_diode(vcenter, log, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    inventory = InventorySnapshot.collect(vcenter, log)
+    clusters = vcenter_fetcher.fetch_cluster_data(vcenter, log, inventory)
+    vms = vcenter_fetcher.fetch_vm_data(vcenter, log, inventory)
+
+    outbox = Outbox(path)
+    client = UnavailableDiodeClient()
+    scheduler = IngestScheduler(client, log, max_retries=1, backoff=0.01, outbox=outbox)
+    data_conversion.prepare_data(client, clusters, vms, log, scheduler=scheduler)
+    scheduler.close()
+    pending = outbox.pending()
+    outbox.close()
+    assert pending > 0
+
+    outbox = Outbox(path)
+    client = FakeDiodeClient()
+    scheduler = IngestScheduler(client, log, backoff=0.01, outbox=outbox)
+    scheduler.flush()
+    scheduler.close()
+    assert client.entities == pending
+    assert outbox.pending() == 0
+    outbox.close()
+
+
+class RecoveringDiodeClient(FakeDiodeClient):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def ingest(self, entities):
+        with self.lock:
+            self.failures -= 1
+            if self.failures >= 0:
+                raise RuntimeError("unavailable")
+        return super().ingest(entities)
+
+
+def test_parked_outbox_resumes_once_diode_recovers(log, tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    client = RecoveringDiodeClient(failures=5)
+    scheduler = IngestScheduler(client, log, max_in_flight=1, max_batch_entities=2, max_retries=1, backoff=0.01, outbox=outbox)
+    scheduler.add([_address(f"vm{n} eth0") for n in range(4)])
+    # Returns once the retries are used up and the outbox is parked
+    scheduler.flush()
+    assert not outbox.available
+
+    deadline = time.time() + 10
+    while outbox.pending() and time.time() < deadline:
+        outbox.wait(0.1)
+    scheduler.close()
+    assert outbox.available
+    assert outbox.pending() == 0
+    assert client.entities == 4
+    outbox.close()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+import pipeline
+from mock_vcenter import FakeDiodeClient
+
+
+class FailingScheduler:
+    def add(self, entities):
+        raise RuntimeError("ingest failed")
+
+    def flush(self):
+        pass
+
+
+def _slow(iterate, delay):
+    def wrapper(*args, **kwargs):
+        for record in iterate(*args, **kwargs):
+            time.sleep(delay)
+            yield record
+    return wrapper
+
+
+def _run_in_thread(target):
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = target()
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "pipeline did not shut down"
+    return outcome
+
+
+def test_streams_every_record(vcenter, log):
+    client = FakeDiodeClient()
+    clusters, vms = pipeline.run_pipeline(vcenter, client, log, page_size=50, queue_size=4)
+    assert (clusters, vms) == (2, 273)
+    assert client.entities > 0
+
+
+def test_ingest_failure_stops_every_stage(vcenter, log, monkeypatch):
+    # A slow fetch stage leaves the convert stage waiting for records when ingest fails
+    monkeypatch.setattr(pipeline, "iter_vm_data", _slow(pipeline.iter_vm_data, 0.01))
+    outcome = _run_in_thread(lambda: pipeline.run_pipeline(
+        vcenter, FakeDiodeClient(), log, page_size=50, scheduler=FailingScheduler(),
+    ))
+    assert str(outcome["error"]) == "ingest failed"
+
+
+def test_fetch_failure_fails_the_sync(vcenter, log, monkeypatch):
+    iter_vm_data = pipeline.iter_vm_data
+
+    def broken(*args, **kwargs):
+        for index, vm in enumerate(iter_vm_data(*args, **kwargs)):
+            if index == 10:
+                raise RuntimeError("connection lost")
+            yield vm
+
+    monkeypatch.setattr(pipeline, "iter_vm_data", broken)
+    client = FakeDiodeClient()
+    with pytest.raises(RuntimeError, match="fetch stage failed: connection lost"):
+        pipeline.run_pipeline(vcenter, client, log, page_size=50)
+    # What was fetched before the failure is still ingested
+    assert client.entities > 0
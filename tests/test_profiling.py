@@ -0,0 +1,41 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+from profiling import cprofile
+
+
+def test_profiled_blocks_run_one_at_a_time(tmp_path):
+    lock = threading.Lock()
+    active = []
+    overlaps = []
+
+    def sync(name):
+        with cprofile(str(tmp_path / "sync.prof"), name, logging):
+            with lock:
+                active.append(name)
+                overlaps.append(len(active) > 1)
+            sum(range(100000))
+            with lock:
+                active.remove(name)
+
+    threads = [threading.Thread(target=sync, args=(f"vc{index}",)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not any(overlaps)
+    assert sorted(os.listdir(tmp_path)) == [f"sync-vc{index}.prof" for index in range(4)]
+
+
+def test_profile_is_rejected_in_daemon_mode(tmp_path):
+    result = subprocess.run(
+        [sys.executable, "diode-vcenter.py", "--daemon", "true", "--profile", str(tmp_path / "sync.prof"),
+         "--dry-run", "true", "--snapshot-in", str(tmp_path / "missing.jsonl")],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 2
+    assert "--profile cannot be combined with --daemon" in result.stderr
@@ -0,0 +1,88 @@
+import time
+
+import vcenter_fetcher
+from mock_vcenter import MockVCenter
+from property_cache import PropertyCache, decode, encode
+from state_store import StateStore
+from vcenter_collector import InventorySnapshot
+
+INTERVALS = {"config": 3600, "hardware": 3600, "summary": 3600}
+
+
+def _fetch(inventory, log, cache=None):
+    vcenter = MockVCenter(inventory)
+    snapshot = InventorySnapshot.collect(vcenter, log, page_size=100, cache=cache)
+    vms = [vm.to_dict() for vm in vcenter_fetcher.fetch_vm_data(vcenter, log, snapshot)]
+    clusters = [cluster.to_dict() for cluster in vcenter_fetcher.fetch_cluster_data(vcenter, log, snapshot)]
+    return vms, clusters, vcenter.values
+
+
+def test_values_survive_encoding(inventory):
+    for _, props, _ in inventory[:200]:
+        for value in props.values():
+            assert encode(decode(encode(value))) == encode(value)
+
+
+def test_cached_run_builds_the_same_records(inventory, log, tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    expected_vms, expected_clusters, uncached_values = _fetch(inventory, log)
+
+    first = PropertyCache(state, "vc", INTERVALS, log)
+    assert _fetch(inventory, log, first)[:2] == (expected_vms, expected_clusters)
+    assert first.stats()["cached"] == 0
+
+    second = PropertyCache(state, "vc", INTERVALS, log)
+    vms, clusters, values = _fetch(inventory, log, second)
+    assert (vms, clusters) == (expected_vms, expected_clusters)
+    assert second.stats()["cached"] > 0
+    assert values < uncached_values
+    state.close()
+
+
+def test_objects_without_cached_copy_are_retrieved(inventory, log, tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    expected = _fetch(inventory, log)[:2]
+    _fetch(inventory, log, PropertyCache(state, "vc", INTERVALS, log))
+    state.conn.execute("DELETE FROM property_cache WHERE moid IN ('vm-1', 'vm-2')")
+    state.conn.commit()
+    cache = PropertyCache(state, "vc", INTERVALS, log)
+    assert _fetch(inventory, log, cache)[:2] == expected
+    assert cache.stats()["retrieved"] == 2
+    state.close()
+
+
+def test_expired_groups_are_refreshed(inventory, log, tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    _fetch(inventory, log, PropertyCache(state, "vc", INTERVALS, log))
+    state.conn.execute("UPDATE property_cache SET updated = ? WHERE property_group = 'config'", (time.time() - 7200,))
+    state.conn.commit()
+    cache = PropertyCache(state, "vc", INTERVALS, log)
+    retrieve, cached = cache.plan("vms", ["name", "config.hardware.device", "summary.storage"])
+    assert "config.hardware.device" in retrieve
+    assert cached == ["summary.storage"]
+    state.close()
+
+
+class RecordingVCenter(MockVCenter):
+    def __init__(self, objects):
+        super().__init__(objects)
+        self.paths = set()
+
+    def RetrievePropertiesEx(self, specSet, options):
+        for prop_spec in specSet[0].propSet:
+            self.paths.update(prop_spec.pathSet)
+        return super().RetrievePropertiesEx(specSet, options)
+
+
+def test_groups_not_due_are_not_requested(inventory, log, tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    first = RecordingVCenter(inventory)
+    InventorySnapshot.collect(first, log, page_size=100, cache=PropertyCache(state, "vc", INTERVALS, log))
+
+    second = RecordingVCenter(inventory)
+    InventorySnapshot.collect(second, log, page_size=100, cache=PropertyCache(state, "vc", INTERVALS, log))
+    assert {path.split(".")[0] for path in first.paths} >= set(INTERVALS)
+    assert not {path.split(".")[0] for path in second.paths} & set(INTERVALS)
+    # Payload, not calls: every page is still retrieved
+    assert second.round_trips == first.round_trips
+    state.close()
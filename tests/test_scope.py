@@ -0,0 +1,46 @@
+import pytest
+
+import vcenter_fetcher
+from mock_vcenter import MockVCenter
+from scope import Scope
+from vcenter_collector import InventorySnapshot
+
+
+def _fetch(inventory, log, scope=None):
+    vcenter = MockVCenter(inventory)
+    snapshot = InventorySnapshot.collect(vcenter, log, page_size=100, include_vms=False, scope=scope)
+    clusters = vcenter_fetcher.fetch_cluster_data(vcenter, log, snapshot)
+    vms = list(vcenter_fetcher.iter_vm_data(vcenter, log, snapshot, page_size=100, scope=scope))
+    return clusters, vms, vcenter.values
+
+
+def test_datacenters_out_of_scope_are_not_retrieved(inventory, log):
+    all_clusters, all_vms, all_values = _fetch(inventory, log)
+    clusters, vms, values = _fetch(inventory, log, Scope({"datacenters": ["DC00"]}))
+    assert clusters and all(cluster.name.startswith("DC00-") for cluster in clusters)
+    assert vms and all(vm.cluster.startswith("DC00-") for vm in vms)
+    assert len(vms) < len(all_vms)
+    assert values < all_values
+
+
+def test_heavy_vm_properties_are_retrieved_only_for_selected_vms(inventory, log):
+    _, all_vms, all_values = _fetch(inventory, log)
+    _, vms, values = _fetch(inventory, log, Scope({"vms": ["web"]}))
+    web_vms = [vm for vm in all_vms if vm.name.startswith("web")]
+    assert [vm.name for vm in vms] == [vm.name for vm in web_vms]
+    assert [vm.to_dict() for vm in vms] == [vm.to_dict() for vm in web_vms]
+    assert values < all_values * 0.5
+
+
+def test_unknown_selector_is_rejected():
+    with pytest.raises(ValueError):
+        Scope({"hosts": ["esx01"]})
+
+
+def test_skip_rules_alone_retrieve_vms_in_one_pass(inventory, log):
+    _, all_vms, all_values = _fetch(inventory, log)
+    scope = Scope(skip_vm=vcenter_fetcher.default_transformer().should_skip_vm)
+    assert not scope.filters_vms()
+    _, vms, values = _fetch(inventory, log, scope)
+    assert [vm.name for vm in vms] == [vm.name for vm in all_vms]
+    assert values == all_values
@@ -0,0 +1,66 @@
+import data_conversion
+import vcenter_fetcher
+from ingest_scheduler import IngestScheduler
+from mock_vcenter import FakeDiodeClient
+from state_store import StateStore, entity_hash
+from vcenter_collector import InventorySnapshot
+
+
+def _sync(vcenter, log, state):
+    inventory = InventorySnapshot.collect(vcenter, log)
+    clusters = vcenter_fetcher.fetch_cluster_data(vcenter, log, inventory)
+    vms = vcenter_fetcher.fetch_vm_data(vcenter, log, inventory)
+    client = FakeDiodeClient()
+    data_conversion.prepare_data(client, clusters, vms, log, state=state)
+    return client
+
+
+def test_addresses_shared_by_vms_have_their_own_keys():
+    first = data_conversion.Entity(ip_address=data_conversion.IPAddress(address="10.0.0.1/24", description="vm1 eth0"))
+    second = data_conversion.Entity(ip_address=data_conversion.IPAddress(address="10.0.0.1/24", description="vm2 eth0"))
+    assert entity_hash(first)[:2] != entity_hash(second)[:2]
+
+
+def test_second_run_skips_unchanged_entities(vcenter, log, tmp_path):
+    path = str(tmp_path / "state.db")
+    state = StateStore(path)
+    assert state.start_run(log)
+    first = _sync(vcenter, log, state)
+    state.close()
+
+    state = StateStore(path)
+    assert not state.start_run(log)
+    second = _sync(vcenter, log, state)
+    state.close()
+
+    assert first.entities > 0
+    assert second.entities == 0
+    assert state.skipped == first.entities
+
+
+def test_full_sync_every_is_decided_per_run(tmp_path, log):
+    state = StateStore(str(tmp_path / "state.db"), full_sync_every=3)
+    decisions = [state.start_run(log) for _ in range(6)]
+    state.close()
+    assert decisions == [True, False, True, False, False, True]
+
+
+def test_scheduler_full_sync_resends_without_changing_the_run(vcenter, log, tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    state.start_run(log)
+    first = _sync(vcenter, log, state)
+    state.full_sync = False
+
+    inventory = InventorySnapshot.collect(vcenter, log)
+    clusters = vcenter_fetcher.fetch_cluster_data(vcenter, log, inventory)
+    vms = vcenter_fetcher.fetch_vm_data(vcenter, log, inventory)
+    client = FakeDiodeClient()
+    scheduler = IngestScheduler(client, log, state)
+    scheduler.full_sync = True
+    data_conversion.prepare_data(client, clusters, vms, log, state=state, scheduler=scheduler)
+    scheduler.close()
+    assert client.entities == first.entities
+    assert not state.full_sync
+    # Other schedulers sharing the store still skip unchanged entities
+    assert _sync(vcenter, log, state).entities == 0
+    state.close()
@@ -0,0 +1,69 @@
+import os
+
+from transformer import RuleSet, Transformer
+from vcenter_fetcher import DEFAULT_RULE_FILES, default_transformer
+
+
+def test_apply_caches_the_replacement(monkeypatch):
+    rules = RuleSet("test", [["(?i)^web-(.*)", r"Web \1"], ["(?i)^db.*", "Databases"]], 16)
+    assert rules.apply("web-01") == "Web 01"
+
+    def no_regex(value):
+        raise AssertionError("cache hit ran the rules")
+
+    monkeypatch.setattr(rules, "_first_match", no_regex)
+    assert rules.apply("web-01") == "Web 01"
+    stats = rules.stats()
+    assert (stats["cache_hits"], stats["cache_misses"]) == (1, 1)
+
+
+def test_unmatched_values_are_unknown():
+    assert RuleSet("test", [["(?i)^db.*", "Databases"]], 16).apply("web-01") == "Unknown"
+
+
+def test_rules_that_can_never_match_are_reported():
+    rules = RuleSet("test", [["('?i)^web.*", "Web"], ["(?i)^db.*", "Databases"]], 16)
+    assert len(rules.warnings) == 1
+    assert "can never match" in rules.warnings[0]
+
+
+def test_tenant_rules_match():
+    transformer = default_transformer()
+    assert transformer.vm_tenant_rules.warnings == []
+    assert transformer.vm_to_tenant("24z-app01") == "VP for Economic Development"
+    assert transformer.vm_to_tenant("25A-db02") == "Cooperative Extension Services"
+
+
+def _rule_files(tmp_path, vm_role_rules):
+    paths = {**DEFAULT_RULE_FILES, "vm_role_rules": str(tmp_path / "vm_role_rules.yml")}
+    (tmp_path / "vm_role_rules.yml").write_text(vm_role_rules)
+    return paths
+
+
+def _touch(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_changed_rule_files_are_reloaded(tmp_path):
+    paths = _rule_files(tmp_path, '- ["(?i)^web.*", "Web"]\n')
+    transformer = Transformer(*paths.values())
+    assert not transformer.reload_if_changed()
+    assert transformer.vm_to_role("web01") == "Web"
+
+    (tmp_path / "vm_role_rules.yml").write_text('- ["(?i)^web.*", "Web servers"]\n')
+    _touch(paths["vm_role_rules"], 1)
+    assert transformer.reload_if_changed()
+    assert transformer.generation == 1
+    assert transformer.vm_to_role("web01") == "Web servers"
+
+
+def test_broken_rule_files_keep_the_current_rules(tmp_path):
+    paths = _rule_files(tmp_path, '- ["(?i)^web.*", "Web"]\n')
+    transformer = Transformer(*paths.values())
+
+    (tmp_path / "vm_role_rules.yml").write_text('- ["(?i)^web(.*", "Web"]\n')
+    _touch(paths["vm_role_rules"], 1)
+    assert not transformer.reload_if_changed()
+    assert transformer.generation == 0
+    assert transformer.vm_to_role("web01") == "Web"
@@ -0,0 +1,51 @@
+import argparse
+
+import pytest
+
+from mock_vcenter import FakeDiodeClient
+from transformer import Transformer
+from vcenter_fetcher import DEFAULT_RULE_FILES, default_transformer
+from vcenter_sync import _sync_vcenter, build_transformer, sync_vcenters
+
+
+def test_vcenters_without_overrides_share_the_default_rules():
+    assert build_transformer({}) is default_transformer()
+
+
+def test_unreadable_override_raises_instead_of_exiting(tmp_path):
+    paths = {**DEFAULT_RULE_FILES, "vm_role_rules": str(tmp_path / "missing.yml")}
+    with pytest.raises(OSError):
+        Transformer(*paths.values(), fatal=False)
+
+
+def test_unreadable_override_fails_only_its_vcenter(tmp_path):
+    vcenter = {"name": "vc1", "rules": {"vm_role_rules": str(tmp_path / "missing.yml")}, "scope": {}}
+    result = _sync_vcenter(vcenter, None, argparse.Namespace())
+    assert not result["ok"]
+    assert result["error"].startswith("invalid rules:")
+
+
+class PrefixCountingClient(FakeDiodeClient):
+    def __init__(self):
+        super().__init__()
+        self.prefixes = []
+
+    def ingest(self, entities):
+        with self.lock:
+            self.prefixes += [entity.prefix.prefix for entity in entities if entity.WhichOneof("entity") == "prefix"]
+        return super().ingest(entities)
+
+
+def test_vcenters_of_a_run_send_each_prefix_once(connected, sync_args):
+    client = PrefixCountingClient()
+    results = sync_vcenters([connected, {**connected, "name": "vc2"}], client, sync_args())
+    assert all(result["ok"] for result in results)
+    assert client.prefixes and len(client.prefixes) == len(set(client.prefixes))
+
+
+def test_invalid_scope_fails_only_its_vcenter(sync_args):
+    vcenter = {"name": "vc1", "rules": {}, "scope": {"include": {"hosts": ["esx01"]}}}
+    result = _sync_vcenter(vcenter, None, sync_args())
+    assert not result["ok"]
+    assert result["error"].startswith("invalid scope:")
+    assert result["seconds"] > 0
@@ -1,25 +1,345 @@
+import os
 import re
-import yaml
+import time
+import threading
+from functools import lru_cache
 import logging
 import ipaddress
+from profiling import profiler
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+CLEAN_NAME = re.compile(r'\.clemson\.edu.*', flags=re.IGNORECASE)
+# Leading global flags, e.g. "(?i)", which cannot appear mid-pattern once rules are combined.
+LEADING_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+# Lookups are keyed by name; hosts and VMs repeat names many times per run.
+DEFAULT_CACHE_SIZE = 8192
+# Constructs that depend on group numbering or names and so cannot share a combined pattern.
+GROUP_REFERENCES = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(')
+# Problems of one kind listed in full at load; the rest are only counted.
+MAX_REPORTED_PROBLEMS = 5
+
+
+def _is_dead(parsed):
+    """
+    Returns True if a parsed pattern can never match: a ^ anchor after something that
+    consumes at least one character, as in the mistyped flag "('?i)^abc".
+    """
+    if parsed.state.flags & re.MULTILINE:
+        return False
+    for index, (op, av) in enumerate(parsed.data):
+        if op is sre_parse.AT and av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            if index and sre_parse.SubPattern(parsed.state, parsed.data[:index]).getwidth()[0] > 0:
+                return True
+    return False
+
+
+def _literal_prefix(parsed):
+    """
+    Returns (literal text every match starts with, whether the pattern matches every value
+    starting with that text). Rules are applied with re.match, so matches start at the beginning.
+    """
+    items = list(parsed.data)
+    if items and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING):
+        items.pop(0)
+    text = []
+    while items and items[0][0] is sre_parse.LITERAL:
+        text.append(chr(items.pop(0)[1]))
+    if items and items[-1] == (sre_parse.AT, sre_parse.AT_END) and len(items) > 1:
+        items.pop()
+    open_ended = not items or (
+        len(items) == 1
+        and items[0][0] in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+        and items[0][1][0] == 0 and items[0][1][1] == sre_parse.MAXREPEAT
+        and list(items[0][1][2]) == [(sre_parse.ANY, None)]
+    )
+    return "".join(text).casefold(), open_ended
+
+
+class Rule:
+    """
+    A single compiled rule: a regex and the replacement used when it matches.
+    """
+    __slots__ = ("pattern", "replacement", "regex")
+
+    def __init__(self, pattern, replacement):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.regex = re.compile(pattern, flags=re.IGNORECASE)
+
+
+class RuleSet:
+    """
+    An ordered list of regex rules compiled once at load.
+    Runs of rules that can be combined are joined into a single alternation, so finding
+    the first matching rule takes one regex match per run instead of one per rule.
+    Python alternation tries branches left to right, which keeps first-match-wins order.
+    Results are memoized per value in a bounded LRU cache owned by the rule set.
+    """
+
+    def __init__(self, name, rules, cache_size=DEFAULT_CACHE_SIZE):
+        self.name = name
+        self.rules = []
+        self.segments = []
+        # Problems that make rules unusable, and rules that load but can never apply
+        self.errors = []
+        self.warnings = []
+        self.calls = 0
+        self.matches = 0
+        self.match_seconds = 0.0
+
+        for rule in rules or []:
+            # Plain pattern lists (skip rules) have no replacement
+            if isinstance(rule, str):
+                rule = (rule, None)
+            # Validate rule structure
+            if not isinstance(rule, (list, tuple)) or len(rule) != 2:
+                self.errors.append(f"Malformed rule in {name}: {rule}")
+                logging.error(self.errors[-1])
+                continue
+            pattern, replacement = rule
+            try:
+                self.rules.append(Rule(pattern, replacement))
+            except (re.error, TypeError) as e:
+                # Matching used to stop with "Unknown" at the first broken rule, so later rules are unreachable
+                self.errors.append(f"Regex error in {name} rule {rule}: {e}")
+                logging.error(f"{self.errors[-1]}; ignoring it and the rules after it")
+                break
+
+        self._validate()
+        self._build_segments()
+        # apply caches the replacement itself, so a hit runs no regex at all;
+        # first_match serves callers that need the rule, such as the skip rules
+        self.apply = lru_cache(maxsize=cache_size)(self._apply)
+        self.first_match = lru_cache(maxsize=cache_size)(self._first_match)
+
+    def _validate(self):
+        """
+        Reports rules that can never match and rules shadowed by an earlier rule that
+        matches everything they match, so they never apply.
+        """
+        dead = []
+        shadowed = []
+        catch_alls = []  # (literal prefix, rule) of earlier open-ended rules
+        for rule in self.rules:
+            parsed = sre_parse.parse(rule.pattern, re.IGNORECASE)
+            if _is_dead(parsed):
+                dead.append(f"{rule.pattern!r}")
+                continue
+            prefix, open_ended = _literal_prefix(parsed)
+            earlier = next((other for other_prefix, other in catch_alls if prefix.startswith(other_prefix)), None)
+            if earlier is not None:
+                shadowed.append(f"{rule.pattern!r} (by {earlier.pattern!r})")
+            elif open_ended:
+                catch_alls.append((prefix, rule))
+
+        for problems, reason in ((dead, "can never match"), (shadowed, "shadowed by an earlier rule")):
+            if not problems:
+                continue
+            self.warnings.extend(f"{self.name} rule {problem}: {reason}" for problem in problems)
+            listed = ", ".join(problems[:MAX_REPORTED_PROBLEMS])
+            more = f" and {len(problems) - MAX_REPORTED_PROBLEMS} more" if len(problems) > MAX_REPORTED_PROBLEMS else ""
+            logging.warning(f"{len(problems)} {self.name} rules {reason}: {listed}{more}")
+
+    def _build_segments(self):
+        """
+        Groups consecutive combinable rules into one alternation with one wrapping group per rule.
+        Each segment is (compiled regex, {group index: rule index}) or (None, rule index).
+        """
+        run = []
+
+        def _flush():
+            if not run:
+                return
+            parts = []
+            groups = {}
+            group_index = 1
+            for rule_index, pattern in run:
+                parts.append(f"({pattern})")
+                groups[group_index] = rule_index
+                group_index += 1 + self.rules[rule_index].regex.groups
+            self.segments.append((re.compile("|".join(parts), flags=re.IGNORECASE), groups))
+            run.clear()
+
+        for rule_index, rule in enumerate(self.rules):
+            pattern = rule.pattern
+            flags = LEADING_FLAGS.match(pattern)
+            if flags and set(flags.group(1)) <= {"i"}:
+                pattern = pattern[flags.end():]
+            if GROUP_REFERENCES.search(pattern) or LEADING_FLAGS.match(pattern):
+                _flush()
+                self.segments.append((None, rule_index))
+            else:
+                run.append((rule_index, pattern))
+        _flush()
+
+    def _first_match(self, value):
+        """
+        Returns the first rule matching value, or None.
+        """
+        start = time.perf_counter()
+        self.calls += 1
+        rule = None
+        for regex, groups in self.segments:
+            if regex is None:
+                if self.rules[groups].regex.match(value):
+                    rule = self.rules[groups]
+                    break
+                continue
+            match = regex.match(value)
+            if match:
+                rule = self.rules[groups[match.lastindex]]
+                break
+        elapsed = time.perf_counter() - start
+        self.match_seconds += elapsed
+        profiler.record("transform", elapsed)
+        if rule is not None:
+            self.matches += 1
+        return rule
+
+    def _apply(self, value):
+        """
+        Applies the replacement of the first matching rule, or returns "Unknown".
+        """
+        rule = self._first_match(value)
+        if rule is None:
+            return "Unknown"
+        return rule.regex.sub(rule.replacement, value)
+
+    def stats(self):
+        caches = (self.apply.cache_info(), self.first_match.cache_info())
+        return {
+            "rules": len(self.rules),
+            "segments": len(self.segments),
+            "errors": len(self.errors),
+            "warnings": len(self.warnings),
+            "calls": self.calls,
+            "matches": self.matches,
+            "match_seconds": round(self.match_seconds, 6),
+            "cache_hits": sum(cache.hits for cache in caches),
+            "cache_misses": sum(cache.misses for cache in caches),
+        }
+
 
 class Transformer:
-    def __init__(self, host_site_rules_path, host_tenant_rules_path, vm_role_rules_path, vm_tenant_rules_path, skip_rules_path):
+    def __init__(self, host_site_rules_path, host_tenant_rules_path, vm_role_rules_path, vm_tenant_rules_path, skip_rules_path, cache_size=DEFAULT_CACHE_SIZE, fatal=True):
+
+        self.host_site_rules_path = host_site_rules_path
+        self.host_tenant_rules_path = host_tenant_rules_path
+        self.vm_role_rules_path = vm_role_rules_path
+        self.vm_tenant_rules_path = vm_tenant_rules_path
+        self.skip_rules_path = skip_rules_path
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # Bumped on each reload, so callers can tell their records were built with older rules
+        self.generation = 0
+        self._clean_name = lru_cache(maxsize=self.cache_size)(self._strip_domain)
+        self.mtimes = self._mtimes()
+        # Only the main thread may exit; others load with fatal=False and get an exception
+        self.rule_sets = self._build(fatal=fatal)
+
+    @property
+    def paths(self):
+        return {
+            "host_site_rules": self.host_site_rules_path,
+            "host_tenant_rules": self.host_tenant_rules_path,
+            "vm_role_rules": self.vm_role_rules_path,
+            "vm_tenant_rules": self.vm_tenant_rules_path,
+            "skip_vm_rules": self.skip_rules_path,
+        }
+
+    def _mtimes(self):
+        mtimes = {}
+        for path in self.paths.values():
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _build(self, fatal=False):
+        """
+        Loads and compiles every rule file into a dict of RuleSets by name.
+        At startup (fatal) an unreadable file exits; otherwise it raises ValueError, as do rule errors.
+        """
+        rule_sets = {
+            name: RuleSet(name, self._load_rules(path, fatal), self.cache_size)
+            for name, path in self.paths.items()
+        }
+        errors = [error for rules in rule_sets.values() for error in rules.errors]
+        if errors and not fatal:
+            raise ValueError(f"{len(errors)} rule errors, first: {errors[0]}")
+        return rule_sets
+
+    def reload(self):
+        """
+        Reloads all rule files. The new rule sets replace the old ones in a single assignment,
+        so each lookup sees either the old or the new rules; lookup caches start empty.
+        If any file cannot be loaded or has rule errors, the current rules are kept.
+        :return: True if the rules were replaced
+        """
+        with self.lock:
+            return self._reload()
+
+    def _reload(self):
+        self.mtimes = self._mtimes()
+        try:
+            rule_sets = self._build()
+        except Exception as e:
+            logging.error(f"Keeping the current rules, reloading failed: {e}")
+            return False
+        self.rule_sets = rule_sets
+        self.generation += 1
+        logging.info(f"Reloaded rule files (generation {self.generation}).")
+        return True
+
+    def reload_if_changed(self):
+        """
+        Reloads the rule files if any of them changed on disk since the last (attempted) load.
+        Cheap enough to call on every cycle of a long-running sync.
+        :return: True if the rules were replaced
+        """
+        with self.lock:
+            if self._mtimes() == self.mtimes:
+                return False
+            logging.info("Rule files changed, reloading...")
+            return self._reload()
 
-        self.host_site_rules = self._load_rules(host_site_rules_path)
-        self.host_tenant_rules = self._load_rules(host_tenant_rules_path)
-        self.vm_tenant_rules = self._load_rules(vm_tenant_rules_path)
-        self.vm_role_rules = self._load_rules(vm_role_rules_path)
-        self.skip_vm_rules = self._load_rules(skip_rules_path)
+    def _load_rules(self, path, fatal=True):
+        import yaml
 
-    def _load_rules(self, path):
         try:
             with open(path, "r") as f:
                 return yaml.safe_load(f)
         except Exception as e:
             logging.error(f"Failed to load rules from {path}: {e}")
+            if not fatal:
+                raise
             exit(1)
 
+    @property
+    def host_site_rules(self):
+        return self.rule_sets["host_site_rules"]
+
+    @property
+    def host_tenant_rules(self):
+        return self.rule_sets["host_tenant_rules"]
+
+    @property
+    def vm_role_rules(self):
+        return self.rule_sets["vm_role_rules"]
+
+    @property
+    def vm_tenant_rules(self):
+        return self.rule_sets["vm_tenant_rules"]
+
+    @property
+    def skip_vm_rules(self):
+        return self.rule_sets["skip_vm_rules"]
+
     def get_cidr(self,ip, subnet_mask):
         try:
             network = ipaddress.ip_network(f"{ip}/{subnet_mask}", strict=False)
@@ -30,32 +350,29 @@ class Transformer:
          
             
     def apply_regex_replacements(self, value, rules):
-        try:
-            for rule in rules:
-                # Validate rule structure
-                if len(rule) != 2:
-                    logging.error(f"Malformed rule: {rule}")
-                    continue
-
-                pattern, replacement = rule
-                if re.match(pattern, value, flags=re.IGNORECASE):
-                    return re.sub(pattern, replacement, value, flags=re.IGNORECASE)
-        except re.error as e:
-            # Handle regex errors gracefully
-            logging.error(f"Regex error {value} {rule}: {e}")
-            return "Unknown"
-
-        return "Unknown"
+        """
+        Returns the replacement of the first rule in the RuleSet matching value, or "Unknown".
+        """
+        return rules.apply(value)
 
     def should_skip_vm(self, vm_name):
         """
         Determines if a VM should be skipped based on the skip rules.
         """
-        for pattern in self.skip_vm_rules:
-            if re.match(pattern, vm_name, flags=re.IGNORECASE):
-                logging.info(f"Skipping VM: {vm_name} (matched pattern: {pattern})")
-                return True
+        rule = self.skip_vm_rules.first_match(vm_name)
+        if rule is not None:
+            logging.info(f"Skipping VM: {vm_name} (matched pattern: {rule.pattern})")
+            return True
         return False
+
+    def stats(self):
+        """
+        Returns rule counts, matching time and cache hit/miss counters for each rule set.
+        """
+        stats = {name: rules.stats() for name, rules in self.rule_sets.items()}
+        cache = self._clean_name.cache_info()
+        stats["clean_name"] = {"cache_hits": cache.hits, "cache_misses": cache.misses}
+        return stats
     
     def host_to_site(self, name):
         """
@@ -85,4 +402,8 @@ class Transformer:
         """
         Remove '.clemson.edu.*' from a hostname or VM name.
         """
-        return re.sub(r'\.clemson\.edu.*', '', name, flags=re.IGNORECASE)
+        return self._clean_name(name)
+
+    @staticmethod
+    def _strip_domain(name):
+        return CLEAN_NAME.sub('', name)
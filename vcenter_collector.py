@@ -0,0 +1,516 @@
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim, vmodl
+from profiling import profiler
+
+# Property paths read by vcenter_fetcher, per managed object type.
+VM_PROPERTIES = [
+    "name",
+    "runtime.powerState",
+    "runtime.host",
+    "guest.net",
+    "guest.guestFullName",
+    "config.hardware.device",
+    "config.hardware.numCPU",
+    "config.hardware.memoryMB",
+    "summary.config.annotation",
+]
+
+HOST_PROPERTIES = [
+    "name",
+    "parent",
+    "config.network.vnic",
+    "config.network.pnic",
+    "summary.hardware.otherIdentifyingInfo",
+    "hardware.systemInfo.model",
+    "hardware.systemInfo.vendor",
+]
+
+CLUSTER_PROPERTIES = ["name", "parent", "host"]
+
+DATASTORE_PROPERTIES = ["name"]
+
+# Host vmkernel NICs reference distributed switches by uuid and portgroups by key.
+SWITCH_PROPERTIES = ["name", "uuid"]
+
+PORTGROUP_PROPERTIES = ["name", "key"]
+
+# Folders and datacenters are only needed to resolve parent names.
+ENTITY_PROPERTIES = ["name", "parent"]
+
+# Cheap VM properties a Scope is evaluated against before VM_PROPERTIES are retrieved.
+VM_SCOPE_PROPERTIES = ["name", "parent", "runtime.host"]
+
+DEFAULT_PAGE_SIZE = 1000
+
+DEFAULT_WORKERS = 4
+
+# Types retrieved per datacenter, into the InventorySnapshot table of the same name.
+DATACENTER_TABLES = [
+    ("vms", vim.VirtualMachine, VM_PROPERTIES),
+    ("hosts", vim.HostSystem, HOST_PROPERTIES),
+    ("clusters", vim.ComputeResource, CLUSTER_PROPERTIES),
+    ("datastores", vim.Datastore, DATASTORE_PROPERTIES),
+    ("switches", vim.DistributedVirtualSwitch, SWITCH_PROPERTIES),
+    ("portgroups", vim.dvs.DistributedVirtualPortgroup, PORTGROUP_PROPERTIES),
+]
+
+# Every type and property path kept in an InventorySnapshot. The watcher of daemon mode also
+# needs the folder of each VM, to apply a Scope to changed VMs.
+INVENTORY_PROPERTIES = [
+    (vim.VirtualMachine, VM_PROPERTIES + ["parent"]),
+    (vim.HostSystem, HOST_PROPERTIES),
+    (vim.ComputeResource, CLUSTER_PROPERTIES),
+    (vim.Datastore, DATASTORE_PROPERTIES),
+    (vim.DistributedVirtualSwitch, SWITCH_PROPERTIES),
+    (vim.dvs.DistributedVirtualPortgroup, PORTGROUP_PROPERTIES),
+    (vim.Folder, ENTITY_PROPERTIES),
+    (vim.Datacenter, ENTITY_PROPERTIES),
+]
+
+
+def _view_filter_spec(view, type_properties):
+    """
+    Builds a FilterSpec selecting the given property paths for every object in a ContainerView.
+    :param type_properties: list of (managed object type, property paths)
+    """
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name="traverseView",
+        path="view",
+        skip=False,
+        type=vim.view.ContainerView,
+    )
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=view,
+        skip=True,
+        selectSet=[traversal_spec],
+    )
+    property_specs = [
+        vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set, all=False)
+        for obj_type, path_set in type_properties
+    ]
+    return vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[object_spec],
+        propSet=property_specs,
+    )
+
+
+def iter_properties(content, obj_type, path_set, logging, page_size=DEFAULT_PAGE_SIZE, root=None):
+    """
+    Yields (managed object id, properties) for every object of obj_type below root
+    using a ContainerView and PropertyCollector.RetrievePropertiesEx, following
+    ContinueRetrievePropertiesEx tokens page by page, so only one page is held at a time.
+    :param content: ServiceContent from si.RetrieveContent()
+    :param obj_type: pyVmomi managed object type, e.g. vim.VirtualMachine
+    :param path_set: list of property paths to retrieve
+    :param page_size: maximum number of objects returned per round trip
+    :param root: container to search, the root folder by default
+    """
+    view = content.viewManager.CreateContainerView(root or content.rootFolder, [obj_type], True)
+    try:
+        filter_spec = _view_filter_spec(view, [(obj_type, path_set)])
+        yield from _iter_results(content.propertyCollector, filter_spec, obj_type, logging, page_size)
+    finally:
+        view.Destroy()
+
+
+def iter_objects(content, refs, obj_type, path_set, logging, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yields (managed object id, properties) for the given managed object references only,
+    requesting at most page_size objects per RetrievePropertiesEx call.
+    """
+    refs = list(refs)
+    for start in range(0, len(refs), page_size):
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=ref, skip=False)
+            for ref in refs[start:start + page_size]
+        ]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=object_specs,
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set, all=False)],
+        )
+        yield from _iter_results(content.propertyCollector, filter_spec, obj_type, logging, page_size)
+
+
+def _iter_results(collector, filter_spec, obj_type, logging, page_size):
+    """
+    Runs one RetrievePropertiesEx query and follows its ContinueRetrievePropertiesEx tokens.
+    """
+    token = None
+    try:
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+
+        count = 0
+        pages = 0
+        with profiler.phase("soap_round_trip"):
+            result = collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            pages += 1
+            token = result.token
+            for obj_content in result.objects:
+                props = {prop.name: prop.val for prop in obj_content.propSet}
+                props["obj"] = obj_content.obj
+                count += 1
+                yield obj_content.obj._moId, props
+            if not token:
+                break
+            with profiler.phase("soap_round_trip"):
+                result = collector.ContinueRetrievePropertiesEx(token)
+            token = None
+        logging.debug(f"Retrieved {count} {obj_type.__name__} objects in {pages} pages.")
+    finally:
+        # Release the server-side result set if the caller stopped early
+        if token:
+            try:
+                collector.CancelRetrievePropertiesEx(token)
+            except Exception as e:
+                logging.warning(f"Failed to cancel property retrieval: {e}")
+
+
+def retrieve_properties(content, obj_type, path_set, logging, page_size=DEFAULT_PAGE_SIZE, root=None):
+    """
+    Retrieves the given property paths for every object of obj_type below root.
+    :return: dict of managed object id -> {property path: value, "obj": reference}
+    """
+    return dict(iter_properties(content, obj_type, path_set, logging, page_size, root))
+
+
+def iter_tiered(content, table, obj_type, path_set, fetch, logging, page_size=DEFAULT_PAGE_SIZE, cache=None):
+    """
+    Yields (managed object id, properties) from fetch(paths), with the paths a PropertyCache
+    serves left out of the retrieval and filled in from the cache a page at a time.
+    Objects missing from the cache are retrieved by reference and cached.
+    :param table: InventorySnapshot table name the cache is keyed by, "vms" or "hosts"
+    :param fetch: function of a path list yielding (managed object id, properties)
+    """
+    if cache is None:
+        yield from fetch(path_set)
+        return
+    paths, cached = cache.plan(table, path_set)
+    objects = fetch(paths)
+    while True:
+        page = dict(islice(objects, page_size))
+        if not page:
+            break
+        cache.save(table, page, paths)
+        missing = cache.fill(table, page, cached)
+        if missing:
+            backfill = dict(iter_objects(content, [page[moid]["obj"] for moid in missing], obj_type, cached, logging, page_size))
+            for moid, props in backfill.items():
+                page[moid].update(props)
+            cache.save(table, backfill, cached)
+        yield from page.items()
+
+
+def iter_vm_properties(content, datacenter, inventory, logging, page_size=DEFAULT_PAGE_SIZE, scope=None):
+    """
+    Yields (managed object id, VM_PROPERTIES) for the VMs of a datacenter.
+    If the scope selects VMs by cluster, folder or name, only VM_SCOPE_PROPERTIES are retrieved
+    for all VMs first, and VM_PROPERTIES only for the VMs in scope and not skipped. VMs are in a selected
+    cluster if their host is a member of one of the inventory's (already scoped) clusters.
+    Property groups the inventory's PropertyCache serves are not retrieved.
+    """
+    if scope is None or not scope.filters_vms():
+        yield from iter_tiered(
+            content, "vms", vim.VirtualMachine, VM_PROPERTIES,
+            lambda paths: iter_properties(content, vim.VirtualMachine, paths, logging, page_size, root=datacenter["obj"]),
+            logging, page_size, inventory.cache,
+        )
+        return
+
+    host_ids = None
+    if scope.filters("clusters"):
+        host_ids = {ref._moId for cluster in inventory.clusters.values() for ref in cluster.get("host", [])}
+    selected = []
+    total = 0
+    for _, props in iter_properties(content, vim.VirtualMachine, VM_SCOPE_PROPERTIES, logging, page_size, root=datacenter["obj"]):
+        total += 1
+        host = props.get("runtime.host")
+        if host_ids is not None and (host is None or host._moId not in host_ids):
+            continue
+        if scope.vm_selected(props.get("name"), inventory.path_of(props.get("parent"))):
+            selected.append(props["obj"])
+    logging.info(f"{len(selected)} of {total} VMs in datacenter {datacenter.get('name')} are in scope.")
+    yield from iter_tiered(
+        content, "vms", vim.VirtualMachine, VM_PROPERTIES,
+        lambda paths: iter_objects(content, selected, vim.VirtualMachine, paths, logging, page_size),
+        logging, page_size, inventory.cache,
+    )
+
+
+class InventorySnapshot:
+    """
+    Local copy of the vCenter properties used by vcenter_fetcher, keyed by managed object id.
+    Managed object references found in property values are resolved against this
+    snapshot instead of being dereferenced over SOAP.
+    """
+
+    def __init__(self, vms=None, hosts=None, clusters=None, datastores=None, entities=None, datacenters=None,
+                 switches=None, portgroups=None):
+        # False if VMs were left out of the snapshot to be streamed instead
+        self.vms_loaded = True
+        self.vms = vms or {}
+        self.hosts = hosts or {}
+        self.clusters = clusters or {}
+        self.datastores = datastores or {}
+        self.switches = switches or {}
+        self.portgroups = portgroups or {}
+        # Lookups of switches by uuid and portgroups by key, built on first use
+        self.indexes = {}
+        self.entities = entities or {}
+        self.datacenters = datacenters or {}
+        # PropertyCache serving slowly changing VM and host properties, if tiered refresh is on
+        self.cache = None
+        # Last known properties of objects removed by applied update sets, until pop_departed()
+        self.departed = {}
+
+    @classmethod
+    @profiler.timed("fetch_inventory")
+    def collect(cls, si, logging, page_size=DEFAULT_PAGE_SIZE, workers=DEFAULT_WORKERS, include_vms=True, scope=None,
+                cache=None):
+        """
+        Retrieves VMs, hosts, clusters, datastores, distributed switches and portgroups,
+        folders and datacenters in bulk, so references between them resolve locally.
+        Each datacenter's objects are retrieved as separate tasks on a pool of up to
+        `workers` threads. Results are merged in datacenter name order, and a failed
+        task only loses that datacenter's objects of one type.
+        With include_vms=False, VMs are left to be streamed with iter_vm_properties.
+        With a Scope, datacenters out of scope are not searched at all; clusters are
+        selected before the properties of their hosts are retrieved, and VMs (see
+        iter_vm_properties) before their heavy properties are.
+        With a PropertyCache, VM and host property groups that are not due for refresh are
+        served from it instead of being retrieved (see iter_tiered).
+        """
+        logging.info("Retrieving inventory from vCenter PropertyCollector...")
+        content = si.RetrieveContent()
+        entities = retrieve_properties(content, vim.Folder, ENTITY_PROPERTIES, logging, page_size)
+        datacenters = retrieve_properties(content, vim.Datacenter, ENTITY_PROPERTIES, logging, page_size)
+        entities.update(datacenters)
+        if scope is not None:
+            selected = {moid: dc for moid, dc in datacenters.items() if scope.datacenter_selected(dc.get("name"))}
+            logging.info(f"{len(selected)} of {len(datacenters)} datacenters are in scope.")
+            datacenters = selected
+        snapshot = cls(entities=entities, datacenters=datacenters)
+        snapshot.vms_loaded = include_vms
+        snapshot.cache = cache
+        datacenters = sorted(datacenters.values(), key=lambda dc: dc.get("name") or "")
+        # Hosts and VMs wait for the clusters in scope to be known
+        deferred = set()
+        if scope is not None and scope.filters("clusters"):
+            deferred.add("hosts")
+        if scope is not None and scope.filters_vms():
+            deferred.add("vms")
+
+        def _retrieve(task):
+            datacenter, table, obj_type, path_set = task
+            try:
+                if table == "vms":
+                    return dict(iter_vm_properties(content, datacenter, snapshot, logging, page_size, scope if "vms" in deferred else None))
+                if table == "hosts":
+                    return dict(iter_tiered(
+                        content, table, obj_type, path_set,
+                        lambda paths: iter_properties(content, obj_type, paths, logging, page_size, root=datacenter["obj"]),
+                        logging, page_size, cache,
+                    ))
+                return retrieve_properties(content, obj_type, path_set, logging, page_size, root=datacenter["obj"])
+            except Exception as e:
+                logging.error(f"Error retrieving {table} from datacenter {datacenter.get('name')}: {e}")
+                return {}
+
+        def _run(tasks):
+            for (_, table, _, _), objects in zip(tasks, executor.map(_retrieve, tasks)):
+                getattr(snapshot, table).update(objects)
+
+        tables = [(table, obj_type, path_set) for table, obj_type, path_set in DATACENTER_TABLES if include_vms or table != "vms"]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            _run([
+                (datacenter, table, obj_type, path_set)
+                for datacenter in datacenters
+                for table, obj_type, path_set in tables
+                if table not in deferred
+            ])
+            if "hosts" in deferred:
+                clusters = {moid: cluster for moid, cluster in snapshot.clusters.items() if scope.cluster_selected(cluster.get("name"))}
+                logging.info(f"{len(clusters)} of {len(snapshot.clusters)} clusters are in scope.")
+                snapshot.clusters = clusters
+                host_refs = [ref for cluster in clusters.values() for ref in cluster.get("host", [])]
+                snapshot.hosts.update(iter_tiered(
+                    content, "hosts", vim.HostSystem, HOST_PROPERTIES,
+                    lambda paths: iter_objects(content, host_refs, vim.HostSystem, paths, logging, page_size),
+                    logging, page_size, cache,
+                ))
+            _run([
+                (datacenter, table, obj_type, path_set)
+                for datacenter in datacenters
+                for table, obj_type, path_set in tables
+                if table in deferred and table != "hosts"
+            ])
+
+        logging.info(
+            f"Retrieved {len(snapshot.vms)} VMs, {len(snapshot.hosts)} hosts, "
+            f"{len(snapshot.clusters)} clusters, {len(snapshot.datastores)} datastores and "
+            f"{len(snapshot.switches)} distributed switches "
+            f"from {len(datacenters)} datacenters."
+        )
+        return snapshot
+
+    def table_for(self, ref):
+        """
+        Returns the snapshot table that holds objects of the reference's type.
+        """
+        if isinstance(ref, vim.VirtualMachine):
+            return self.vms
+        if isinstance(ref, vim.HostSystem):
+            return self.hosts
+        if isinstance(ref, vim.ComputeResource):
+            return self.clusters
+        if isinstance(ref, vim.Datastore):
+            return self.datastores
+        if isinstance(ref, vim.DistributedVirtualSwitch):
+            return self.switches
+        if isinstance(ref, vim.dvs.DistributedVirtualPortgroup):
+            return self.portgroups
+        return self.entities
+
+    def apply_update_set(self, update_set):
+        """
+        Applies a PropertyCollector UpdateSet from WaitForUpdatesEx to the snapshot.
+        :return: dict of managed object id -> (kind, set of changed property paths)
+        """
+        changes = {}
+        self.indexes.clear()
+        for filter_update in update_set.filterSet or []:
+            for object_update in filter_update.objectSet or []:
+                ref = object_update.obj
+                table = self.table_for(ref)
+                moid = ref._moId
+                if object_update.kind == "leave":
+                    props = table.pop(moid, None)
+                    if props is not None:
+                        self.departed[moid] = props
+                    changes[moid] = ("leave", set())
+                    continue
+                props = table.setdefault(moid, {"obj": ref})
+                changed = set()
+                for change in object_update.changeSet or []:
+                    if change.op in ("remove", "indirectRemove"):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = change.val
+                    changed.add(change.name)
+                kind, previous = changes.get(moid, (object_update.kind, set()))
+                changes[moid] = (kind, previous | changed)
+        return changes
+
+    def pop_departed(self):
+        """
+        Returns the last known properties of the objects removed since the previous call,
+        keyed by managed object id, and forgets them.
+        """
+        departed, self.departed = self.departed, {}
+        return departed
+
+    def lookup(self, ref):
+        """
+        Returns the property dict for a managed object reference, or None if it is not in the snapshot.
+        """
+        if ref is None:
+            return None
+        moid = ref._moId
+        for table in (self.hosts, self.clusters, self.datastores, self.switches, self.portgroups, self.entities, self.vms):
+            if moid in table:
+                return table[moid]
+        return None
+
+    def name_of(self, ref):
+        """
+        Returns the name of a managed object reference.
+        """
+        props = self.lookup(ref)
+        return props.get("name") if props else None
+
+    def switch_name(self, uuid):
+        """
+        Returns the name of the distributed switch with the given uuid.
+        """
+        props = self._index(self.switches, "uuid").get(uuid)
+        return props.get("name") if props else None
+
+    def portgroup_name(self, key):
+        """
+        Returns the name of the distributed portgroup with the given key.
+        """
+        props = self._index(self.portgroups, "key").get(key)
+        return props.get("name") if props else None
+
+    def _index(self, table, field):
+        index = self.indexes.get(field)
+        if index is None:
+            index = self.indexes[field] = {props.get(field): props for props in table.values()}
+        return index
+
+    def path_of(self, ref):
+        """
+        Returns the inventory path of a folder or datacenter reference, e.g. "/DC1/vm/Production",
+        leaving out the root folder.
+        """
+        names = []
+        while ref is not None:
+            props = self.entities.get(ref._moId)
+            if props is None or props.get("parent") is None:
+                break
+            names.append(props.get("name") or "")
+            ref = props.get("parent")
+        return "/" + "/".join(reversed(names)) if names else None
+
+    def parent_of(self, ref):
+        """
+        Returns the parent reference of a managed object reference.
+        """
+        props = self.lookup(ref)
+        return props.get("parent") if props else None
+
+
+class InventoryWatcher:
+    """
+    Subscribes to changes of the inventory properties with a dedicated PropertyCollector filter.
+    The first wait() returns every object as an "enter" update, later calls only changes.
+    """
+
+    def __init__(self, si, logging, max_wait_seconds=60):
+        self.logging = logging
+        self.max_wait_seconds = max_wait_seconds
+        self.version = ""
+        content = si.RetrieveContent()
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateContainerView(
+            content.rootFolder, [obj_type for obj_type, _ in INVENTORY_PROPERTIES], True
+        )
+        self.collector.CreateFilter(_view_filter_spec(self.view, INVENTORY_PROPERTIES), partialUpdates=False)
+
+    def wait(self):
+        """
+        Waits up to max_wait_seconds for changes.
+        :return: list of UpdateSets (more than one if vCenter truncated the update), empty if nothing changed
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait_seconds)
+        update_sets = []
+        while True:
+            update_set = self.collector.WaitForUpdatesEx(self.version, options)
+            if update_set is None:
+                break
+            self.version = update_set.version
+            update_sets.append(update_set)
+            if not update_set.truncated:
+                break
+        return update_sets
+
+    def close(self):
+        """
+        Destroys the PropertyCollector (and with it the filter) and the ContainerView.
+        """
+        try:
+            self.collector.DestroyPropertyCollector()
+            self.view.Destroy()
+        except Exception as e:
+            self.logging.warning(f"Failed to clean up inventory watcher: {e}")
@@ -1,39 +1,172 @@
 from pyVim.connect import SmartConnect, Disconnect
+import os
 import ssl
+import json
+import threading
 import logging
 
 # Set up logging for status messages
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def connect_to_vcenter(host, user, password):
+# Seconds between session checks in long-running modes; vCenter's default idle timeout is 30 minutes.
+DEFAULT_KEEPALIVE_INTERVAL = 600
+
+
+class SessionCache:
+    """
+    Stores vCenter session ids by user and host in a JSON file readable only by its owner,
+    so later runs can resume a session instead of logging in again.
+    """
+
+    # Shared by all instances, as the syncs of several vCenters may use the same file.
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable session cache {self.path}: {e}")
+            return {}
+
+    def get(self, host, user):
+        with self.lock:
+            return self._load().get(f"{user}@{host}")
+
+    def set(self, host, user, session_id):
+        """
+        Records a session id, or removes it if session_id is None.
+        """
+        with self.lock:
+            sessions = self._load()
+            if session_id:
+                sessions[f"{user}@{host}"] = session_id
+            else:
+                sessions.pop(f"{user}@{host}", None)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.path)
+
+
+def _ssl_context(verify):
+    """
+    Returns an SSL context that verifies the vCenter certificate unless verify is False.
+    """
+    if verify:
+        return ssl.create_default_context()
+    return ssl._create_unverified_context()
+
+
+def _session_valid(si):
+    """
+    Checks a session with one cheap SessionManager.currentSession read.
+    """
+    try:
+        return si.RetrieveContent().sessionManager.currentSession is not None
+    except Exception:
+        return False
+
+
+def connect_to_vcenter(host, user, password, verify=True, session_cache=None):
     """
     Establish a connection to the vCenter server.
     :param host: vCenter hostname or IP
     :param user: vCenter username
     :param password: vCenter password
+    :param verify: verify the vCenter SSL certificate
+    :param session_cache: SessionCache to resume a previous session from and save the new one to
     :return: ServiceInstance object if connection is successful, None otherwise
     """
+    context = _ssl_context(verify)
+    if session_cache is not None:
+        session_id = session_cache.get(host, user)
+        if session_id:
+            try:
+                si = SmartConnect(host=host, sslContext=context, sessionId=session_id)
+                if _session_valid(si):
+                    logging.info(f"Resumed vCenter session at {host}.")
+                    return si
+                si._stub.DropConnections()
+            except Exception as e:
+                logging.debug(f"Could not resume vCenter session at {host}: {e}")
+            logging.info(f"Cached vCenter session at {host} expired, logging in again.")
+
     logging.info(f"Attempting to connect to vCenter at {host}...")
     try:
-        # Disable SSL verification for testing
-        context = ssl._create_unverified_context()
         si = SmartConnect(host=host, user=user, pwd=password, sslContext=context)
         logging.info("Successfully connected to vCenter.")
+        if session_cache is not None:
+            session_cache.set(host, user, si._stub.GetSessionId())
         return si
     except Exception as e:
         logging.error(f"Failed to connect to vCenter: {e}")
         return None
 
-def disconnect_vcenter(si):
+def disconnect_vcenter(si, logout=True):
     """
     Disconnect from the vCenter server.
     :param si: ServiceInstance object
+    :param logout: end the vCenter session; False keeps it open for a cached session to resume
     """
     if si:
         try:
-            Disconnect(si)
+            if logout:
+                Disconnect(si)
+            else:
+                si._stub.DropConnections()
             logging.info("Disconnected from vCenter.")
         except Exception as e:
             logging.error(f"Failed to disconnect from vCenter: {e}")
     else:
         logging.warning("No active vCenter session to disconnect.")
+
+
+class SessionKeepAlive:
+    """
+    Background thread that checks the session every interval seconds, which also resets
+    vCenter's idle timer, and logs in again on the same connection if the session was lost.
+    """
+
+    def __init__(self, si, user, password, logging, interval=DEFAULT_KEEPALIVE_INTERVAL, host=None, session_cache=None):
+        self.si = si
+        self.user = user
+        self.password = password
+        self.logging = logging
+        self.interval = interval
+        self.host = host
+        self.session_cache = session_cache
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="vcenter-keepalive", daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            if _session_valid(self.si):
+                self.logging.debug("vCenter session is alive.")
+                continue
+            self.logging.warning("vCenter session was lost, logging in again...")
+            try:
+                self.si.RetrieveContent().sessionManager.Login(self.user, self.password, None)
+                if self.session_cache is not None:
+                    self.session_cache.set(self.host, self.user, self.si._stub.GetSessionId())
+            except Exception as e:
+                self.logging.error(f"Failed to log in to vCenter again: {e}")
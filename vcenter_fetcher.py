@@ -1,9 +1,34 @@
+import time
+import threading
 from pyVmomi import vim
 from transformer import Transformer
-from ipaddress import IPv4Network
+from vcenter_collector import InventorySnapshot, iter_vm_properties, DEFAULT_PAGE_SIZE
+from profiling import profiler
+from network_index import mask_to_prefixlen
+from records import ClusterRecord, HostRecord, HostNicRecord, VMRecord, VMInterfaceRecord, VMDiskRecord
 
-# Initialize Transformer with paths to regex rules
-transformer = Transformer("includes/host_site_rules.yml", "includes/host_tenant_rules.yml", "includes/vm_role_rules.yml", "includes/vm_tenant_rules.yml", "includes/skip_vms.yml")
+# Rule files used unless a vCenter overrides them, in Transformer argument order
+DEFAULT_RULE_FILES = {
+    "host_site_rules": "includes/host_site_rules.yml",
+    "host_tenant_rules": "includes/host_tenant_rules.yml",
+    "vm_role_rules": "includes/vm_role_rules.yml",
+    "vm_tenant_rules": "includes/vm_tenant_rules.yml",
+    "skip_vms": "includes/skip_vms.yml",
+}
+
+_default_transformer = None
+_default_transformer_lock = threading.Lock()
+
+def default_transformer():
+    """
+    Returns the Transformer of the default rule files, loading the rules on first use
+    so importing this module does not read or compile them.
+    """
+    global _default_transformer
+    with _default_transformer_lock:
+        if _default_transformer is None:
+            _default_transformer = Transformer(*DEFAULT_RULE_FILES.values())
+        return _default_transformer
 
 def extract_serial_number(other_identifying_info):
     """
@@ -16,51 +41,82 @@ def extract_serial_number(other_identifying_info):
                 return item.identifierValue
     return None
 
-def fetch_cluster_data(si,logging):
+@profiler.timed("fetch_cluster")
+def build_cluster_record(cluster, inventory, logging, host_ids=None, transformer=None):
+    """
+    Builds a cluster record, including its hosts, from the cluster's property dict.
+    If host_ids is given, only those hosts of the cluster are included.
+    """
+    transformer = transformer or default_transformer()
+    cluster_name = cluster.get("name")
+    logging.info(f"Processing cluster: {cluster_name}")
+    # Determine site name from cluster name
+    site_name = transformer.host_to_site(cluster_name)
+    logging.debug(f"Site name for cluster {cluster_name}: {site_name}")
+    tenant = transformer.host_to_tenant(cluster_name)
+    logging.debug(f"Tenant name for cluster {cluster_name}: {tenant}")
+    # Check if the cluster has hosts
+    cluster_hosts = [
+        inventory.hosts[ref._moId] for ref in cluster.get("host", [])
+        if ref._moId in inventory.hosts and (host_ids is None or ref._moId in host_ids)
+    ]
+    if cluster_hosts:
+        logging.debug(f"Cluster {cluster_name} has {len(cluster_hosts)} hosts.")
+        hosts = fetch_host_data(cluster_hosts, site_name, logging, inventory, transformer)
+    else:
+        logging.warning(f"Cluster {cluster_name} has no hosts.")
+        hosts = []
+
+    # Process parent name
+    parent_name = inventory.name_of(inventory.parent_of(cluster.get("parent")))
+    logging.debug(f"Cluster {cluster_name} parent: {parent_name}")
+
+    return ClusterRecord(
+        name=cluster_name,
+        group=parent_name,
+        site=site_name,
+        tenant=tenant,
+        hosts=hosts,
+    )
+
+def iter_cluster_data(si,logging,inventory=None,transformer=None,scope=None):
+    """
+    Yields cluster records one at a time; see fetch_cluster_data.
+    """
+    if inventory is None:
+        inventory = InventorySnapshot.collect(si, logging, scope=scope)
+
+    for cluster in inventory.clusters.values():
+        try:
+            record = build_cluster_record(cluster, inventory, logging, transformer=transformer)
+        except Exception as e:
+            logging.error(f"Error processing cluster {cluster.get('name')}: {e}")
+            continue
+        yield record
+
+def fetch_cluster_data(si,logging,inventory=None,transformer=None):
     """
     Fetches cluster information, including cluster name, parent group, and hosts.
     Applies transformations to determine site names.
+    If no inventory snapshot is given, one is retrieved in bulk from vCenter.
     """
     logging.info("Fetching clusters from vCenter...")
-    content = si.RetrieveContent()
-    clusters = []
-
-    for datacenter in content.rootFolder.childEntity:
-        for cluster in datacenter.hostFolder.childEntity:
-            try:
-                logging.info(f"Processing cluster: {cluster.name}")
-                # Determine site name from cluster name
-                site_name = transformer.host_to_site(cluster.name)
-                logging.debug(f"Site name for cluster {cluster.name}: {site_name}")
-                tenant = transformer.host_to_tenant(cluster.name)
-                logging.debug(f"Tenant name for cluster {cluster.name}: {tenant}")
-                # Check if the cluster has hosts
-                if hasattr(cluster, "host") and cluster.host:
-                    logging.debug(f"Cluster {cluster.name} has {len(cluster.host)} hosts.")
-                    hosts = fetch_host_data(cluster.host, site_name, logging)
-                else:
-                    logging.warning(f"Cluster {cluster.name} has no hosts.")
-                    hosts = []
-
-                # Process parent name
-                parent_name = cluster.parent.parent.name if cluster.parent.parent else None
-                logging.debug(f"Cluster {cluster.name} parent: {parent_name}")
-
-                clusters.append({
-                    "name": cluster.name,
-                    "group": parent_name, 
-                    "site": site_name,
-                    "hosts": hosts,
-                    "tenant": tenant,
-                })
-            except Exception as e:
-                logging.error(f"Error processing cluster {cluster.name}: {e}")
+    clusters = list(iter_cluster_data(si, logging, inventory, transformer))
     logging.info(f"Fetched {len(clusters)} clusters from vCenter.")
     return clusters
 
-
     
-def fetch_host_data(hosts, site_name, logging):
+def fetch_host_data(hosts, site_name, logging, inventory, transformer=None):
+    """
+    Builds host records from host property dicts retrieved into the inventory snapshot.
+    """
+    return list(iter_host_data(hosts, site_name, logging, inventory, transformer))
+
+def iter_host_data(hosts, site_name, logging, inventory, transformer=None):
+    """
+    Yields host records one at a time from host property dicts; see fetch_host_data.
+    """
+    transformer = transformer or default_transformer()
 
     def _get_nic_type(link_speed):
         """
@@ -84,26 +140,27 @@ def fetch_host_data(hosts, site_name, logging):
         Converts an IP address and subnet mask to CIDR notation (x.x.x.x/y).
         """
         try:
-            prefix_length = IPv4Network(f"0.0.0.0/{subnet_mask}").prefixlen
+            prefix_length = mask_to_prefixlen(subnet_mask)
             return f"{ip}/{prefix_length}"
         except Exception as e:
             logging.error(f"Failed to convert {ip} and {subnet_mask} to CIDR: {e}")
             return None
         
     logging.info(f"Fetching details for {len(hosts)} hosts...")
-    host_data = []
     for host in hosts:
+        start = time.perf_counter()
+        host_name = host.get("name")
         try:
-            logging.debug(f"Processing host: {host.name}")
+            logging.debug(f"Processing host: {host_name}")
             # Clean hostname and determine tenant
-            clean_name = transformer.clean_name(host.name)
+            clean_name = transformer.clean_name(host_name)
             tenant = transformer.host_to_tenant(clean_name)
-            logging.debug(f"Transformed host {host.name} -> clean: {clean_name}, tenant: {tenant}")
+            logging.debug(f"Transformed host {host_name} -> clean: {clean_name}, tenant: {tenant}")
 
             host_nics = []
 
             # Process vNICs (Virtual NICs)
-            for vnic in host.config.network.vnic:
+            for vnic in host.get("config.network.vnic", []):
                 ip_addresses = []
                 if vnic.spec.ip and hasattr(vnic.spec.ip, 'ipAddress'):
                     #TODO: IPV6 Addresses
@@ -116,137 +173,159 @@ def fetch_host_data(hosts, site_name, logging):
                         else:
                             ip_addresses.append(ip)  # Add raw IP if no subnet mask
 
-                nic_data = {
-                    "type": "virtual",
-                    "name": vnic.device,
-                    "mac": vnic.spec.mac,
-                    "ip_addresses": ip_addresses,
-                    "dvs_name": vnic.distributedVirtualPort.switchUuid if hasattr(vnic, "distributedVirtualPort") else None,
-                    "portgroup_name": vnic.portgroup if hasattr(vnic, "portgroup") else None,
-                }
+                # vmkernel NICs on a distributed switch have no standard portgroup name
+                dv_port = getattr(vnic.spec, "distributedVirtualPort", None)
+                nic_data = HostNicRecord(
+                    type="virtual",
+                    name=vnic.device,
+                    mac=vnic.spec.mac,
+                    ip_addresses=ip_addresses,
+                    dvs_name=inventory.switch_name(dv_port.switchUuid) if dv_port else None,
+                    portgroup_name=getattr(vnic, "portgroup", None) or (inventory.portgroup_name(dv_port.portgroupKey) if dv_port else None),
+                )
                 host_nics.append(nic_data)
 
             # Process pNICs (Physical NICs)
-            for pnic in host.config.network.pnic:
+            for pnic in host.get("config.network.pnic", []):
                 link_speed = pnic.linkSpeed.speedMb if pnic.linkSpeed else None
                 nic_type = _get_nic_type(link_speed)
                 
                 #TODO: Don't assume pNics have no IP
 
-                nic_data = {
-                    "type": nic_type,
-                    "name": pnic.device,
-                    "mac": getattr(pnic, "mac", None),
-                    "link_speed": link_speed,
-                    "ip_addresses": [],  
-                    "dvs_name": None,
-                    "portgroup_name": None,
-                }
+                nic_data = HostNicRecord(
+                    type=nic_type,
+                    name=pnic.device,
+                    mac=getattr(pnic, "mac", None),
+                    link_speed=link_speed,
+                )
                 host_nics.append(nic_data)
 
-            serial_number = extract_serial_number(host.summary.hardware.otherIdentifyingInfo)
-
-            host_data.append({
-                "name": clean_name,
-                "site": site_name,
-                "cluster": host.parent.name,
-                "tenant": tenant,
-                "nics": host_nics,
-                "model": host.hardware.systemInfo.model,
-                "vendor": host.hardware.systemInfo.vendor,
-                "serial_number": serial_number,
+            serial_number = extract_serial_number(host.get("summary.hardware.otherIdentifyingInfo"))
 
-            })
+            record = HostRecord(
+                name=clean_name,
+                site=site_name,
+                cluster=inventory.name_of(host.get("parent")),
+                tenant=tenant,
+                model=host.get("hardware.systemInfo.model"),
+                vendor=host.get("hardware.systemInfo.vendor"),
+                serial_number=serial_number,
+                nics=host_nics,
+            )
         except Exception as e:
-            logging.error(f"Error processing host {host.name}: {e}")
-    return host_data
+            logging.error(f"Error processing host {host_name}: {e}")
+            continue
+        profiler.record("fetch_host", time.perf_counter() - start)
+        yield record
 
-def fetch_vm_data(si,logging):
+@profiler.timed("fetch_vm")
+def build_vm_record(vm, inventory, logging, transformer=None):
     """
-    Fetches VM information, applies transformations for cleaning and tenant mapping.
+    Builds a VM record from the VM's property dict, resolving host and datastore
+    references against the inventory snapshot.
     """
-    def _fetch_vms_from_folder(folder):
-        """
-        Recursively fetches VMs from a folder and its subfolders, applying transformations.
-        """
-        vms = []
-        for vm in folder.childEntity:
-            if isinstance(vm, vim.VirtualMachine):
-                logging.info(f"Processing VM: {vm.name}")
-                skip = transformer.should_skip_vm(vm.name)
-                
-                if skip:
-                    continue  # Skip this VM
-            
-                vm_interfaces = []    
-                for net in vm.guest.net:
-                    if hasattr(vm, 'config') and hasattr(vm.config, 'hardware'):
-                        for device in vm.config.hardware.device:
-                            if isinstance(device, vim.vm.device.VirtualEthernetCard):
-                                ipv4_addresses = []
-                                ipv6_addresses = []
-                                if net.macAddress == device.macAddress:
-                                    ip_config = getattr(net, 'ipConfig', None)
-                                    if ip_config and hasattr(ip_config, 'ipAddress'):
-                                        for ip in ip_config.ipAddress:
-                                            logging.debug(f"{ip_config}: {ip}")
-                                            if ':' in ip.ipAddress:
-                                                ipv6_addresses.append({"address": ip.ipAddress, "prefix_length": getattr(ip, 'prefixLength', '48') })
-                                            else:
-                                                ipv4_addresses.append({"address": ip.ipAddress, "prefix_length": getattr(ip, 'prefixLength', '24') })
-                                interface = {
-                                    "vm_name": vm.name, 
-                                    "name": device.deviceInfo.label,
-                                    "mac": device.macAddress if hasattr(device, 'macAddress') else None,
-                                    "enabled": device.connectable.connected if hasattr(device, 'connectable') else False,
-                                    "ipv4_address": ipv4_addresses[0] if len(ipv4_addresses) > 0 else None,
-                                    "ipv6_address": ipv6_addresses[0] if len(ipv6_addresses) > 0 else None,
-                                }
-                                vm_interfaces.append(interface)
-                
-                vm_disks = [
-                    {
-                    "name": disk.deviceInfo.label, 
-                    "capacity": round(disk.capacityInKB / 1024), 
-                    "datastore": disk.backing.datastore.name, 
-                    "vmdk": disk.backing.fileName,
-                    "disk_type": disk.backing.diskMode, 
-                    "thin_thick": "Thin" if hasattr(disk.backing, 'thinProvisioned') else "Thick" 
-                    } for disk in vm.config.hardware.device if hasattr(disk, "capacityInKB")
-                ]
-                
-                vms.append({
-                        "name": vm.name,
-                        "status": "active" if vm.runtime.powerState == "poweredOn" else "offline",
-                        "site": transformer.host_to_site(vm.runtime.host.name) if vm.runtime.host else None,
-                        "cluster": vm.runtime.host.parent.name if vm.runtime.host else None,
-                        "role": transformer.vm_to_role(vm.name),  # Custom logic to map VM names to roles
-                        "device": transformer.clean_name(vm.runtime.host.name),  # Host name without domain
-                        "platform": vm.guest.guestFullName if vm.guest and vm.guest.guestFullName else "Unknown",
-                        "vcpus": vm.config.hardware.numCPU if hasattr(vm.config.hardware, "numCPU") else None,
-                        "memory": vm.config.hardware.memoryMB if hasattr(vm.config.hardware, "memoryMB") else None,
-                        "description": vm.summary.config.annotation if vm.summary.config.annotation else None,
-                        "tenant": transformer.vm_to_tenant(vm.name),
-                        "comments": None,  # Placeholder for any comments
-                        "interfaces": vm_interfaces,  # List of NICs
-                        "disks": vm_disks,  # List of disks
-                        "tenant": transformer.vm_to_tenant(vm.name)
-
-                    })
+    transformer = transformer or default_transformer()
+    vm_name = vm.get("name")
+    devices = vm.get("config.hardware.device", [])
 
-                
-            elif isinstance(vm, vim.Folder):
-                # Recursively process subfolders
-                vms.extend(_fetch_vms_from_folder(vm))
-        return vms
+    # Guest NIC info by MAC address, to attach IPs to the matching ethernet card
+    guest_nets = {net.macAddress: net for net in vm.get("guest.net", []) if getattr(net, "macAddress", None)}
+
+    vm_interfaces = []
+    vm_disks = []
+    for device in devices:
+        if isinstance(device, vim.vm.device.VirtualEthernetCard):
+            mac = getattr(device, "macAddress", None)
+            ipv4_addresses = []
+            ipv6_addresses = []
+            ip_config = getattr(guest_nets.get(mac), "ipConfig", None)
+            for ip in getattr(ip_config, "ipAddress", None) or []:
+                logging.debug(f"{vm_name} {mac}: {ip.ipAddress}")
+                if ':' in ip.ipAddress:
+                    ipv6_addresses.append(f"{ip.ipAddress}/{getattr(ip, 'prefixLength', None) or 48}")
+                else:
+                    ipv4_addresses.append(f"{ip.ipAddress}/{getattr(ip, 'prefixLength', None) or 24}")
+            vm_interfaces.append(VMInterfaceRecord(
+                name=device.deviceInfo.label,
+                mac=mac,
+                enabled=device.connectable.connected if getattr(device, 'connectable', None) else False,
+                ipv4_addresses=ipv4_addresses,
+                ipv6_addresses=ipv6_addresses,
+            ))
+        elif hasattr(device, "capacityInKB"):
+            vm_disks.append(VMDiskRecord(
+                name=device.deviceInfo.label,
+                capacity=round(device.capacityInKB / 1024),
+                datastore=inventory.name_of(device.backing.datastore),
+                vmdk=device.backing.fileName,
+                disk_type=device.backing.diskMode,
+                thin_thick="Thin" if hasattr(device.backing, 'thinProvisioned') else "Thick",
+            ))
+
+    host = inventory.lookup(vm.get("runtime.host"))
+    host_name = host.get("name") if host else None
+
+    return VMRecord(
+        name=vm_name,
+        status="active" if vm.get("runtime.powerState") == "poweredOn" else "offline",
+        site=transformer.host_to_site(host_name) if host_name else None,
+        cluster=inventory.name_of(host.get("parent")) if host else None,
+        role=transformer.vm_to_role(vm_name),  # Custom logic to map VM names to roles
+        device=transformer.clean_name(host_name) if host_name else None,  # Host name without domain
+        platform=vm.get("guest.guestFullName") or "Unknown",
+        vcpus=vm.get("config.hardware.numCPU"),
+        memory=vm.get("config.hardware.memoryMB"),
+        description=vm.get("summary.config.annotation") or None,
+        tenant=transformer.vm_to_tenant(vm_name),
+        interfaces=vm_interfaces,  # List of NICs
+        disks=vm_disks,  # List of disks
+    )
+
+def iter_vm_data(si,logging,inventory=None,transformer=None,page_size=DEFAULT_PAGE_SIZE,scope=None):
+    """
+    Yields VM records one at a time; see fetch_vm_data.
+    If the inventory snapshot was collected with include_vms=False, VMs are streamed
+    from vCenter one PropertyCollector page at a time instead, limited to the scope.
+    """
+    transformer = transformer or default_transformer()
+    if inventory is None:
+        inventory = InventorySnapshot.collect(si, logging, scope=scope)
+
+    if inventory.vms_loaded:
+        vm_props = inventory.vms.values()
+    else:
+        content = si.RetrieveContent()
+        vm_props = (
+            props
+            for datacenter in sorted(inventory.datacenters.values(), key=lambda dc: dc.get("name") or "")
+            for _, props in iter_vm_properties(content, datacenter, inventory, logging, page_size, scope)
+        )
+
+    yield from build_vm_records(vm_props, inventory, logging, transformer)
+
+def build_vm_records(vm_props, inventory, logging, transformer=None):
+    """
+    Yields the records of VM property dicts, leaving out skipped VMs and VMs that fail to build.
+    """
+    transformer = transformer or default_transformer()
+    for vm in vm_props:
+        vm_name = vm.get("name")
+        logging.info(f"Processing VM: {vm_name}")
+        if transformer.should_skip_vm(vm_name):
+            continue  # Skip this VM
+        try:
+            record = build_vm_record(vm, inventory, logging, transformer)
+        except Exception as e:
+            logging.error(f"Error processing VM {vm_name}: {e}")
+            continue
+        yield record
 
+def fetch_vm_data(si,logging,inventory=None,transformer=None):
+    """
+    Fetches VM information, applies transformations for cleaning and tenant mapping.
+    If no inventory snapshot is given, one is retrieved in bulk from vCenter.
+    """
     logging.info("Fetching VMs from vCenter...")
-    content = si.RetrieveContent()
-    vms = []
-    for datacenter in content.rootFolder.childEntity:
-        vm_folder = datacenter.vmFolder
-        vms.extend(_fetch_vms_from_folder(vm_folder))
+    vms = list(iter_vm_data(si, logging, inventory, transformer))
     logging.info(f"Fetched {len(vms)} VMs from vCenter.")
     return vms
-
-   
\ No newline at end of file
@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from transformer import Transformer
+from vcenter_connector import connect_to_vcenter, disconnect_vcenter, SessionCache, SessionKeepAlive
+from vcenter_collector import InventorySnapshot
+from property_cache import PropertyCache
+from scope import Scope, SELECTORS
+from vcenter_fetcher import fetch_cluster_data, fetch_vm_data, default_transformer, DEFAULT_RULE_FILES
+from data_conversion import prepare_data
+from network_index import NetworkIndex
+from ingest_scheduler import IngestScheduler
+from profiling import profiler, cprofile
+
+
+class VCenterLogger(logging.LoggerAdapter):
+    """
+    Prefixes log messages with the vCenter name so interleaved output of parallel syncs stays readable.
+    """
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['vcenter']}] {msg}", kwargs
+
+
+def load_vcenter_configs(path):
+    """
+    Loads the list of vCenters from a YAML file. Each entry needs host and user, and either
+    password or password_env naming the environment variable that holds it.
+    Optional keys: name, verify, rules mapping rule set names to override files, and scope
+    with include and exclude mappings of selector names to lists of regexes.
+    """
+    import yaml
+
+    try:
+        with open(path, "r") as f:
+            config = yaml.safe_load(f) or {}
+    except Exception as e:
+        logging.error(f"Failed to load vCenter config from {path}: {e}")
+        exit(1)
+
+    vcenters = []
+    for entry in config.get("vcenters", []):
+        if not entry.get("host") or not entry.get("user"):
+            logging.error(f"Skipping vCenter entry without host or user: {entry.get('name', entry.get('host'))}")
+            continue
+        password = entry.get("password")
+        if password is None and entry.get("password_env"):
+            password = os.getenv(entry["password_env"])
+        vcenters.append({
+            "name": entry.get("name", entry["host"]),
+            "host": entry["host"],
+            "user": entry["user"],
+            "password": password,
+            "verify": entry.get("verify", True),
+            "rules": entry.get("rules") or {},
+            "scope": entry.get("scope") or {},
+        })
+    return vcenters
+
+
+def build_transformer(rules):
+    """
+    Returns the default Transformer, or a new one if any rule file is overridden.
+    Overrides are loaded in the vCenter's sync thread, so a file that cannot be loaded or
+    has rule errors raises instead of exiting.
+    """
+    unknown = set(rules) - set(DEFAULT_RULE_FILES)
+    if unknown:
+        logging.warning(f"Ignoring unknown rule sets in vCenter config: {sorted(unknown)}")
+    if not set(rules) & set(DEFAULT_RULE_FILES):
+        return default_transformer()
+    paths = {**DEFAULT_RULE_FILES, **{name: path for name, path in rules.items() if name in DEFAULT_RULE_FILES}}
+    return Transformer(*paths.values(), fatal=False)
+
+
+def build_scope(config, args, transformer):
+    """
+    Returns the Scope of a vCenter: the --include-*/--exclude-* options, with each selector
+    replaced by the vCenter's own scope config where it sets one, plus the skip rules.
+    """
+    include = {key: getattr(args, f"include_{key}") for key in SELECTORS}
+    exclude = {key: getattr(args, f"exclude_{key}") for key in SELECTORS}
+    include.update(config.get("include") or {})
+    exclude.update(config.get("exclude") or {})
+    return Scope(include, exclude, skip_vm=transformer.should_skip_vm)
+
+
+def build_property_cache(vcenter, args, state, log):
+    """
+    Returns the PropertyCache of a vCenter if --refresh-intervals is set. The cache lives in
+    the state store, and full sync runs refresh every property group.
+    """
+    if not args.refresh_intervals:
+        return None
+    if state is None:
+        log.warning("Refresh intervals need --state-db; retrieving all properties.")
+        return None
+    return PropertyCache(state, vcenter["name"], args.refresh_intervals, log, refresh_all=state.full_sync)
+
+
+def sync_vcenter(vcenter, client, args, state=None, snapshot=None, outbox=None, network_index=None):
+    """
+    Connects to one vCenter, fetches its inventory and ingests it through the shared Diode client.
+    With --profile, the sync runs under cProfile. With a SnapshotWriter, fetched records are saved to it.
+    With an Outbox, entities are written to it before they are sent. With a NetworkIndex, prefixes
+    already sent for another vCenter of the run are not sent again; daemons keep their own.
+    :return: dict with the vCenter name, success flag, counts, elapsed seconds, error,
+             rule set statistics and ingest counters
+    """
+    with cprofile(args.profile, vcenter["name"], logging):
+        return _sync_vcenter(vcenter, client, args, state, snapshot, outbox, network_index)
+
+
+def _sync_vcenter(vcenter, client, args, state=None, snapshot=None, outbox=None, network_index=None):
+    log = VCenterLogger(logging.getLogger(), {"vcenter": vcenter["name"]})
+    result = {"name": vcenter["name"], "ok": False, "clusters": 0, "vms": 0, "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    try:
+        transformer = build_transformer(vcenter["rules"])
+    except Exception as e:
+        log.error(f"Failed to load rule files: {e}")
+        result["error"] = f"invalid rules: {e}"
+        result["seconds"] = time.perf_counter() - start
+        return result
+    try:
+        scope = build_scope(vcenter.get("scope") or {}, args, transformer)
+    except (ValueError, re.error) as e:
+        log.error(f"Invalid scope: {e}")
+        result["error"] = f"invalid scope: {e}"
+        result["seconds"] = time.perf_counter() - start
+        return result
+    cache = build_property_cache(vcenter, args, state, log)
+
+    session_cache = SessionCache(args.session_cache) if args.session_cache else None
+    with profiler.phase("connect"):
+        si = connect_to_vcenter(vcenter["host"], vcenter["user"], vcenter["password"], vcenter["verify"], session_cache)
+    if not si:
+        result["error"] = "connection failed"
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    keepalive = SessionKeepAlive(
+        si, vcenter["user"], vcenter["password"], log,
+        interval=args.keepalive_interval, host=vcenter["host"], session_cache=session_cache,
+    ).start()
+    scheduler = None
+    # The async pipeline sends through an ingester of its own; a scheduler would also drain the outbox
+    if args.daemon or not args.async_mode:
+        scheduler = IngestScheduler(
+            client, log, state,
+            max_in_flight=args.ingest_workers,
+            max_batch_entities=args.batch_size,
+            max_retries=args.ingest_retries,
+            outbox=outbox,
+        )
+    try:
+        # Each mode's module is imported only when it runs
+        if args.daemon:
+            from delta_sync import run_delta_sync
+
+            log.info("Running in daemon mode...")
+            if snapshot is not None:
+                log.warning("Snapshots are not written in daemon mode.")
+            run_delta_sync(si, client, log, args.update_wait, state, transformer, scheduler, args.full_sync_interval, scope)
+            return result
+
+        if args.async_mode:
+            from async_pipeline import run_async_pipeline
+
+            log.info("Streaming vCenter data to Diode on an asyncio event loop...")
+            clusters, vms, ingest = run_async_pipeline(
+                si, client, log, transformer, state,
+                page_size=args.page_size, workers=args.fetch_workers,
+                fetch_concurrency=args.fetch_concurrency, ingest_concurrency=args.ingest_workers,
+                max_batch_entities=args.batch_size, max_retries=args.ingest_retries,
+                queue_size=args.queue_size, snapshot=snapshot, vcenter=vcenter["name"], scope=scope, cache=cache,
+                outbox=outbox, network_index=network_index,
+            )
+            result.update(ok=True, clusters=clusters, vms=vms, ingest=ingest)
+            return result
+
+        if args.pipeline:
+            from pipeline import run_pipeline
+
+            log.info("Streaming vCenter data to Diode...")
+            clusters, vms = run_pipeline(
+                si, client, log, transformer, state,
+                page_size=args.page_size, workers=args.fetch_workers, queue_size=args.queue_size,
+                scheduler=scheduler, snapshot=snapshot, vcenter=vcenter["name"], scope=scope, cache=cache,
+                network_index=network_index,
+            )
+            result.update(ok=True, clusters=clusters, vms=vms)
+            return result
+
+        inventory = InventorySnapshot.collect(si, log, page_size=args.page_size, workers=args.fetch_workers, scope=scope, cache=cache)
+
+        log.info("Fetching cluster data from vCenter...")
+        cluster_data = fetch_cluster_data(si, log, inventory, transformer)
+        log.info(f"Fetched {len(cluster_data)} clusters.")
+
+        log.info("Fetching VM data from vCenter...")
+        vm_data = fetch_vm_data(si, log, inventory, transformer)
+        log.info(f"Fetched {len(vm_data)} VMs.")
+
+        if snapshot is not None:
+            for cluster in cluster_data:
+                snapshot.write("cluster", cluster, vcenter["name"])
+            for vm in vm_data:
+                snapshot.write("vm", vm, vcenter["name"])
+
+        log.info("Transforming data to Diode entities...")
+        prepare_data(
+            client, cluster_data, vm_data, log, state=state, scheduler=scheduler,
+            network_index=network_index, processes=args.convert_processes,
+        )
+
+        result.update(ok=True, clusters=len(cluster_data), vms=len(vm_data))
+    except Exception as e:
+        log.error(f"An error occurred during the process: {e}")
+        result["error"] = str(e)
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+            result.setdefault("ingest", scheduler.stats())
+        result["rules"] = transformer.stats()
+        if cache is not None:
+            result["refresh"] = cache.stats()
+            log.info(f"Property cache: {result['refresh']}")
+        for name, stats in result["rules"].items():
+            log.info(f"Rule set {name}: {stats}")
+        keepalive.stop()
+        # Disconnect from vCenter, leaving a cached session open for the next run
+        log.info("Disconnecting from vCenter...")
+        disconnect_vcenter(si, logout=session_cache is None)
+        result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def sync_vcenters(vcenters, client, args, state=None, snapshot=None, outbox=None):
+    """
+    Syncs all vCenters in parallel, one thread each, and reports each result as it finishes
+    so a slow or failing vCenter does not hold up the others. They share one NetworkIndex,
+    so a prefix is sent once per run.
+    """
+    results = []
+    network_index = NetworkIndex()
+    # The default rules are loaded here, so unreadable default rule files exit before any sync starts
+    default_transformer()
+    with ThreadPoolExecutor(max_workers=max(1, len(vcenters))) as executor:
+        futures = {executor.submit(sync_vcenter, vcenter, client, args, state, snapshot, outbox, network_index): vcenter for vcenter in vcenters}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name": futures[future]["name"], "ok": False, "clusters": 0, "vms": 0, "seconds": 0.0, "error": str(e)}
+            if result["ok"]:
+                logging.info(
+                    f"vCenter {result['name']}: {result['clusters']} clusters, {result['vms']} VMs in {result['seconds']:.1f}s."
+                )
+            else:
+                logging.error(f"vCenter {result['name']} failed after {result['seconds']:.1f}s: {result['error']}")
+            results.append(result)
+    return results